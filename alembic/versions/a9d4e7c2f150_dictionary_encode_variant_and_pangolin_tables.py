@@ -0,0 +1,307 @@
+"""dictionary-encode variant_ivar and pangolin_result
+
+Revision ID: a9d4e7c2f150
+Revises: f1c6d2b8e4a7
+Create Date: 2026-10-18 11:31:06.418275
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4e7c2f150'
+down_revision = 'f1c6d2b8e4a7'
+branch_labels = None
+depends_on = None
+
+
+# The rows move to variant_ivar_encoded and pangolin_result_encoded, where
+# library IDs, variant caller names and versions, reference accessions,
+# gene names and pangolin versions are replaced by integer IDs into small
+# dictionary tables. variant_ivar and pangolin_result become views that
+# decode them, so existing queries keep working. The views use left joins
+# (every ID is in its dictionary, so the rows are the same), which SQLite
+# can leave out of simple queries that don't use a dictionary's columns, but
+# not out of grouped queries; those read the encoded tables directly.
+#
+# The old tables' key columns are NOT NULL, like the dictionaries' columns,
+# so every row has an entry in each dictionary. The copies still match with
+# IS rather than =, and the upgrade checks that every row was copied.
+
+VARIANT_IVAR_VIEW = """
+CREATE VIEW variant_ivar AS
+SELECT
+    library_dictionary.library_id AS library_id,
+    variant_calling_tool_dictionary.variant_calling_tool AS variant_calling_tool,
+    variant_calling_tool_dictionary.variant_calling_tool_version AS variant_calling_tool_version,
+    ref_accession_dictionary.ref_accession AS ref_accession,
+    v.nucleotide_position AS nucleotide_position,
+    v.ref_allele AS ref_allele,
+    v.alt_allele AS alt_allele,
+    v.ref_allele_depth AS ref_allele_depth,
+    v.ref_allele_depth_reverse_reads AS ref_allele_depth_reverse_reads,
+    v.ref_allele_mean_quality AS ref_allele_mean_quality,
+    v.alt_allele_depth AS alt_allele_depth,
+    v.alt_allele_depth_reverse_reads AS alt_allele_depth_reverse_reads,
+    v.alt_allele_mean_quality AS alt_allele_mean_quality,
+    v.alt_allele_frequency AS alt_allele_frequency,
+    v.consensus_allele AS consensus_allele,
+    v.variant_type AS variant_type,
+    v.is_ambiguous AS is_ambiguous,
+    v.total_depth AS total_depth,
+    v.p_value_fishers_exact AS p_value_fishers_exact,
+    v.p_value_pass AS p_value_pass,
+    gene_name_dictionary.gene_name AS gene_name,
+    v.ref_codon AS ref_codon,
+    v.ref_amino_acid AS ref_amino_acid,
+    v.alt_codon AS alt_codon,
+    v.alt_amino_acid AS alt_amino_acid,
+    v.codon_position AS codon_position,
+    v.mutation_name_by_amino_acid AS mutation_name_by_amino_acid
+FROM variant_ivar_encoded AS v
+LEFT JOIN library_dictionary ON library_dictionary.id = v.library_key
+LEFT JOIN variant_calling_tool_dictionary ON variant_calling_tool_dictionary.id = v.variant_calling_tool_id
+LEFT JOIN ref_accession_dictionary ON ref_accession_dictionary.id = v.ref_accession_id
+LEFT JOIN gene_name_dictionary ON gene_name_dictionary.id = v.gene_name_id
+"""
+
+PANGOLIN_RESULT_VIEW = """
+CREATE VIEW pangolin_result AS
+SELECT
+    p.sequencing_run_id AS sequencing_run_id,
+    library_dictionary.library_id AS library_id,
+    p.lineage AS lineage,
+    p.conflict AS conflict,
+    p.ambiguity_score AS ambiguity_score,
+    p.scorpio_call AS scorpio_call,
+    p.scorpio_support AS scorpio_support,
+    p.scorpio_conflict AS scorpio_conflict,
+    pangolin_version_dictionary.version AS version,
+    pangolin_version_dictionary.pangolin_version AS pangolin_version,
+    pangolin_version_dictionary.pangolearn_version AS pangolearn_version,
+    pangolin_version_dictionary.pango_version AS pango_version,
+    p.status AS status,
+    p.note AS note
+FROM pangolin_result_encoded AS p
+LEFT JOIN library_dictionary ON library_dictionary.id = p.library_key
+LEFT JOIN pangolin_version_dictionary ON pangolin_version_dictionary.id = p.pangolin_version_id
+"""
+
+
+def variant_ivar_columns():
+    return [
+        sa.Column('ref_allele_depth',               sa.Integer),
+        sa.Column('ref_allele_depth_reverse_reads', sa.Integer),
+        sa.Column('ref_allele_mean_quality',        sa.Integer),
+        sa.Column('alt_allele_depth',               sa.Integer),
+        sa.Column('alt_allele_depth_reverse_reads', sa.Integer),
+        sa.Column('alt_allele_mean_quality',        sa.Integer),
+        sa.Column('alt_allele_frequency',           sa.Float),
+        sa.Column('consensus_allele',               sa.String),
+        sa.Column('variant_type',                   sa.String),
+        sa.Column('is_ambiguous',                   sa.Boolean),
+        sa.Column('total_depth',                    sa.Integer),
+        sa.Column('p_value_fishers_exact',          sa.Float),
+        sa.Column('p_value_pass',                   sa.Boolean),
+    ]
+
+
+def variant_ivar_amino_acid_columns():
+    return [
+        sa.Column('ref_codon',                      sa.String),
+        sa.Column('ref_amino_acid',                 sa.String),
+        sa.Column('alt_codon',                      sa.String),
+        sa.Column('alt_amino_acid',                 sa.String),
+        sa.Column('codon_position',                 sa.Integer),
+        sa.Column('mutation_name_by_amino_acid',    sa.String),
+    ]
+
+
+def upgrade():
+    op.create_table(
+        'library_dictionary',
+        sa.Column('id',         sa.Integer, primary_key=True),
+        sa.Column('library_id', sa.String, sa.ForeignKey('library.id'), unique=True, nullable=False),
+    )
+    op.create_table(
+        'variant_calling_tool_dictionary',
+        sa.Column('id',                           sa.Integer, primary_key=True),
+        sa.Column('variant_calling_tool',         sa.String, nullable=False),
+        sa.Column('variant_calling_tool_version', sa.String, nullable=False),
+        sa.UniqueConstraint('variant_calling_tool', 'variant_calling_tool_version'),
+    )
+    op.create_table(
+        'ref_accession_dictionary',
+        sa.Column('id',            sa.Integer, primary_key=True),
+        sa.Column('ref_accession', sa.String, unique=True, nullable=False),
+    )
+    op.create_table(
+        'gene_name_dictionary',
+        sa.Column('id',        sa.Integer, primary_key=True),
+        sa.Column('gene_name', sa.String, unique=True, nullable=False),
+    )
+    op.create_table(
+        'pangolin_version_dictionary',
+        sa.Column('id',                 sa.Integer, primary_key=True),
+        sa.Column('version',            sa.String),
+        sa.Column('pangolin_version',   sa.String),
+        sa.Column('pangolearn_version', sa.String),
+        sa.Column('pango_version',      sa.String),
+        sa.UniqueConstraint('version', 'pangolin_version', 'pangolearn_version', 'pango_version'),
+    )
+
+    op.create_table(
+        'variant_ivar_encoded',
+        sa.Column('library_key',             sa.Integer, sa.ForeignKey('library_dictionary.id'), primary_key=True),
+        sa.Column('variant_calling_tool_id', sa.Integer, sa.ForeignKey('variant_calling_tool_dictionary.id'), primary_key=True),
+        sa.Column('ref_accession_id',        sa.Integer, sa.ForeignKey('ref_accession_dictionary.id'), primary_key=True),
+        sa.Column('nucleotide_position',     sa.Integer, primary_key=True),
+        sa.Column('ref_allele',              sa.String, primary_key=True),
+        sa.Column('alt_allele',              sa.String, primary_key=True),
+        *variant_ivar_columns(),
+        sa.Column('gene_name_id',            sa.Integer, sa.ForeignKey('gene_name_dictionary.id')),
+        *variant_ivar_amino_acid_columns(),
+        sqlite_with_rowid=False,
+    )
+    op.create_table(
+        'pangolin_result_encoded',
+        sa.Column('sequencing_run_id',   sa.String, sa.ForeignKey('sequencing_run.id'), primary_key=True),
+        sa.Column('library_key',         sa.Integer, sa.ForeignKey('library_dictionary.id'), primary_key=True),
+        sa.Column('lineage',             sa.String),
+        sa.Column('conflict',            sa.Float),
+        sa.Column('ambiguity_score',     sa.Float),
+        sa.Column('scorpio_call',        sa.String),
+        sa.Column('scorpio_support',     sa.Float),
+        sa.Column('scorpio_conflict',    sa.Float),
+        sa.Column('pangolin_version_id', sa.Integer, sa.ForeignKey('pangolin_version_dictionary.id'), primary_key=True),
+        sa.Column('status',              sa.String),
+        sa.Column('note',                sa.String),
+        sqlite_with_rowid=False,
+    )
+
+    op.execute("""
+        INSERT INTO library_dictionary (library_id)
+        SELECT library_id FROM variant_ivar
+        UNION
+        SELECT library_id FROM pangolin_result
+    """)
+    op.execute("""
+        INSERT INTO variant_calling_tool_dictionary (variant_calling_tool, variant_calling_tool_version)
+        SELECT DISTINCT variant_calling_tool, variant_calling_tool_version FROM variant_ivar
+    """)
+    op.execute('INSERT INTO ref_accession_dictionary (ref_accession) SELECT DISTINCT ref_accession FROM variant_ivar')
+    op.execute('INSERT INTO gene_name_dictionary (gene_name) SELECT DISTINCT gene_name FROM variant_ivar WHERE gene_name IS NOT NULL')
+    op.execute("""
+        INSERT INTO pangolin_version_dictionary (version, pangolin_version, pangolearn_version, pango_version)
+        SELECT DISTINCT version, pangolin_version, pangolearn_version, pango_version FROM pangolin_result
+    """)
+
+    op.execute("""
+        INSERT INTO variant_ivar_encoded
+        SELECT
+            library_dictionary.id, variant_calling_tool_dictionary.id, ref_accession_dictionary.id,
+            v.nucleotide_position, v.ref_allele, v.alt_allele,
+            v.ref_allele_depth, v.ref_allele_depth_reverse_reads, v.ref_allele_mean_quality,
+            v.alt_allele_depth, v.alt_allele_depth_reverse_reads, v.alt_allele_mean_quality,
+            v.alt_allele_frequency, v.consensus_allele, v.variant_type, v.is_ambiguous,
+            v.total_depth, v.p_value_fishers_exact, v.p_value_pass,
+            gene_name_dictionary.id,
+            v.ref_codon, v.ref_amino_acid, v.alt_codon, v.alt_amino_acid, v.codon_position, v.mutation_name_by_amino_acid
+        FROM variant_ivar AS v
+        JOIN library_dictionary ON library_dictionary.library_id IS v.library_id
+        JOIN variant_calling_tool_dictionary
+          ON variant_calling_tool_dictionary.variant_calling_tool IS v.variant_calling_tool
+         AND variant_calling_tool_dictionary.variant_calling_tool_version IS v.variant_calling_tool_version
+        JOIN ref_accession_dictionary ON ref_accession_dictionary.ref_accession IS v.ref_accession
+        LEFT JOIN gene_name_dictionary ON gene_name_dictionary.gene_name = v.gene_name
+    """)
+    op.execute("""
+        INSERT INTO pangolin_result_encoded
+        SELECT
+            p.sequencing_run_id, library_dictionary.id,
+            p.lineage, p.conflict, p.ambiguity_score, p.scorpio_call, p.scorpio_support, p.scorpio_conflict,
+            pangolin_version_dictionary.id,
+            p.status, p.note
+        FROM pangolin_result AS p
+        JOIN library_dictionary ON library_dictionary.library_id IS p.library_id
+        JOIN pangolin_version_dictionary
+          ON pangolin_version_dictionary.version IS p.version
+         AND pangolin_version_dictionary.pangolin_version IS p.pangolin_version
+         AND pangolin_version_dictionary.pangolearn_version IS p.pangolearn_version
+         AND pangolin_version_dictionary.pango_version IS p.pango_version
+    """)
+
+    connection = op.get_bind()
+    for table, encoded_table in [('variant_ivar', 'variant_ivar_encoded'), ('pangolin_result', 'pangolin_result_encoded')]:
+        num_rows = connection.execute(sa.text('SELECT COUNT(*) FROM {}'.format(table))).scalar()
+        num_encoded_rows = connection.execute(sa.text('SELECT COUNT(*) FROM {}'.format(encoded_table))).scalar()
+        if num_encoded_rows != num_rows:
+            raise RuntimeError('{} of {} rows of {} were copied to {}'.format(num_encoded_rows, num_rows, table, encoded_table))
+
+    op.drop_index('ix_variant_ivar_nucleotide_position', 'variant_ivar')
+    op.drop_index('ix_variant_ivar_mutation_name_by_amino_acid', 'variant_ivar')
+    op.drop_index('ix_pangolin_result_lineage', 'pangolin_result')
+    op.drop_table('variant_ivar')
+    op.drop_table('pangolin_result')
+
+    op.execute(VARIANT_IVAR_VIEW)
+    op.execute(PANGOLIN_RESULT_VIEW)
+
+    op.create_index('ix_variant_ivar_nucleotide_position', 'variant_ivar_encoded', ['nucleotide_position', 'library_key'])
+    op.create_index('ix_variant_ivar_mutation_name_by_amino_acid', 'variant_ivar_encoded', ['mutation_name_by_amino_acid', 'library_key'])
+    op.create_index('ix_pangolin_result_lineage', 'pangolin_result_encoded', ['lineage', 'library_key'])
+
+
+def downgrade():
+    op.create_table(
+        'variant_ivar_decoded',
+        sa.Column('library_id',                     sa.String, sa.ForeignKey('library.id'), primary_key=True),
+        sa.Column('variant_calling_tool',           sa.String, primary_key=True),
+        sa.Column('variant_calling_tool_version',   sa.String, primary_key=True),
+        sa.Column('ref_accession',                  sa.String, primary_key=True),
+        sa.Column('nucleotide_position',            sa.Integer, primary_key=True),
+        sa.Column('ref_allele',                     sa.String, primary_key=True),
+        sa.Column('alt_allele',                     sa.String, primary_key=True),
+        *variant_ivar_columns(),
+        sa.Column('gene_name',                      sa.String),
+        *variant_ivar_amino_acid_columns(),
+    )
+    op.create_table(
+        'pangolin_result_decoded',
+        sa.Column('sequencing_run_id',  sa.String, sa.ForeignKey('sequencing_run.id'), primary_key=True),
+        sa.Column('library_id',         sa.String, sa.ForeignKey('library.id'), primary_key=True),
+        sa.Column('lineage',            sa.String),
+        sa.Column('conflict',           sa.Float),
+        sa.Column('ambiguity_score',    sa.Float),
+        sa.Column('scorpio_call',       sa.String),
+        sa.Column('scorpio_support',    sa.Float),
+        sa.Column('scorpio_conflict',   sa.Float),
+        sa.Column('version',            sa.String, primary_key=True),
+        sa.Column('pangolin_version',   sa.String, primary_key=True),
+        sa.Column('pangolearn_version', sa.String, primary_key=True),
+        sa.Column('pango_version',      sa.String, primary_key=True),
+        sa.Column('status',             sa.String),
+        sa.Column('note',               sa.String),
+    )
+    op.execute('INSERT INTO variant_ivar_decoded SELECT * FROM variant_ivar')
+    op.execute('INSERT INTO pangolin_result_decoded SELECT * FROM pangolin_result')
+
+    op.execute('DROP VIEW variant_ivar')
+    op.execute('DROP VIEW pangolin_result')
+    op.drop_index('ix_pangolin_result_lineage', 'pangolin_result_encoded')
+    op.drop_index('ix_variant_ivar_mutation_name_by_amino_acid', 'variant_ivar_encoded')
+    op.drop_index('ix_variant_ivar_nucleotide_position', 'variant_ivar_encoded')
+    op.drop_table('pangolin_result_encoded')
+    op.drop_table('variant_ivar_encoded')
+    op.drop_table('pangolin_version_dictionary')
+    op.drop_table('gene_name_dictionary')
+    op.drop_table('ref_accession_dictionary')
+    op.drop_table('variant_calling_tool_dictionary')
+    op.drop_table('library_dictionary')
+
+    op.rename_table('variant_ivar_decoded', 'variant_ivar')
+    op.rename_table('pangolin_result_decoded', 'pangolin_result')
+    op.create_index('ix_variant_ivar_nucleotide_position', 'variant_ivar', ['nucleotide_position', 'library_id'])
+    op.create_index('ix_variant_ivar_mutation_name_by_amino_acid', 'variant_ivar', ['mutation_name_by_amino_acid', 'library_id'])
+    op.create_index('ix_pangolin_result_lineage', 'pangolin_result', ['lineage', 'library_id'])
@@ -0,0 +1,33 @@
+"""create loaded file table
+
+Revision ID: b7e5c1d09a4f
+Revises: a3024132ae72
+Create Date: 2026-10-18 10:30:12.418203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e5c1d09a4f'
+down_revision = 'a3024132ae72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'loaded_file',
+        sa.Column('path',         sa.String, primary_key=True),
+        sa.Column('file_type',    sa.String),
+        sa.Column('size',         sa.Integer),
+        sa.Column('mtime',        sa.Float),
+        sa.Column('content_hash', sa.String),
+        sa.Column('row_count',    sa.Integer),
+        sa.Column('loaded_at',    sa.String),
+    )
+
+
+def downgrade():
+    op.drop_table('loaded_file')
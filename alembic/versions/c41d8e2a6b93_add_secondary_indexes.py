@@ -0,0 +1,34 @@
+"""add secondary indexes
+
+Revision ID: c41d8e2a6b93
+Revises: b7e5c1d09a4f
+Create Date: 2026-10-18 10:41:37.205118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d8e2a6b93'
+down_revision = 'b7e5c1d09a4f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_variant_ivar_nucleotide_position', 'variant_ivar', ['nucleotide_position', 'library_id'])
+    op.create_index('ix_variant_ivar_mutation_name_by_amino_acid', 'variant_ivar', ['mutation_name_by_amino_acid', 'library_id'])
+    op.create_index('ix_ncov_tools_amino_acid_mutation_mutation_name_by_amino_acid', 'ncov_tools_amino_acid_mutation', ['mutation_name_by_amino_acid', 'library_id'])
+    op.create_index('ix_pangolin_result_lineage', 'pangolin_result', ['lineage', 'library_id'])
+    op.create_index('ix_ncov_tools_summary_qc_sequencing_run_id', 'ncov_tools_summary_qc', ['sequencing_run_id', 'qc_pass', 'library_id'])
+    op.create_index('ix_container_collection_date', 'container', ['collection_date', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_container_collection_date', 'container')
+    op.drop_index('ix_ncov_tools_summary_qc_sequencing_run_id', 'ncov_tools_summary_qc')
+    op.drop_index('ix_pangolin_result_lineage', 'pangolin_result')
+    op.drop_index('ix_ncov_tools_amino_acid_mutation_mutation_name_by_amino_acid', 'ncov_tools_amino_acid_mutation')
+    op.drop_index('ix_variant_ivar_mutation_name_by_amino_acid', 'variant_ivar')
+    op.drop_index('ix_variant_ivar_nucleotide_position', 'variant_ivar')
@@ -0,0 +1,44 @@
+"""create rollup tables
+
+Revision ID: d5e2f7a9c310
+Revises: c41d8e2a6b93
+Create Date: 2026-10-18 10:52:08.631940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e2f7a9c310'
+down_revision = 'c41d8e2a6b93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'mutation_prevalence_rollup',
+        sa.Column('source',                      sa.String, primary_key=True),
+        sa.Column('mutation_name_by_amino_acid', sa.String, primary_key=True),
+        sa.Column('week_start',                  sa.String, primary_key=True),
+        sa.Column('sequencing_run_id',           sa.String, sa.ForeignKey('sequencing_run.id'), primary_key=True),
+        sa.Column('num_libraries',               sa.Integer),
+    )
+    op.create_index('ix_mutation_prevalence_rollup_sequencing_run_id', 'mutation_prevalence_rollup', ['sequencing_run_id'])
+
+    op.create_table(
+        'library_count_rollup',
+        sa.Column('week_start',        sa.String, primary_key=True),
+        sa.Column('sequencing_run_id', sa.String, sa.ForeignKey('sequencing_run.id'), primary_key=True),
+        sa.Column('num_libraries',     sa.Integer),
+        sa.Column('num_qc_pass',       sa.Integer),
+    )
+    op.create_index('ix_library_count_rollup_sequencing_run_id', 'library_count_rollup', ['sequencing_run_id'])
+
+
+def downgrade():
+    op.drop_index('ix_library_count_rollup_sequencing_run_id', 'library_count_rollup')
+    op.drop_table('library_count_rollup')
+    op.drop_index('ix_mutation_prevalence_rollup_sequencing_run_id', 'mutation_prevalence_rollup')
+    op.drop_table('mutation_prevalence_rollup')
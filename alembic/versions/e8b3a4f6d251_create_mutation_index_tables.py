@@ -0,0 +1,43 @@
+"""create mutation index tables
+
+Revision ID: e8b3a4f6d251
+Revises: d5e2f7a9c310
+Create Date: 2026-10-18 11:04:52.117306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b3a4f6d251'
+down_revision = 'd5e2f7a9c310'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'mutation_dictionary',
+        sa.Column('id',                          sa.Integer, primary_key=True),
+        sa.Column('mutation_name_by_amino_acid', sa.String, unique=True, nullable=False),
+    )
+
+    op.create_table(
+        'mutation_index_library',
+        sa.Column('bit',        sa.Integer, primary_key=True),
+        sa.Column('library_id', sa.String, sa.ForeignKey('library.id'), unique=True, nullable=False),
+    )
+
+    op.create_table(
+        'mutation_bitmap',
+        sa.Column('mutation_id',   sa.Integer, sa.ForeignKey('mutation_dictionary.id'), primary_key=True),
+        sa.Column('num_libraries', sa.Integer),
+        sa.Column('bitmap',        sa.LargeBinary),
+    )
+
+
+def downgrade():
+    op.drop_table('mutation_bitmap')
+    op.drop_table('mutation_index_library')
+    op.drop_table('mutation_dictionary')
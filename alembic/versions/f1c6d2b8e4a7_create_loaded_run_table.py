@@ -0,0 +1,29 @@
+"""create loaded run table
+
+Revision ID: f1c6d2b8e4a7
+Revises: e8b3a4f6d251
+Create Date: 2026-10-18 11:15:27.903411
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c6d2b8e4a7'
+down_revision = 'e8b3a4f6d251'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'loaded_run',
+        sa.Column('run_dir',           sa.String, primary_key=True),
+        sa.Column('sequencing_run_id', sa.String),
+        sa.Column('loaded_at',         sa.String),
+    )
+
+
+def downgrade():
+    op.drop_table('loaded_run')
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Compare the parse and store time of the ncov-tools amino acid table loader
+against the previous implementation (three re.search calls per row, and an
+ORM lookup per row when storing), on a full plate's _aa_table.tsv.
+
+The table is generated with ncov_db.synthetic unless one is given with
+--aa-table. Each store is timed against a new database.
+
+usage (from the repository root): python -m benchmarks.bench_aa_table [--aa-table PATH] [--libraries N] [--variants-per-library M]
+                                                                      [--repeats R]
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import re
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+from ncov_db import db
+from ncov_db import discovery
+from ncov_db import entities
+from ncov_db import models
+from ncov_db import store_ncov_tools_amino_acid_mutation_table
+from ncov_db import synthetic
+from ncov_db import tsv
+
+from benchmarks.bench_sqlite_profiles import init_db
+
+
+def legacy_parse_amino_acid_mutation_tsv(amino_acid_mutation_tsv_path):
+    """The parser as it was before the precompiled tokenizer, kept for comparison."""
+    field_names = [name for name, column, converter in store_ncov_tools_amino_acid_mutation_table.AMINO_ACID_MUTATION_FIELDS]
+
+    for values in tsv.decode_rows(amino_acid_mutation_tsv_path, store_ncov_tools_amino_acid_mutation_table.AMINO_ACID_MUTATION_FIELDS):
+        m = dict(zip(field_names, values))
+
+        if m['amino_acid_change'] and not re.search('deletion', m['consequence']):
+            ref_aa_match = re.search('^[A-Z]+', m['amino_acid_change'])
+            m['ref_amino_acid'] = ref_aa_match.group(0) if ref_aa_match else None
+            codon_position_match = re.search('[0-9]+', m['amino_acid_change'])
+            m['codon_position'] = int(codon_position_match.group(0)) if codon_position_match else None
+            alt_aa_match = re.search('[A-Z]+$', m['amino_acid_change'])
+            m['alt_amino_acid'] = alt_aa_match.group(0) if alt_aa_match else None
+        else:
+            m['ref_amino_acid'] = None
+            m['codon_position'] = None
+            m['alt_amino_acid'] = None
+
+        m.pop('amino_acid_change')
+
+        if m['gene'] is not None:
+            m['gene'] = m['gene'].replace('orf', 'ORF')
+
+        if m['mutation_name_by_amino_acid'] is not None:
+            m['mutation_name_by_amino_acid'] = m['mutation_name_by_amino_acid'].replace('-', ':').replace('orf', 'ORF')
+
+        yield m
+
+
+def legacy_store_amino_acid_mutations(session, amino_acid_mutations):
+    """The store step as it was before bulk inserts, kept for comparison."""
+    entity_cache = entities.get_entity_cache(session)
+    entity_cache.ensure_libraries(m['library_id'] for m in amino_acid_mutations)
+    num_inserted = 0
+    for m in amino_acid_mutations:
+        amino_acid_mutation = models.NcovToolsAminoAcidMutation()
+        for key in m.keys():
+            setattr(amino_acid_mutation, key, m[key])
+
+        existing_amino_acid_mutation = (
+            session.query(models.NcovToolsAminoAcidMutation)
+            .filter(
+                sa.and_(
+                    models.NcovToolsAminoAcidMutation.library_id == amino_acid_mutation.library_id,
+                    models.NcovToolsAminoAcidMutation.ref_accession == amino_acid_mutation.ref_accession,
+                    models.NcovToolsAminoAcidMutation.nucleotide_position == amino_acid_mutation.nucleotide_position,
+                    models.NcovToolsAminoAcidMutation.ref_allele == amino_acid_mutation.ref_allele,
+                    models.NcovToolsAminoAcidMutation.alt_allele == amino_acid_mutation.alt_allele,
+                )
+            )
+            .one_or_none()
+        )
+        if existing_amino_acid_mutation is None:
+            session.add(amino_acid_mutation)
+            num_inserted += 1
+    session.flush()
+
+    return num_inserted
+
+
+def current_store_amino_acid_mutations(session, amino_acid_mutations):
+    return store_ncov_tools_amino_acid_mutation_table.store_amino_acid_mutations(session, amino_acid_mutations)['inserted']
+
+
+def time_parser(parse, path, repeats):
+    best = None
+    for _ in range(repeats):
+        store_ncov_tools_amino_acid_mutation_table.parse_amino_acid_change.cache_clear()
+        start = time.perf_counter()
+        rows = list(parse(path))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return rows, best
+
+
+def time_store(store, rows, db_path):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        init_db(db_path)
+    session = db.create_session(db_path)
+    start = time.perf_counter()
+    num_inserted = store(session, rows)
+    session.commit()
+    elapsed = time.perf_counter() - start
+    db.close_session(session)
+
+    return num_inserted, elapsed
+
+
+def main(args):
+    implementations = [
+        ('legacy', legacy_parse_amino_acid_mutation_tsv, legacy_store_amino_acid_mutations),
+        ('current', store_ncov_tools_amino_acid_mutation_table.parse_amino_acid_mutation_tsv, current_store_amino_acid_mutations),
+    ]
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        aa_table_path = args.aa_table
+        if aa_table_path is None:
+            run_dir = synthetic.generate_run(tmp_dir, num_libraries=args.libraries, variants_per_library=args.variants_per_library)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                aa_table_path = discovery.discover_run_files(run_dir)['ncov_tools_aa_table'][0]
+
+        for name, parse, store in implementations:
+            rows, parse_seconds = time_parser(parse, aa_table_path, args.repeats)
+            num_inserted, store_seconds = time_store(store, rows, os.path.join(tmp_dir, name + '.db'))
+            results[name] = {
+                'rows': len(rows),
+                'rows_inserted': num_inserted,
+                'parse_seconds': round(parse_seconds, 4),
+                'store_seconds': round(store_seconds, 4),
+                'rows_per_sec': round(len(rows) / (parse_seconds + store_seconds)),
+            }
+
+    results['parse_speedup'] = round(results['legacy']['parse_seconds'] / results['current']['parse_seconds'], 1)
+    results['store_speedup'] = round(results['legacy']['store_seconds'] / results['current']['store_seconds'], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aa-table', help='ncov-tools _aa_table.tsv to load (default: a synthetic full plate)')
+    parser.add_argument('--libraries', default=94, type=int)
+    parser.add_argument('--variants-per-library', default=40, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Time each loader, and the full `load-run`, on a synthetic run directory
+(see ncov_db.synthetic), reporting rows/sec and peak RSS.
+
+Each case runs in a fresh process against a new database, so that its peak
+RSS isn't inflated by the cases before it. With --baseline, the results are
+compared against an earlier --output file, and the script exits non-zero if
+any case's rows/sec dropped by more than --max-slowdown.
+
+usage (from the repository root): python -m benchmarks.bench_loaders [--libraries N] [--variants-per-library M] [--plates P]
+                                                                      [--output results.json] [--baseline results.json]
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from ncov_db import db
+from ncov_db import discovery
+from ncov_db import store_metadata_tsv
+from ncov_db import store_ncov_tools_amino_acid_mutation_table
+from ncov_db import store_ncov_tools_summary_qc
+from ncov_db import store_pangolin_results
+from ncov_db import store_sequencing_run
+from ncov_db import store_variants_tsv
+from ncov_db import synthetic
+
+from benchmarks.bench_sqlite_profiles import init_db
+
+
+RUN_ID = '210501_M01234_0001_000000000-A0001'
+
+
+def load_metadata(session, run_files, pangolin_path):
+    counts = store_metadata_tsv.store_metadata_records(session, store_metadata_tsv.parse_metadata_tsv(run_files['metadata_tsv'][0]))
+    return counts['parsed']
+
+
+def load_ivar_variants(session, run_files, pangolin_path):
+    filters = store_variants_tsv.args_to_filters(store_variants_tsv.Args(db=None, variants=None))
+    num_rows = 0
+    for path in run_files['ivar_variants_tsv']:
+        library_id, rows = store_variants_tsv.parse_variants_file(path, filters)
+        num_rows += store_variants_tsv.store_parsed_variants(session, library_id, rows)['parsed']
+    return num_rows
+
+
+def load_ncov_tools_summary_qc(session, run_files, pangolin_path):
+    num_rows = 0
+    for path in run_files['ncov_tools_summary_qc']:
+        num_rows += store_ncov_tools_summary_qc.store_qc_summaries(session, store_ncov_tools_summary_qc.parse_qc_summary_tsv(path))['parsed']
+    return num_rows
+
+
+def load_ncov_tools_aa_table(session, run_files, pangolin_path):
+    num_rows = 0
+    for path in run_files['ncov_tools_aa_table']:
+        amino_acid_mutations = store_ncov_tools_amino_acid_mutation_table.parse_amino_acid_mutation_tsv(path)
+        num_rows += store_ncov_tools_amino_acid_mutation_table.store_amino_acid_mutations(session, amino_acid_mutations)['parsed']
+    return num_rows
+
+
+def load_pangolin_results(session, run_files, pangolin_path):
+    return store_pangolin_results.store_pangolin_results(session, store_pangolin_results.parse_pangolin_results(pangolin_path))['parsed']
+
+
+LOADER_CASES = collections.OrderedDict([
+    ('metadata_tsv', load_metadata),
+    ('ivar_variants_tsv', load_ivar_variants),
+    ('ncov_tools_summary_qc', load_ncov_tools_summary_qc),
+    ('ncov_tools_aa_table', load_ncov_tools_aa_table),
+    ('pangolin_results', load_pangolin_results),
+])
+
+
+def count_data_rows(paths):
+    num_rows = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            num_rows += sum(1 for line in f) - 1
+    return num_rows
+
+
+def run_case(case, run_dir, pangolin_path, db_path):
+    """
+    Run one benchmark case in this process. Returns (rows, seconds, peak
+    RSS in bytes).
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        init_db(db_path)
+        run_files = discovery.discover_run_files(run_dir)
+        start = time.perf_counter()
+        if case == 'load_run':
+            args = argparse.Namespace(db=db_path, run_dir=run_dir)
+            store_sequencing_run.main(args)
+            num_rows = count_data_rows(path for paths in run_files.values() for path in paths)
+        else:
+            session = db.create_session(db_path)
+            num_rows = LOADER_CASES[case](session, run_files, pangolin_path)
+            session.commit()
+            db.close_session(session)
+        elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss = max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+    return num_rows, elapsed, peak_rss
+
+
+def compare_to_baseline(results, baseline, max_slowdown):
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        change = result['rows_per_sec'] / baseline[case]['rows_per_sec'] - 1
+        result['change_vs_baseline'] = round(change, 3)
+        if change < -max_slowdown:
+            regressions.append(case)
+    return regressions
+
+
+def main(args):
+    cases = list(LOADER_CASES) + ['load_run']
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run_dir = synthetic.generate_run(tmp_dir, RUN_ID, args.libraries, args.variants_per_library, args.plates)
+        pangolin_path = synthetic.generate_pangolin_results(os.path.join(tmp_dir, 'lineage_report.csv'), run_dir)
+
+        spawn = multiprocessing.get_context('spawn')
+        for case in cases:
+            db_path = os.path.join(tmp_dir, case + '.db')
+            with spawn.Pool(1) as pool:
+                num_rows, elapsed, peak_rss = pool.apply(run_case, (case, run_dir, pangolin_path, db_path))
+            results[case] = {
+                'rows': num_rows,
+                'seconds': round(elapsed, 4),
+                'rows_per_sec': round(num_rows / elapsed),
+                'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+            }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.max_slowdown)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if regressions:
+        print('rows/sec dropped by more than {:.0%} for: {}'.format(args.max_slowdown, ', '.join(regressions)), file=sys.stderr)
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--libraries', default=376, type=int)
+    parser.add_argument('--variants-per-library', default=40, type=int)
+    parser.add_argument('--plates', default=4, type=int)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--max-slowdown', default=0.2, type=float)
+    args = parser.parse_args()
+    main(args)
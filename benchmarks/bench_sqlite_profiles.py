@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Compare how fast iVar variants are written to a new database under each of
+the SQLite connection profiles in ncov_db.db.SQLITE_PROFILES.
+
+Every library is committed separately (as with `load-run --commit-every file`),
+which is where the journal mode and synchronous setting matter most.
+
+usage (from the repository root): python -m benchmarks.bench_sqlite_profiles [--libraries N] [--rows-per-library M]
+"""
+
+import argparse
+import collections
+import json
+import os
+import tempfile
+import time
+
+import alembic.config
+
+from ncov_db import db
+from ncov_db import store_variants_tsv
+
+from benchmarks.bench_tsv_decoder import FILTERS, write_variants_tsv
+
+
+def init_db(path):
+    alembic_args = [
+        '--raiseerr',
+        '-x',
+        'db=sqlite:///' + path,
+        'upgrade',
+        'head',
+    ]
+    alembic.config.main(argv=alembic_args)
+
+
+def time_profile(profile, db_path, library_rows):
+    start = time.perf_counter()
+    session = db.create_session(db_path, profile)
+    num_rows = 0
+    for library_id, rows in library_rows:
+        counts = store_variants_tsv.store_parsed_variants(session, library_id, rows)
+        session.commit()
+        num_rows += counts['inserted']
+    if profile == 'fast-load':
+        db.checkpoint(session)
+    db.close_session(session)
+    elapsed = time.perf_counter() - start
+
+    return num_rows, elapsed
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        variants_path = os.path.join(tmp_dir, 'variants.tsv')
+        write_variants_tsv(variants_path, args.rows_per_library)
+        template_rows = list(store_variants_tsv.parse_variants_tsv(variants_path, None, FILTERS))
+
+        library_rows = []
+        for n in range(args.libraries):
+            library_id = 'R%010d-1234-1-A01' % n
+            library_rows.append((library_id, [(library_id,) + row[1:] for row in template_rows]))
+
+        results = collections.OrderedDict()
+        for profile in db.SQLITE_PROFILES:
+            db_path = os.path.join(tmp_dir, profile + '.db')
+            init_db(db_path)
+            num_rows, elapsed = time_profile(profile, db_path, library_rows)
+            results[profile] = {
+                'rows': num_rows,
+                'commits': args.libraries,
+                'seconds': round(elapsed, 4),
+                'rows_per_sec': round(num_rows / elapsed),
+            }
+
+    for profile in results:
+        results[profile]['speedup_vs_safe'] = round(results[profile]['rows_per_sec'] / results['safe']['rows_per_sec'], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--libraries', default=200, type=int)
+    parser.add_argument('--rows-per-library', default=500, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Compare the rows/sec of the iVar variants parser against the previous
+csv.DictReader + OrderedDict + setattr(models.VariantIvar) implementation.
+
+usage (from the repository root): python -m benchmarks.bench_tsv_decoder [--rows N] [--repeats R]
+"""
+
+import argparse
+import collections
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+
+from ncov_db import models
+from ncov_db import store_variants_tsv
+
+
+HEADER = [
+    'REGION', 'POS', 'REF', 'ALT', 'REF_DP', 'REF_RV', 'REF_QUAL', 'ALT_DP', 'ALT_RV', 'ALT_QUAL', 'ALT_FREQ',
+    'TOTAL_DP', 'PVAL', 'PASS', 'GFF_FEATURE', 'REF_CODON', 'REF_AA', 'ALT_CODON', 'ALT_AA', 'CODON_POS', 'MUT_NAME',
+]
+
+FILTERS = {
+    'min_freq_threshold': 0.25,
+    'freq_threshold': 0.75,
+    'min_depth': 10,
+}
+
+
+def write_variants_tsv(path, num_rows):
+    rng = random.Random(0)
+    with open(path, 'w') as f:
+        f.write('\t'.join(HEADER) + '\n')
+        for n in range(num_rows):
+            ref, alt = rng.sample('ACGT', 2)
+            pos = rng.randint(1, 29903)
+            row = [
+                'MN908947.3', str(pos), ref, alt, '10', '5', '35', '200', '100', '36',
+                '%.3f' % rng.choice([0.1, 0.5, 0.9]), '211', '0.0001', rng.choice(['TRUE', 'FALSE']),
+                'cds-YP_009724390.1', 'GAA', 'E', 'AAA', 'K', str(pos // 3), 'S:E%dK' % (pos // 3),
+            ]
+            f.write('\t'.join(row) + '\n')
+
+
+def legacy_parse_variants_tsv(variants_tsv_path, library_id, filters):
+    """The parser as it was before ncov_db.tsv.RowDecoder, kept for comparison."""
+    field_name_conversion = dict(zip(HEADER, [name for name, column, converter in store_variants_tsv.VARIANT_FIELDS]))
+    int_fields = [
+        'nucleotide_position', 'ref_allele_depth', 'ref_allele_depth_reverse_reads', 'ref_allele_mean_quality',
+        'alt_allele_depth', 'alt_allele_depth_reverse_reads', 'alt_allele_mean_quality', 'total_depth', 'codon_position',
+    ]
+    float_fields = ['alt_allele_frequency', 'p_value_fishers_exact']
+    bool_fields = ['p_value_pass']
+    na_null_fields = [
+        'gene_name', 'ref_codon', 'ref_amino_acid', 'alt_codon', 'alt_amino_acid', 'codon_position',
+        'mutation_name_by_amino_acid',
+    ]
+    variants = []
+    with open(variants_tsv_path, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        for row in reader:
+            variant = collections.OrderedDict()
+            variant['library_id'] = library_id
+            variant['variant_calling_tool'] = 'ivar'
+            variant['variant_calling_tool_version'] = '1.3'
+            for k, v in field_name_conversion.items():
+                variant[v] = row.get(k)
+            for f in na_null_fields:
+                if variant[f] == 'NA':
+                    variant[f] = None
+            for f in int_fields:
+                if variant[f] is not None:
+                    variant[f] = int(variant[f])
+            for f in float_fields:
+                if variant[f] is not None:
+                    variant[f] = float(variant[f])
+            for f in bool_fields:
+                if variant[f] is not None:
+                    variant[f] = bool(variant[f])
+            if len(variant['ref_allele']) == 1 and len(variant['alt_allele']) == 1:
+                variant['variant_type'] = 'snp'
+                if variant['alt_allele_frequency'] < filters['min_freq_threshold']:
+                    variant['consensus_allele'] = variant['ref_allele']
+                elif variant['alt_allele_frequency'] < filters['freq_threshold']:
+                    variant['consensus_allele'] = store_variants_tsv.IUPAC_AMBIGUITY[(variant['ref_allele'], variant['alt_allele'])]
+                else:
+                    variant['consensus_allele'] = variant['alt_allele']
+                variant['is_ambiguous'] = variant['consensus_allele'] in store_variants_tsv.AMBIGUOUS_ALLELES
+            variant_obj = models.VariantIvar()
+            for key in variant.keys():
+                setattr(variant_obj, key, variant[key])
+            variants.append(variant_obj)
+
+    return variants
+
+
+def current_parse_variants_tsv(variants_tsv_path, library_id, filters):
+    return list(store_variants_tsv.parse_variants_tsv(variants_tsv_path, library_id, filters))
+
+
+def time_parser(parse, path, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = parse(path, 'R0000000000-1234-1-A01', FILTERS)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return len(rows), best
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'R0000000000-1234-1-A01.variants.tsv')
+        write_variants_tsv(path, args.rows)
+
+        results = collections.OrderedDict()
+        for name, parse in [('legacy', legacy_parse_variants_tsv), ('row_decoder', current_parse_variants_tsv)]:
+            num_rows, elapsed = time_parser(parse, path, args.repeats)
+            results[name] = {
+                'rows': num_rows,
+                'seconds': round(elapsed, 4),
+                'rows_per_sec': round(num_rows / elapsed),
+            }
+
+    results['speedup'] = round(results['row_decoder']['rows_per_sec'] / results['legacy']['rows_per_sec'], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', default=100000, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,257 @@
+import collections
+import csv
+import io
+import json
+import os
+import time
+
+import sqlalchemy as sa
+
+from . import bulk
+from . import models
+from .time import now
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Length of the SARS-CoV-2 reference (MN908947.3). Column `j` of the matrix
+# is nucleotide position `j + 1`.
+GENOME_LENGTH = 29903
+
+# Positions with no SNP called for a library are stored as REFERENCE. There
+# is no per-position coverage in the database, so uncovered positions can't
+# be told apart from reference calls; use the genome_completeness in the
+# library index to filter or weight libraries instead.
+REFERENCE = 0
+ALLELE_CODES = {
+    'A': 1,
+    'C': 2,
+    'G': 3,
+    'T': 4,
+    'N': 5,
+    'R': 6,
+    'Y': 7,
+    'S': 8,
+    'W': 9,
+    'K': 10,
+    'M': 11,
+    'B': 12,
+    'D': 13,
+    'H': 14,
+    'V': 15,
+}
+
+LIBRARY_INDEX_COLUMNS = ['row', 'library_id', 'sequencing_run_id', 'genome_completeness']
+
+variant_ivar = models.VariantIvar.__table__
+ncov_tools_summary_qc = models.NcovToolsSummaryQC.__table__
+
+
+def library_index_path(matrix_path):
+    return os.path.splitext(matrix_path)[0] + '.libraries.tsv'
+
+
+def read_library_index(matrix_path):
+    index_path = library_index_path(matrix_path)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, 'r', newline='') as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+
+def open_allele_matrix(matrix_path):
+    """
+    Return (matrix, library_index): the matrix as a read-only memory-mapped
+    array of shape (libraries, GENOME_LENGTH), and a list of dicts with the
+    library_id, sequencing_run_id and genome_completeness of each row.
+    """
+    if numpy is None:
+        raise ImportError('Reading the allele matrix requires numpy. Install it with: pip install numpy')
+    library_index = read_library_index(matrix_path)
+    with open(matrix_path, 'rb') as f:
+        header_length = read_npy_header_length(f)
+    # Map only the rows in the index, in case an interrupted export left
+    # the .npy header or data ahead of it.
+    matrix = numpy.memmap(matrix_path, dtype=numpy.uint8, mode='r', offset=header_length, shape=(len(library_index), GENOME_LENGTH))
+    return matrix, library_index
+
+
+def npy_header(num_rows):
+    header = io.BytesIO()
+    numpy.lib.format.write_array_header_1_0(header, {
+        'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(numpy.uint8)),
+        'fortran_order': False,
+        'shape': (num_rows, GENOME_LENGTH),
+    })
+    return header.getvalue()
+
+
+def read_npy_header_length(f):
+    f.seek(0)
+    numpy.lib.format.read_magic(f)
+    numpy.lib.format.read_array_header_1_0(f)
+    return f.tell()
+
+
+def open_for_append(matrix_path, existing_rows, total_rows):
+    """
+    Open the .npy file at `matrix_path`, positioned after its first
+    `existing_rows` rows, with room for a header for `total_rows` rows.
+    Rows are stored contiguously after the header, so appending rows only
+    means rewriting the header in place (see write_npy_header()) once they
+    have been written. The file is only copied in the rare case that the new
+    header doesn't fit in the old one's space.
+    """
+    header = npy_header(total_rows)
+    if not os.path.exists(matrix_path):
+        f = open(matrix_path, 'wb')
+        f.write(header)
+        return f
+
+    f = open(matrix_path, 'r+b')
+    header_length = read_npy_header_length(f)
+    if header_length == len(header):
+        f.seek(header_length + existing_rows * GENOME_LENGTH)
+        f.truncate()
+        return f
+
+    tmp_path = matrix_path + '.tmp'
+    with open(tmp_path, 'wb') as tmp:
+        tmp.write(header)
+        f.seek(header_length)
+        remaining = existing_rows * GENOME_LENGTH
+        while remaining > 0:
+            chunk = f.read(min(remaining, 64 * 1024 * 1024))
+            tmp.write(chunk)
+            remaining -= len(chunk)
+    f.close()
+    os.replace(tmp_path, matrix_path)
+    f = open(matrix_path, 'r+b')
+    f.seek(0, os.SEEK_END)
+    return f
+
+
+def write_npy_header(f, total_rows):
+    f.seek(0)
+    f.write(npy_header(total_rows))
+
+
+def libraries_to_add(session, exported_library_ids, min_completeness=None):
+    """
+    Libraries with ncov-tools summary QC that aren't in the matrix yet, in
+    (sequencing run, library) order. A library sequenced on more than one
+    run is added once, for the first of its runs.
+    """
+    query = (
+        sa.select(
+            ncov_tools_summary_qc.c.library_id,
+            sa.func.min(ncov_tools_summary_qc.c.sequencing_run_id).label('sequencing_run_id'),
+            sa.func.max(ncov_tools_summary_qc.c.genome_completeness).label('genome_completeness'),
+        )
+        .group_by(ncov_tools_summary_qc.c.library_id)
+    )
+    libraries = []
+    for library in session.execute(query).mappings():
+        if library['library_id'] in exported_library_ids:
+            continue
+        if min_completeness is not None and (library['genome_completeness'] is None or library['genome_completeness'] < min_completeness):
+            continue
+        libraries.append(dict(library))
+    libraries.sort(key=lambda library: (library['sequencing_run_id'], library['library_id']))
+
+    return libraries
+
+
+def allele_code_lookup():
+    lookup = numpy.full(256, ALLELE_CODES['N'], dtype=numpy.uint8)
+    for allele, code in ALLELE_CODES.items():
+        lookup[ord(allele)] = code
+        lookup[ord(allele.lower())] = code
+    return lookup
+
+
+def build_rows(session, library_ids, lookup):
+    """
+    Return a (len(library_ids), GENOME_LENGTH) uint8 array of consensus
+    allele codes for `library_ids`, from their SNPs in variant_ivar. Where a
+    library has more than one SNP at a position, the consensus allele of the
+    one with the highest alt_allele_frequency is used.
+    """
+    rows = numpy.zeros((len(library_ids), GENOME_LENGTH), dtype=numpy.uint8)
+    row_by_library_id = {library_id: n for n, library_id in enumerate(library_ids)}
+    query = (
+        sa.select(variant_ivar.c.library_id, variant_ivar.c.nucleotide_position, variant_ivar.c.consensus_allele)
+        .where(variant_ivar.c.library_id.in_(library_ids))
+        .where(variant_ivar.c.variant_type == 'snp')
+        .where(variant_ivar.c.consensus_allele.isnot(None))
+        .where(variant_ivar.c.nucleotide_position.between(1, GENOME_LENGTH))
+        .order_by(variant_ivar.c.alt_allele_frequency.desc())
+    )
+    variants = session.execute(query).all()
+    if not variants:
+        return rows
+
+    library_column, position_column, allele_column = zip(*variants)
+    row_numbers = numpy.fromiter((row_by_library_id[library_id] for library_id in library_column), dtype=numpy.intp, count=len(variants))
+    positions = numpy.fromiter(position_column, dtype=numpy.intp, count=len(variants)) - 1
+    alleles = numpy.frombuffer(''.join(allele[0] for allele in allele_column).encode('ascii'), dtype=numpy.uint8)
+
+    # numpy.unique returns the first occurrence of each cell, ie. the
+    # highest-frequency SNP.
+    cells, first = numpy.unique(row_numbers * GENOME_LENGTH + positions, return_index=True)
+    rows.reshape(-1)[cells] = lookup[alleles[first]]
+
+    return rows
+
+
+def export_allele_matrix(session, matrix_path, min_completeness=None, batch_size=256):
+    """
+    Append a row to the allele matrix at `matrix_path` (a .npy file) for
+    every library that isn't in it yet, and record the new rows in the
+    sidecar library index (<matrix>.libraries.tsv). Libraries are built
+    `batch_size` at a time, so memory use is bounded by
+    batch_size * GENOME_LENGTH bytes.
+    Returns the number of rows added.
+    """
+    if numpy is None:
+        raise ImportError('The allele matrix export requires numpy. Install it with: pip install numpy')
+
+    start = time.perf_counter()
+    library_index = read_library_index(matrix_path)
+    existing_rows = len(library_index)
+    exported_library_ids = {library['library_id'] for library in library_index}
+    new_libraries = libraries_to_add(session, exported_library_ids, min_completeness)
+
+    if new_libraries:
+        lookup = allele_code_lookup()
+        total_rows = existing_rows + len(new_libraries)
+        with open_for_append(matrix_path, existing_rows, total_rows) as f:
+            for library_batch in bulk.batched(new_libraries, batch_size):
+                rows = build_rows(session, [library['library_id'] for library in library_batch], lookup)
+                f.write(rows.tobytes())
+            write_npy_header(f, total_rows)
+
+        # The index is written last: if the export is interrupted, rows past
+        # the end of the index are ignored and overwritten next time.
+        index_path = library_index_path(matrix_path)
+        write_header = not os.path.exists(index_path)
+        with open(index_path, 'a', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            if write_header:
+                writer.writerow(LIBRARY_INDEX_COLUMNS)
+            for n, library in enumerate(new_libraries):
+                writer.writerow([existing_rows + n, library['library_id'], library['sequencing_run_id'], library['genome_completeness']])
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'allele_matrix_exported'
+    log_msg['path'] = os.path.abspath(matrix_path)
+    log_msg['rows_added'] = len(new_libraries)
+    log_msg['total_rows'] = existing_rows + len(new_libraries)
+    log_msg['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(log_msg))
+
+    return len(new_libraries)
@@ -0,0 +1,40 @@
+def insert_ignore_duplicates(session, table, columns, rows):
+    """
+    Insert all rows (tuples of values for `columns`) with a single executemany
+    INSERT ... ON CONFLICT DO NOTHING, letting the primary key skip rows that
+    are already present.
+    Returns a dict of inserted and skipped row counts.
+    """
+    counts = {
+        'inserted': 0,
+        'skipped': 0,
+    }
+    if not rows:
+        return counts
+
+    sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT DO NOTHING'.format(
+        table.name,
+        ', '.join(columns),
+        ', '.join(['?'] * len(columns)),
+    )
+    result = session.connection().exec_driver_sql(sql, rows)
+
+    counts['inserted'] = result.rowcount
+    counts['skipped'] = len(rows) - result.rowcount
+
+    return counts
+
+
+def batched(iterable, batch_size):
+    """
+    Yield lists of up to batch_size items from iterable, without reading
+    more than one batch ahead.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
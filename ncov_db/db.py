@@ -0,0 +1,131 @@
+import sqlalchemy as sa
+import sqlalchemy.orm as sao
+
+
+# PRAGMAs applied to every new connection, by profile name.
+# 'safe' keeps SQLite's own defaults (rollback journal, synchronous=FULL).
+# 'default' only sets per-connection caching options: journal_mode is stored
+# in the database file, and WAL doesn't work on network filesystems, so an
+# existing database keeps whatever journal mode it already has.
+# 'fast-load' switches the database to WAL, and trades durability against power loss / OS crashes for bulk
+# load speed; the WAL is checkpointed once at the end of the load instead
+# of automatically as it grows (see checkpoint()).
+SQLITE_PROFILES = {
+    'safe': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+    },
+    'default': {
+        'cache_size': -64 * 1024,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    'fast-load': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -256 * 1024,
+        'mmap_size': 1024 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 0,
+    },
+}
+
+
+def parse_pragmas(pragma_args):
+    """
+    Parse a list of 'name=value' strings (from --pragma) into a dict.
+    """
+    pragmas = {}
+    for pragma_arg in pragma_args or []:
+        name, sep, value = pragma_arg.partition('=')
+        if not sep or not name.strip():
+            raise ValueError('Expected NAME=VALUE, got: ' + pragma_arg)
+        pragmas[name.strip()] = value.strip()
+
+    return pragmas
+
+
+def args_to_sqlite_options(args):
+    """
+    Read the --fast-load and --pragma options (if present) from parsed args,
+    and return the (profile, pragmas) to open the database with.
+    """
+    profile = 'default'
+    if getattr(args, 'fast_load', False):
+        profile = 'fast-load'
+    pragmas = parse_pragmas(getattr(args, 'pragma', None))
+
+    return profile, pragmas
+
+
+def get_pragmas(profile='default', pragmas=None):
+    profile_pragmas = dict(SQLITE_PROFILES[profile])
+    profile_pragmas.update(pragmas or {})
+    return profile_pragmas
+
+
+def create_engine(db, profile='default', pragmas=None):
+    connection_string = "sqlite+pysqlite:///" + db
+    engine = sa.create_engine(connection_string)
+
+    connection_pragmas = get_pragmas(profile, pragmas)
+
+    def set_pragmas(dbapi_connection, connection_record):
+        # Stop pysqlite from managing transactions itself; BEGIN is emitted
+        # by begin_transaction() instead. Otherwise a SAVEPOINT issued before
+        # pysqlite's own BEGIN becomes the outer transaction, and releasing
+        # it commits.
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in connection_pragmas.items():
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+    def begin_transaction(connection):
+        connection.exec_driver_sql('BEGIN')
+
+    def count_commit(connection):
+        connection.info['commit_count'] = connection.info.get('commit_count', 0) + 1
+
+    sa.event.listen(engine, 'connect', set_pragmas)
+    sa.event.listen(engine, 'begin', begin_transaction)
+    sa.event.listen(engine, 'commit', count_commit)
+
+    return engine
+
+
+def create_session(db, profile='default', pragmas=None):
+    """
+    Open a single connection to the database and return a session bound to it.
+    The same connection is used for every transaction in the session, so a
+    loader (or a whole load-run) only connects once.
+    """
+    engine = create_engine(db, profile, pragmas)
+    connection = engine.connect()
+    Session = sao.sessionmaker()
+    Session.configure(bind=connection)
+    session = Session()
+    return session
+
+
+def commit_count(session):
+    """
+    Return the number of transactions committed on the connection of a
+    session from create_session(). Savepoints aren't counted.
+    """
+    return getattr(session.bind, 'info', {}).get('commit_count', 0)
+
+
+def checkpoint(session):
+    """
+    Copy everything in the write-ahead log back into the database file and
+    truncate the log. Does nothing if the database isn't in WAL mode.
+    """
+    session.connection().exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def close_session(session):
+    connection = session.bind
+    session.close()
+    connection.close()
+    connection.engine.dispose()
@@ -0,0 +1,89 @@
+import sqlalchemy as sa
+
+from . import bulk
+from . import models
+
+
+class Dictionary(object):
+    """
+    The integer IDs of the values in a dictionary table (eg.
+    gene_name_dictionary). A value is a single string for a one-column
+    dictionary, or a tuple of strings.
+
+    The whole table is read on first use. After that, ids() only touches the
+    database to add values that are missing, and to read back the IDs they
+    were given.
+    """
+    def __init__(self, session, table, columns):
+        self.session = session
+        self.table = table
+        self.columns = columns
+        self.value_ids = None
+        self.max_id = 0
+
+    def read(self, min_id=0):
+        query = (
+            sa.select(self.table.c.id, *[self.table.c[column] for column in self.columns])
+            .where(self.table.c.id > min_id)
+        )
+        for row in self.session.execute(query):
+            value = row[1] if len(self.columns) == 1 else tuple(row[1:])
+            self.value_ids[value] = row[0]
+            self.max_id = max(self.max_id, row[0])
+
+    def ids(self, values):
+        """
+        Return the dict of value -> ID, after adding any of `values` that
+        aren't in the dictionary yet. None isn't a value of a one-column
+        dictionary, and is left out.
+        """
+        if self.value_ids is None:
+            self.value_ids = {}
+            self.read()
+
+        new_values = set(values).difference(self.value_ids)
+        if len(self.columns) == 1:
+            new_values.discard(None)
+            rows = [(value,) for value in sorted(new_values)]
+        else:
+            rows = sorted(new_values, key=lambda value: tuple('' if v is None else v for v in value))
+        if rows:
+            bulk.insert_ignore_duplicates(self.session, self.table, self.columns, rows)
+            self.read(self.max_id)
+
+        return self.value_ids
+
+
+class DictionaryCache(object):
+    """
+    The dictionaries that variant_ivar_encoded and pangolin_result_encoded
+    refer to.
+    """
+    def __init__(self, session):
+        self.libraries = Dictionary(session, models.LibraryDictionary.__table__, ['library_id'])
+        self.variant_calling_tools = Dictionary(session, models.VariantCallingToolDictionary.__table__, ['variant_calling_tool', 'variant_calling_tool_version'])
+        self.ref_accessions = Dictionary(session, models.RefAccessionDictionary.__table__, ['ref_accession'])
+        self.gene_names = Dictionary(session, models.GeneNameDictionary.__table__, ['gene_name'])
+        self.pangolin_versions = Dictionary(session, models.PangolinVersionDictionary.__table__, ['version', 'pangolin_version', 'pangolearn_version', 'pango_version'])
+
+
+def get_dictionary_cache(session):
+    """
+    Return the DictionaryCache for this session, creating it on first use.
+    Like the entity cache, it is dropped if the session's transaction (but
+    not just a savepoint) is rolled back.
+    """
+    dictionary_cache = session.info.get('dictionary_cache')
+    if dictionary_cache is None:
+        dictionary_cache = DictionaryCache(session)
+        session.info['dictionary_cache'] = dictionary_cache
+        if not sa.event.contains(session, 'after_soft_rollback', _drop_dictionary_cache):
+            sa.event.listen(session, 'after_soft_rollback', _drop_dictionary_cache)
+
+    return dictionary_cache
+
+
+def _drop_dictionary_cache(session, previous_transaction):
+    if previous_transaction.nested:
+        return
+    session.info.pop('dictionary_cache', None)
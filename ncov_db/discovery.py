@@ -0,0 +1,147 @@
+import collections
+import fnmatch
+import json
+import os
+import re
+import time
+
+from .time import now
+
+
+# Layout of a run's analysis directory:
+#
+#   <run_dir>/
+#     ncov2019-artic-nf-v<version>-output/
+#       ncovIllumina_sequenceAnalysis_addCodonPositionToVariants/*.tsv
+#       ncov-tools-v<version>-output/
+#         metadata.tsv
+#         qc_reports/*_summary_qc.tsv
+#         by_plate/<plate>/qc_annotation/*_aa_table.tsv
+#
+# Discovery only descends into these directories, so the (much larger)
+# alignment, consensus and plot output beside them is never listed. If a run
+# has been analyzed with more than one pipeline version, only the output of
+# the highest version is loaded.
+ARTIC_OUTPUT_DIR_PATTERN = 'ncov2019-artic-nf-v*-output'
+NCOV_TOOLS_OUTPUT_DIR_PATTERN = 'ncov-tools-v*-output'
+IVAR_VARIANTS_DIR = 'ncovIllumina_sequenceAnalysis_addCodonPositionToVariants'
+QC_REPORTS_DIR = 'qc_reports'
+BY_PLATE_DIR = 'by_plate'
+QC_ANNOTATION_DIR = 'qc_annotation'
+
+OUTPUT_DIR_VERSION_PATTERN = re.compile('-v(.+)-output$')
+
+FILE_TYPES = ['metadata_tsv', 'ivar_variants_tsv', 'ncov_tools_summary_qc', 'ncov_tools_aa_table']
+
+
+class Scanner(object):
+    """
+    Lists directories with os.scandir, counting the entries it examines.
+    Directories that don't exist are treated as empty.
+    """
+    def __init__(self):
+        self.entries_examined = 0
+
+    def scan(self, path):
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        self.entries_examined += len(entries)
+        return entries
+
+    def dirs(self, path, pattern='*'):
+        return sorted(entry.path for entry in self.scan(path) if fnmatch.fnmatchcase(entry.name, pattern) and entry.is_dir())
+
+    def files(self, path, pattern='*'):
+        return sorted(entry.path for entry in self.scan(path) if fnmatch.fnmatchcase(entry.name, pattern) and entry.is_file())
+
+
+def output_dir_version(path):
+    """
+    Return the pipeline version in the name of an output directory
+    (eg. '1.3' for ncov2019-artic-nf-v1.3-output), or None.
+    """
+    match = OUTPUT_DIR_VERSION_PATTERN.search(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def version_key(version):
+    # Compare numeric parts as numbers, so that 1.10 sorts after 1.9.
+    return [(int(part), '') if part.isdigit() else (-1, part) for part in re.split('[.-]', version)]
+
+
+def latest_output_dir(output_dirs):
+    """
+    Return the output directory with the highest version, or None.
+    """
+    if not output_dirs:
+        return None
+    return max(output_dirs, key=lambda path: version_key(output_dir_version(path)))
+
+
+def is_run_dir(path):
+    """
+    A run's analysis directory has an ncov2019-artic-nf output directory in it.
+    """
+    return bool(Scanner().dirs(path, ARTIC_OUTPUT_DIR_PATTERN))
+
+
+def find_run_dirs(parent_dir):
+    """
+    Return the run directories directly under `parent_dir` (eg. an
+    analysis_by_run directory), sorted by name so that runs are loaded in
+    date order.
+    """
+    run_dirs = [path for path in Scanner().dirs(parent_dir) if is_run_dir(path)]
+
+    return sorted(run_dirs, key=os.path.basename)
+
+
+def find_run_files(run_dir, scanner):
+    """
+    Return (files, artic_output_dir, ncov_tools_output_dir), where files is
+    a dict of file type -> sorted list of paths of the files to load from
+    `run_dir`, for each of FILE_TYPES, from the output of the highest
+    ncov2019-artic-nf version (and the highest ncov-tools version in it).
+    """
+    files = collections.OrderedDict((file_type, []) for file_type in FILE_TYPES)
+
+    artic_output_dir = latest_output_dir(scanner.dirs(run_dir, ARTIC_OUTPUT_DIR_PATTERN))
+    ncov_tools_output_dir = None
+    if artic_output_dir is not None:
+        files['ivar_variants_tsv'] += scanner.files(os.path.join(artic_output_dir, IVAR_VARIANTS_DIR), '*.tsv')
+        ncov_tools_output_dir = latest_output_dir(scanner.dirs(artic_output_dir, NCOV_TOOLS_OUTPUT_DIR_PATTERN))
+    if ncov_tools_output_dir is not None:
+        files['metadata_tsv'] += scanner.files(ncov_tools_output_dir, 'metadata.tsv')
+        files['ncov_tools_summary_qc'] += scanner.files(os.path.join(ncov_tools_output_dir, QC_REPORTS_DIR), '*_summary_qc.tsv')
+        for plate_dir in scanner.dirs(os.path.join(ncov_tools_output_dir, BY_PLATE_DIR)):
+            files['ncov_tools_aa_table'] += scanner.files(os.path.join(plate_dir, QC_ANNOTATION_DIR), '*_aa_table.tsv')
+
+    return files, artic_output_dir, ncov_tools_output_dir
+
+
+def discover_run_files(run_dir):
+    """
+    Return the dict of file type -> paths from find_run_files(). Logs a
+    run_files_discovered event with the versions chosen, the number of
+    directory entries examined and the time taken.
+    """
+    start = time.perf_counter()
+    scanner = Scanner()
+    files, artic_output_dir, ncov_tools_output_dir = find_run_files(run_dir, scanner)
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'run_files_discovered'
+    log_msg['run_dir'] = os.path.abspath(run_dir)
+    log_msg['artic_version'] = output_dir_version(artic_output_dir) if artic_output_dir else None
+    log_msg['ncov_tools_version'] = output_dir_version(ncov_tools_output_dir) if ncov_tools_output_dir else None
+    for file_type, paths in files.items():
+        log_msg[file_type] = len(paths)
+    log_msg['entries_examined'] = scanner.entries_examined
+    log_msg['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(log_msg))
+
+    return files
@@ -0,0 +1,184 @@
+from datetime import date
+
+import sqlalchemy as sa
+
+from . import bulk
+from . import models
+
+
+CONTAINER_COLUMNS = ['id']
+
+LIBRARY_COLUMNS = [
+    'id',
+    'container_id',
+    'library_plate_id',
+    'index_set_id',
+    'plate_well',
+    'plate_row',
+    'plate_col',
+]
+
+SEQUENCING_RUN_COLUMNS = [
+    'id',
+    'run_date',
+    'platform',
+    'instrument_id',
+]
+
+
+def is_control(library_id):
+    return library_id.startswith('POS') or library_id.startswith('NEG')
+
+
+def library_id_to_container_id(library_id):
+    container_id = None
+    if not is_control(library_id):
+        container_id = library_id.split('-')[0]
+    return container_id
+
+
+def library_id_to_library(library_id):
+    library = {}
+    library_id_components = library_id.split('-')
+
+    library['id'] = library_id
+    if library_id.startswith('POS'):
+        library['container_id'] = None
+        library['library_plate_id'] = library_id_components[2]
+        library['index_set_id'] = library_id_components[3]
+        library['plate_well'] = 'G12'
+    elif library_id.startswith('NEG'):
+        library['container_id'] = None
+        library['library_plate_id'] = library_id_components[2]
+        library['index_set_id'] = library_id_components[3]
+        library['plate_well'] = 'H12'
+    else:
+        library['container_id'] = library_id_components[0]
+        library['library_plate_id'] = library_id_components[1]
+        library['index_set_id'] = library_id_components[2]
+        library['plate_well'] = library_id_components[3]
+    library['plate_row'] = library['plate_well'][0]
+    library['plate_col'] = int(library['plate_well'][-2:])
+
+    return library
+
+
+def sequencing_run_id_to_run_date(sequencing_run_id):
+    run_id_date_string = sequencing_run_id.split('_')[0]
+    year = '20' + run_id_date_string[0:2]
+    month = run_id_date_string[2:4]
+    day = run_id_date_string[4:6]
+    iso8601_date_string = year + '-' + month + '-' + day
+    run_date = date.fromisoformat(iso8601_date_string)
+    return run_date
+
+
+def sequencing_run_id_to_sequencing_run(sequencing_run_id):
+    sequencing_run = {}
+    sequencing_run['id'] = sequencing_run_id
+    sequencing_run['run_date'] = sequencing_run_id_to_run_date(sequencing_run_id)
+    sequencing_run['instrument_id'] = sequencing_run_id.split('_')[1]
+    sequencing_run['platform'] = None
+    if sequencing_run['instrument_id'].startswith('M'):
+        sequencing_run['platform'] = 'MISEQ'
+    elif sequencing_run['instrument_id'].startswith('V'):
+        sequencing_run['platform'] = 'NEXTSEQ'
+    return sequencing_run
+
+
+class EntityCache(object):
+    """
+    In-memory sets of the container, library and sequencing run IDs that
+    exist in the database.
+
+    All known IDs are read with one query when the cache is created. After
+    that, `ensure_libraries` and `ensure_sequencing_runs` only touch the
+    database to bulk-insert parents that are missing, so no ID is looked up
+    more than once per load.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.containers = set()
+        self.libraries = set()
+        self.sequencing_runs = set()
+        self.preload()
+
+    def preload(self):
+        known_ids = sa.union_all(
+            sa.select(sa.literal('container'), models.Container.__table__.c.id),
+            sa.select(sa.literal('library'), models.Library.__table__.c.id),
+            sa.select(sa.literal('sequencing_run'), models.SequencingRun.__table__.c.id),
+        )
+        id_sets = {
+            'container': self.containers,
+            'library': self.libraries,
+            'sequencing_run': self.sequencing_runs,
+        }
+        for entity_type, entity_id in self.session.execute(known_ids):
+            id_sets[entity_type].add(entity_id)
+
+    def ensure_containers(self, container_ids):
+        new_container_ids = set(container_ids) - self.containers
+        new_container_ids.discard(None)
+        rows = [(container_id,) for container_id in sorted(new_container_ids)]
+        bulk.insert_ignore_duplicates(self.session, models.Container.__table__, CONTAINER_COLUMNS, rows)
+        self.containers.update(new_container_ids)
+
+    def ensure_libraries(self, library_ids):
+        """
+        Insert any of `library_ids` (and their containers) that aren't
+        already in the database.
+        """
+        new_library_ids = set(library_ids) - self.libraries
+        if not new_library_ids:
+            return None
+
+        new_libraries = [library_id_to_library(library_id) for library_id in sorted(new_library_ids)]
+        self.ensure_containers(library['container_id'] for library in new_libraries)
+
+        rows = [tuple(library[column] for column in LIBRARY_COLUMNS) for library in new_libraries]
+        bulk.insert_ignore_duplicates(self.session, models.Library.__table__, LIBRARY_COLUMNS, rows)
+        self.libraries.update(new_library_ids)
+
+        return None
+
+    def ensure_sequencing_runs(self, sequencing_run_ids):
+        new_sequencing_run_ids = set(sequencing_run_ids) - self.sequencing_runs
+        if not new_sequencing_run_ids:
+            return None
+
+        rows = []
+        for sequencing_run_id in sorted(new_sequencing_run_ids):
+            sequencing_run = sequencing_run_id_to_sequencing_run(sequencing_run_id)
+            sequencing_run['run_date'] = sequencing_run['run_date'].isoformat()
+            rows.append(tuple(sequencing_run[column] for column in SEQUENCING_RUN_COLUMNS))
+        bulk.insert_ignore_duplicates(self.session, models.SequencingRun.__table__, SEQUENCING_RUN_COLUMNS, rows)
+        self.sequencing_runs.update(new_sequencing_run_ids)
+
+        return None
+
+
+def get_entity_cache(session):
+    """
+    Return the EntityCache for this session, creating it on first use.
+    The cache lives as long as the session (ie. for a whole load-run), and is
+    dropped if the session's transaction is rolled back, since the rows it
+    remembers inserting may no longer exist. Rolling back a savepoint
+    doesn't drop it.
+    """
+    entity_cache = session.info.get('entity_cache')
+    if entity_cache is None:
+        entity_cache = EntityCache(session)
+        session.info['entity_cache'] = entity_cache
+        if not sa.event.contains(session, 'after_soft_rollback', _drop_entity_cache):
+            sa.event.listen(session, 'after_soft_rollback', _drop_entity_cache)
+
+    return entity_cache
+
+
+def _drop_entity_cache(session, previous_transaction):
+    # Rolling back a savepoint (eg. a rejected row) leaves the rest of the
+    # transaction, and so the cache, intact.
+    if previous_transaction.nested:
+        return
+    session.info.pop('entity_cache', None)
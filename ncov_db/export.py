@@ -0,0 +1,312 @@
+import collections
+import json
+import os
+import shutil
+import time
+import urllib.parse
+
+import sqlalchemy as sa
+
+from . import models
+from .time import now
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+container = models.Container.__table__
+library = models.Library.__table__
+ncov_tools_summary_qc = models.NcovToolsSummaryQC.__table__
+
+EXPORT_TABLES = {
+    'variant_ivar': models.VariantIvar.__table__,
+    'pangolin_result': models.PangolinResult.__table__,
+    'ncov_tools_summary_qc': ncov_tools_summary_qc,
+}
+
+PARTITION_BY = ['sequencing_run_id', 'collection_month']
+
+FILE_EXTENSIONS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+STATE_FILENAME = '_export_state.json'
+
+# Partition value used for rows whose library has no collection date.
+UNKNOWN_PARTITION = 'unknown'
+
+
+def arrow_type(column):
+    if isinstance(column.type, sa.Boolean):
+        return pyarrow.bool_()
+    elif isinstance(column.type, sa.Integer):
+        return pyarrow.int64()
+    elif isinstance(column.type, sa.Float):
+        return pyarrow.float64()
+    elif isinstance(column.type, sa.Date):
+        return pyarrow.date32()
+    else:
+        return pyarrow.string()
+
+
+def arrow_schema(table):
+    return pyarrow.schema([(column.name, arrow_type(column)) for column in table.columns])
+
+
+def export_source(table_name, partition_by):
+    """
+    Return (from clause, partition expression) for exporting `table_name`.
+    variant_ivar has no sequencing_run_id of its own, so its rows are linked
+    to runs through ncov_tools_summary_qc; variants of libraries without
+    summary QC aren't exported.
+    """
+    table = EXPORT_TABLES[table_name]
+    if table_name == 'variant_ivar':
+        from_clause = table.join(ncov_tools_summary_qc, ncov_tools_summary_qc.c.library_id == table.c.library_id)
+        sequencing_run_id = ncov_tools_summary_qc.c.sequencing_run_id
+    else:
+        from_clause = table
+        sequencing_run_id = table.c.sequencing_run_id
+
+    if partition_by == 'sequencing_run_id':
+        partition = sequencing_run_id
+    else:
+        from_clause = (
+            from_clause
+            .join(library, library.c.id == table.c.library_id)
+            .outerjoin(container, container.c.id == library.c.container_id)
+        )
+        partition = sa.func.coalesce(sa.func.strftime('%Y-%m', container.c.collection_date), UNKNOWN_PARTITION)
+
+    return from_clause, partition
+
+
+def export_rows(table_name, partition_by):
+    """
+    Return (select, partition expression): a select of the partition value
+    and the columns of each row of `table_name` to export.
+    """
+    table = EXPORT_TABLES[table_name]
+    from_clause, partition = export_source(table_name, partition_by)
+    rows_query = sa.select(partition, *table.columns).select_from(from_clause)
+    if partition_by == 'collection_month' and table_name == 'variant_ivar':
+        # A library sequenced on more than one run is joined to each of its
+        # summary QC rows; its variants only belong in its month once.
+        rows_query = rows_query.distinct()
+
+    return rows_query, partition
+
+
+def partition_row_counts(session, table_name, partition_by):
+    """
+    Return {partition value: number of rows} for `table_name`.
+    """
+    rows_query, partition = export_rows(table_name, partition_by)
+    rows = rows_query.subquery()
+    partition_column = list(rows.columns)[0]
+    query = sa.select(partition_column, sa.func.count()).group_by(partition_column)
+
+    return dict(session.execute(query).all())
+
+
+def read_state(out_dir):
+    state_path = os.path.join(out_dir, STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def write_state(out_dir, state):
+    state_path = os.path.join(out_dir, STATE_FILENAME)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def partition_dir(out_dir, table_name, partition_by, partition_value):
+    return os.path.join(out_dir, table_name, partition_by + '=' + urllib.parse.quote(partition_value, safe=''))
+
+
+class PartitionWriter(object):
+    """
+    Writes the record batches for one partition to a single file, through a
+    temporary file that replaces the partition's previous contents when the
+    writer is closed.
+    """
+    def __init__(self, path, schema, output_format, partition_value):
+        self.path = path
+        self.partition_value = partition_value
+        self.tmp_path = path + '.tmp'
+        self.rows = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if output_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.tmp_path, schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(self.tmp_path, schema)
+
+    def write(self, record_batch):
+        self.writer.write_batch(record_batch)
+        self.rows += record_batch.num_rows
+
+    def close(self):
+        self.writer.close()
+        partition_path = os.path.dirname(self.path)
+        for filename in os.listdir(partition_path):
+            existing_path = os.path.join(partition_path, filename)
+            if existing_path != self.tmp_path:
+                os.remove(existing_path)
+        os.replace(self.tmp_path, self.path)
+
+
+def log_partition_exported(table_name, partition_by, partition_value, rows, path):
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'partition_exported'
+    log_msg['table'] = table_name
+    log_msg['partition_by'] = partition_by
+    log_msg['partition'] = partition_value
+    log_msg['rows'] = rows
+    log_msg['path'] = path
+    print(json.dumps(log_msg))
+
+
+def export_table(session, out_dir, table_name, partition_by, output_format, exported_partitions, batch_size=10000):
+    """
+    Export the partitions of `table_name` whose row counts differ from
+    those in `exported_partitions` (from the last export), and remove the
+    partitions that no longer have any rows. A partition changes when rows
+    are loaded for a run that was already exported (eg. pangolin results
+    loaded later, or a resumed load), as well as for new runs, and, by
+    collection month, when libraries move between months.
+    Each changed partition is rewritten in full; rows are streamed
+    `batch_size` at a time, and only one partition file is open at once.
+    Returns ({partition value: row count} now exported, number of
+    partitions written, rows written).
+    """
+    table = EXPORT_TABLES[table_name]
+    schema = arrow_schema(table)
+    row_counts = partition_row_counts(session, table_name, partition_by)
+
+    for partition_value in sorted(set(exported_partitions) - set(row_counts)):
+        shutil.rmtree(partition_dir(out_dir, table_name, partition_by, partition_value), ignore_errors=True)
+
+    partition_values = sorted(
+        partition_value for partition_value, row_count in row_counts.items()
+        if exported_partitions.get(partition_value) != row_count
+    )
+    if not partition_values:
+        return row_counts, 0, 0
+
+    rows_query, partition = export_rows(table_name, partition_by)
+    rows_query = rows_query.where(partition.in_(partition_values)).order_by(partition)
+
+    num_partitions = 0
+    num_rows = 0
+    writer = None
+    result = session.execute(rows_query)
+    column_names = schema.names
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for partition_value, batch_rows in _group_by_partition(rows):
+            if writer is None or writer.partition_value != partition_value:
+                if writer is not None:
+                    writer.close()
+                    log_partition_exported(table_name, partition_by, writer.partition_value, writer.rows, writer.path)
+                path = os.path.join(partition_dir(out_dir, table_name, partition_by, partition_value), 'part-0' + FILE_EXTENSIONS[output_format])
+                writer = PartitionWriter(path, schema, output_format, partition_value)
+                num_partitions += 1
+            columns = list(zip(*[row[1:] for row in batch_rows]))
+            writer.write(pyarrow.record_batch([pyarrow.array(column, type=schema.field(n).type) for n, column in enumerate(columns)], names=column_names))
+            num_rows += len(batch_rows)
+    if writer is not None:
+        writer.close()
+        log_partition_exported(table_name, partition_by, writer.partition_value, writer.rows, writer.path)
+
+    return row_counts, num_partitions, num_rows
+
+
+def _group_by_partition(rows):
+    batch_rows = []
+    partition_value = None
+    for row in rows:
+        if batch_rows and row[0] != partition_value:
+            yield partition_value, batch_rows
+            batch_rows = []
+        partition_value = row[0]
+        batch_rows.append(row)
+    if batch_rows:
+        yield partition_value, batch_rows
+
+
+def export(session, out_dir, output_format='parquet', partition_by='sequencing_run_id', tables=None, full=False, batch_size=10000):
+    """
+    Export `tables` (default: all of EXPORT_TABLES) to `out_dir`, one
+    directory per table and one file per partition
+    (eg. variant_ivar/sequencing_run_id=<run>/part-0.parquet).
+
+    The number of rows exported in each partition is recorded in a state
+    file in `out_dir`, so that the next export only rewrites the partitions
+    whose rows have changed since then. With `full`, everything is exported
+    again.
+    """
+    if pyarrow is None:
+        raise ImportError('ncov-db export requires pyarrow. Install it with: pip install pyarrow')
+
+    start = time.perf_counter()
+    if tables is None:
+        tables = list(EXPORT_TABLES)
+
+    state = None if full else read_state(out_dir)
+    if state is not None and (state['format'] != output_format or state['partition_by'] != partition_by):
+        raise ValueError(
+            'Existing export in {} is {} partitioned by {}. Export to another directory, or use a full export to replace it.'.format(
+                out_dir, state['format'], state['partition_by'],
+            )
+        )
+    if state is None:
+        for table_name in tables:
+            shutil.rmtree(os.path.join(out_dir, table_name), ignore_errors=True)
+        state = {
+            'format': output_format,
+            'partition_by': partition_by,
+            'tables': {},
+        }
+
+    os.makedirs(out_dir, exist_ok=True)
+    total_partitions = 0
+    total_rows = 0
+    for table_name in tables:
+        table_state = state['tables'].get(table_name, {})
+        # State files from before row counts were kept have none, so
+        # every partition is rewritten.
+        exported_partitions, num_partitions, num_rows = export_table(
+            session, out_dir, table_name, partition_by, output_format, table_state.get('partitions', {}), batch_size,
+        )
+        table_state.pop('sequencing_run_ids', None)
+        table_state['partitions'] = exported_partitions
+        table_state['exported_at'] = now()
+        state['tables'][table_name] = table_state
+        write_state(out_dir, state)
+        total_partitions += num_partitions
+        total_rows += num_rows
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'export_completed'
+    log_msg['out_dir'] = os.path.abspath(out_dir)
+    log_msg['format'] = output_format
+    log_msg['partition_by'] = partition_by
+    log_msg['partitions_written'] = total_partitions
+    log_msg['rows'] = total_rows
+    log_msg['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(log_msg))
+
+    return total_rows
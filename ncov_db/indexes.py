@@ -0,0 +1,55 @@
+import collections
+import json
+import time
+
+from .time import now
+
+
+# Secondary indexes, as created by the 'add secondary indexes' migration
+# (and moved to the encoded tables by the dictionary-encoding migration).
+# Each is (index name, table, columns). The trailing columns make each index
+# covering for its lookup, eg. the libraries with a given mutation can be
+# read from the index alone, without visiting the table.
+SECONDARY_INDEXES = [
+    ('ix_variant_ivar_nucleotide_position', 'variant_ivar_encoded', ['nucleotide_position', 'library_key']),
+    ('ix_variant_ivar_mutation_name_by_amino_acid', 'variant_ivar_encoded', ['mutation_name_by_amino_acid', 'library_key']),
+    ('ix_ncov_tools_amino_acid_mutation_mutation_name_by_amino_acid', 'ncov_tools_amino_acid_mutation', ['mutation_name_by_amino_acid', 'library_id']),
+    ('ix_pangolin_result_lineage', 'pangolin_result_encoded', ['lineage', 'library_key']),
+    ('ix_ncov_tools_summary_qc_sequencing_run_id', 'ncov_tools_summary_qc', ['sequencing_run_id', 'qc_pass', 'library_id']),
+    ('ix_container_collection_date', 'container', ['collection_date', 'id']),
+]
+
+
+def log_indexes_event(event_type, index_names, elapsed):
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = event_type
+    log_msg['indexes'] = index_names
+    log_msg['elapsed_seconds'] = round(elapsed, 3)
+    print(json.dumps(log_msg))
+
+
+def drop_secondary_indexes(session):
+    """
+    Drop the secondary indexes, so that a large bulk load only has to
+    maintain the primary keys. Rebuild them afterwards with
+    create_secondary_indexes().
+    """
+    start = time.perf_counter()
+    connection = session.connection()
+    for index_name, table, columns in SECONDARY_INDEXES:
+        connection.exec_driver_sql('DROP INDEX IF EXISTS {}'.format(index_name))
+    log_indexes_event('indexes_dropped', [index_name for index_name, table, columns in SECONDARY_INDEXES], time.perf_counter() - start)
+
+
+def create_secondary_indexes(session):
+    """
+    Create any secondary indexes that are missing, then update the
+    query planner's statistics.
+    """
+    start = time.perf_counter()
+    connection = session.connection()
+    for index_name, table, columns in SECONDARY_INDEXES:
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(index_name, table, ', '.join(columns)))
+    connection.exec_driver_sql('ANALYZE')
+    log_indexes_event('indexes_created', [index_name for index_name, table, columns in SECONDARY_INDEXES], time.perf_counter() - start)
@@ -0,0 +1,151 @@
+import hashlib
+import os
+
+import sqlalchemy as sa
+
+from sqlalchemy.dialects import sqlite
+
+from . import models
+from .time import now
+
+
+def file_content_hash(path, chunk_size=1024 * 1024):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+def file_state(path):
+    """
+    Return the size, mtime and content hash of the file at `path`. The stat
+    is taken before the file is read, so if the file changes while it's
+    being hashed, the state won't match it afterwards.
+    """
+    stat = os.stat(path)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'content_hash': file_content_hash(path),
+    }
+
+
+class LoadManifest(object):
+    """
+    Tracks which input files have already been loaded, using the
+    loaded_file table.
+
+    The manifest entries under `path_prefix` (eg. a run directory) are read
+    with one query up front. After that, checking a file is a dict lookup
+    and an os.stat(). The file is only hashed when its size matches but its
+    mtime doesn't, to tell a touched file from a modified one.
+
+    The state recorded for a loaded file is taken with snapshot() before the
+    file is parsed, so a file that changes during the load doesn't match its
+    manifest entry, and is loaded again next time.
+    """
+    def __init__(self, session, path_prefix=None):
+        self.session = session
+        self.loaded_files = {}
+        self.snapshots = {}
+
+        loaded_file_table = models.LoadedFile.__table__
+        query = sa.select(loaded_file_table)
+        if path_prefix is not None:
+            query = query.where(loaded_file_table.c.path.startswith(os.path.abspath(path_prefix), autoescape=True))
+        for loaded_file in session.execute(query).mappings():
+            self.loaded_files[loaded_file['path']] = dict(loaded_file)
+
+    def snapshot(self, path):
+        """
+        Take the state of the file at `path` to be recorded when it has been
+        loaded, unless one has been taken already.
+        """
+        path = os.path.abspath(path)
+        state = self.snapshots.get(path)
+        if state is None:
+            state = file_state(path)
+            self.snapshots[path] = state
+
+        return state
+
+    def is_unchanged(self, path):
+        path = os.path.abspath(path)
+        loaded_file = self.loaded_files.get(path)
+        if loaded_file is None:
+            return False
+
+        stat = os.stat(path)
+        if stat.st_size != loaded_file['size']:
+            return False
+        if stat.st_mtime == loaded_file['mtime']:
+            return True
+
+        if self.snapshot(path)['content_hash'] != loaded_file['content_hash']:
+            return False
+
+        # Same content with a new mtime: remember the new mtime so the next
+        # check doesn't have to hash the file again.
+        self.record(path, loaded_file['file_type'], loaded_file['row_count'])
+
+        return True
+
+    def record(self, path, file_type, row_count):
+        """
+        Record the file at `path` as loaded, with the state taken by
+        snapshot() (or its current state, if no snapshot was taken).
+        """
+        path = os.path.abspath(path)
+        state = self.snapshots.pop(path, None)
+        if state is None:
+            state = file_state(path)
+
+        loaded_file = {
+            'path': path,
+            'file_type': file_type,
+            'size': state['size'],
+            'mtime': state['mtime'],
+            'content_hash': state['content_hash'],
+            'row_count': row_count,
+            'loaded_at': now(),
+        }
+
+        loaded_file_table = models.LoadedFile.__table__
+        stmt = sqlite.insert(loaded_file_table).values(**loaded_file)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['path'],
+            set_={k: v for k, v in loaded_file.items() if k != 'path'},
+        )
+        self.session.execute(stmt)
+        self.loaded_files[path] = loaded_file
+
+        return None
+
+
+def record_loaded_run(session, run_dir):
+    """
+    Record that `run_dir` was loaded completely. Written in the same
+    transaction as the run's data, so a run is only ever recorded as loaded
+    if its data was committed.
+    """
+    run_dir = os.path.abspath(run_dir)
+    loaded_run = {
+        'run_dir': run_dir,
+        'sequencing_run_id': os.path.basename(run_dir),
+        'loaded_at': now(),
+    }
+
+    loaded_run_table = models.LoadedRun.__table__
+    stmt = sqlite.insert(loaded_run_table).values(**loaded_run)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['run_dir'],
+        set_={k: v for k, v in loaded_run.items() if k != 'run_dir'},
+    )
+    session.execute(stmt)
+
+
+def loaded_run_dirs(session):
+    loaded_run_table = models.LoadedRun.__table__
+    return set(session.execute(sa.select(loaded_run_table.c.run_dir)).scalars())
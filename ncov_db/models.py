@@ -77,6 +77,76 @@ class DownsamplingReport(SQLModel, table=True):
     downsampling_factor: float
 
 
+class LibraryDictionary(SQLModel, table=True):
+    __tablename__ = "library_dictionary"
+    id: int = Field(primary_key=True)
+    library_id: str = Field(foreign_key='library.id', sa_column_kwargs={'unique': True})
+
+
+class VariantCallingToolDictionary(SQLModel, table=True):
+    __tablename__ = "variant_calling_tool_dictionary"
+    __table_args__ = (sa.UniqueConstraint('variant_calling_tool', 'variant_calling_tool_version'),)
+    id: int = Field(primary_key=True)
+    variant_calling_tool: str
+    variant_calling_tool_version: str
+
+
+class RefAccessionDictionary(SQLModel, table=True):
+    __tablename__ = "ref_accession_dictionary"
+    id: int = Field(primary_key=True)
+    ref_accession: str = Field(sa_column_kwargs={'unique': True})
+
+
+class GeneNameDictionary(SQLModel, table=True):
+    __tablename__ = "gene_name_dictionary"
+    id: int = Field(primary_key=True)
+    gene_name: str = Field(sa_column_kwargs={'unique': True})
+
+
+class PangolinVersionDictionary(SQLModel, table=True):
+    __tablename__ = "pangolin_version_dictionary"
+    __table_args__ = (sa.UniqueConstraint('version', 'pangolin_version', 'pangolearn_version', 'pango_version'),)
+    id: int = Field(primary_key=True)
+    version: Optional[str] = None
+    pangolin_version: Optional[str] = None
+    pangolearn_version: Optional[str] = None
+    pango_version: Optional[str] = None
+
+
+class VariantIvarEncoded(SQLModel, table=True):
+    __tablename__ = "variant_ivar_encoded"
+    __table_args__ = {'sqlite_with_rowid': False}
+    library_key: int = Field(foreign_key='library_dictionary.id', primary_key=True)
+    variant_calling_tool_id: int = Field(foreign_key='variant_calling_tool_dictionary.id', primary_key=True)
+    ref_accession_id: int = Field(foreign_key='ref_accession_dictionary.id', primary_key=True)
+    nucleotide_position: int = Field(primary_key=True)
+    ref_allele: str = Field(primary_key=True)
+    alt_allele: str = Field(primary_key=True)
+    ref_allele_depth: int
+    ref_allele_depth_reverse_reads: int
+    ref_allele_mean_quality: int
+    alt_allele_depth: int
+    alt_allele_depth_reverse_reads: int
+    alt_allele_mean_quality: int
+    alt_allele_frequency: float
+    consensus_allele: str
+    variant_type: str
+    is_ambiguous: bool
+    total_depth: int
+    p_value_fishers_exact: float
+    p_value_pass: bool
+    gene_name_id: Optional[int] = Field(default=None, foreign_key='gene_name_dictionary.id')
+    ref_codon: Optional[str] = None
+    ref_amino_acid: Optional[str] = None
+    alt_codon: Optional[str] = None
+    alt_amino_acid: Optional[str] = None
+    codon_position: Optional[int] = None
+    mutation_name_by_amino_acid: Optional[str] = None
+
+
+# A read-only view over variant_ivar_encoded, with the dictionary IDs
+# decoded (see map_to_view). Rows are written to variant_ivar_encoded (see
+# store_variants_tsv).
 class VariantIvar(SQLModel, table=True):
     __tablename__ = "variant_ivar"
     library_id: str = Field(foreign_key='library.id', primary_key=True)
@@ -157,6 +227,25 @@ class NcovToolsAminoAcidMutation(SQLModel, table=True):
     mutation_name_by_amino_acid: str
 
 
+class PangolinResultEncoded(SQLModel, table=True):
+    __tablename__ = "pangolin_result_encoded"
+    __table_args__ = {'sqlite_with_rowid': False}
+    sequencing_run_id: str  = Field(foreign_key='sequencing_run.id', primary_key=True)
+    library_key: int = Field(foreign_key='library_dictionary.id', primary_key=True)
+    lineage: str
+    conflict: float
+    ambiguity_score: float
+    scorpio_call: str
+    scorpio_support: float
+    scorpio_conflict: float
+    pangolin_version_id: int = Field(foreign_key='pangolin_version_dictionary.id', primary_key=True)
+    status: str
+    note: str
+
+
+# A read-only view over pangolin_result_encoded, with the dictionary IDs
+# decoded (see map_to_view). Rows are written to pangolin_result_encoded (see
+# store_pangolin_results).
 class PangolinResult(SQLModel, table=True):
     __tablename__ = "pangolin_result"
     sequencing_run_id: str  = Field(foreign_key='sequencing_run.id', primary_key=True)
@@ -173,3 +262,109 @@ class PangolinResult(SQLModel, table=True):
     pango_version: str = Field(primary_key=True)
     status: str
     note: str
+
+
+def decoded_select(model, encoded_model, dictionaries):
+    """
+    Select the columns of `model` from the table of `encoded_model`, left
+    joined to each of `dictionaries`, a list of (dictionary model, ID column
+    in the encoded table). Columns of a dictionary replace its ID.
+    """
+    encoded = encoded_model.__table__
+    from_clause = encoded
+    decoded_columns = {}
+    for dictionary_model, id_column in dictionaries:
+        dictionary = dictionary_model.__table__
+        from_clause = from_clause.outerjoin(dictionary, dictionary.c.id == encoded.c[id_column])
+        decoded_columns.update((column.name, column) for column in dictionary.c if column.name != 'id')
+
+    columns = [decoded_columns.get(column.name, encoded.c.get(column.name)).label(column.name) for column in model.__table__.c]
+    return sa.select(*columns).select_from(from_clause)
+
+
+def map_to_view(model, select):
+    """
+    Make `model` a read-only mapping of a view of `select`. Its table is
+    taken out of SQLModel.metadata, so create_all() doesn't create it as a
+    table, and the view is created after the tables instead (as the
+    dictionary-encoding migration does).
+    """
+    table = model.__table__
+    SQLModel.metadata.remove(table)
+    table.info['is_view'] = True
+
+    def create_view(target, connection, **kw):
+        select_sql = select.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+        connection.exec_driver_sql('CREATE VIEW IF NOT EXISTS {} AS {}'.format(table.name, select_sql))
+
+    def drop_view(target, connection, **kw):
+        connection.exec_driver_sql('DROP VIEW IF EXISTS {}'.format(table.name))
+
+    sa.event.listen(SQLModel.metadata, 'after_create', create_view)
+    sa.event.listen(SQLModel.metadata, 'before_drop', drop_view)
+
+
+map_to_view(VariantIvar, decoded_select(VariantIvar, VariantIvarEncoded, [
+    (LibraryDictionary, 'library_key'),
+    (VariantCallingToolDictionary, 'variant_calling_tool_id'),
+    (RefAccessionDictionary, 'ref_accession_id'),
+    (GeneNameDictionary, 'gene_name_id'),
+]))
+map_to_view(PangolinResult, decoded_select(PangolinResult, PangolinResultEncoded, [
+    (LibraryDictionary, 'library_key'),
+    (PangolinVersionDictionary, 'pangolin_version_id'),
+]))
+
+
+class LoadedFile(SQLModel, table=True):
+    __tablename__ = "loaded_file"
+    path: str = Field(primary_key=True)
+    file_type: str
+    size: int
+    mtime: float
+    content_hash: str
+    row_count: int
+    loaded_at: str
+
+
+class MutationPrevalenceRollup(SQLModel, table=True):
+    __tablename__ = "mutation_prevalence_rollup"
+    source: str = Field(primary_key=True)
+    mutation_name_by_amino_acid: str = Field(primary_key=True)
+    week_start: str = Field(primary_key=True)
+    sequencing_run_id: str = Field(primary_key=True)
+    num_libraries: int
+
+
+class LibraryCountRollup(SQLModel, table=True):
+    __tablename__ = "library_count_rollup"
+    week_start: str = Field(primary_key=True)
+    sequencing_run_id: str = Field(primary_key=True)
+    num_libraries: int
+    num_qc_pass: int
+
+
+class MutationDictionary(SQLModel, table=True):
+    __tablename__ = "mutation_dictionary"
+    id: int = Field(primary_key=True)
+    mutation_name_by_amino_acid: str
+
+
+class MutationIndexLibrary(SQLModel, table=True):
+    __tablename__ = "mutation_index_library"
+    bit: int = Field(primary_key=True)
+    library_id: str = Field(foreign_key='library.id')
+
+
+class MutationBitmap(SQLModel, table=True):
+    __tablename__ = "mutation_bitmap"
+    mutation_id: int = Field(foreign_key='mutation_dictionary.id', primary_key=True)
+    num_libraries: int
+    bitmap: bytes
+
+
+class LoadedRun(SQLModel, table=True):
+    __tablename__ = "loaded_run"
+    run_dir: str = Field(primary_key=True)
+    sequencing_run_id: str
+    loaded_at: str
@@ -0,0 +1,244 @@
+import collections
+import json
+import time
+import zlib
+
+import sqlalchemy as sa
+
+from sqlalchemy.dialects import sqlite
+
+from . import bulk
+from . import models
+from .time import now
+
+
+ncov_tools_amino_acid_mutation = models.NcovToolsAminoAcidMutation.__table__
+mutation_dictionary = models.MutationDictionary.__table__
+mutation_index_library = models.MutationIndexLibrary.__table__
+mutation_bitmap = models.MutationBitmap.__table__
+
+
+# Each indexed library is assigned a bit number (mutation_index_library),
+# and each mutation in the ncov-tools amino acid tables an integer ID
+# (mutation_dictionary). The libraries carrying a mutation are stored as a
+# bitmap (mutation_bitmap): a Python int with bit `n` set for library `n`,
+# stored as zlib-compressed little-endian bytes. Co-occurrence queries are
+# then &, | and & ~ on a handful of ints.
+
+
+def encode_bitmap(bitmap):
+    return zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'))
+
+
+def decode_bitmap(data):
+    if data is None:
+        return 0
+    return int.from_bytes(zlib.decompress(data), 'little')
+
+
+def bitmap_bits(bitmap):
+    """
+    Yield the numbers of the set bits in `bitmap`, in increasing order.
+    """
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for byte_number, byte in enumerate(data):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield byte_number * 8 + bit
+
+
+def assign_library_bits(session, library_ids):
+    """
+    Return a dict of library ID -> bit number for `library_ids`, assigning
+    the next free bit numbers to libraries that aren't indexed yet.
+    """
+    library_bits = {}
+    for library_batch in bulk.batched(sorted(set(library_ids)), 500):
+        query = sa.select(mutation_index_library.c.library_id, mutation_index_library.c.bit).where(mutation_index_library.c.library_id.in_(library_batch))
+        library_bits.update(session.execute(query).all())
+
+    new_library_ids = sorted(set(library_ids) - set(library_bits))
+    if new_library_ids:
+        next_bit = session.execute(sa.select(sa.func.coalesce(sa.func.max(mutation_index_library.c.bit) + 1, 0))).scalar()
+        rows = [(next_bit + n, library_id) for n, library_id in enumerate(new_library_ids)]
+        bulk.insert_ignore_duplicates(session, mutation_index_library, ['bit', 'library_id'], rows)
+        library_bits.update((library_id, bit) for bit, library_id in rows)
+
+    return library_bits
+
+
+def assign_mutation_ids(session, mutations):
+    """
+    Return a dict of mutation name -> mutation ID for `mutations`, adding
+    any that aren't in mutation_dictionary yet.
+    """
+    mutations = sorted(set(mutations))
+    rows = [(mutation,) for mutation in mutations]
+    bulk.insert_ignore_duplicates(session, mutation_dictionary, ['mutation_name_by_amino_acid'], rows)
+
+    mutation_ids = {}
+    for mutation_batch in bulk.batched(mutations, 500):
+        query = sa.select(mutation_dictionary.c.mutation_name_by_amino_acid, mutation_dictionary.c.id).where(mutation_dictionary.c.mutation_name_by_amino_acid.in_(mutation_batch))
+        mutation_ids.update(session.execute(query).all())
+
+    return mutation_ids
+
+
+def index_libraries(session, library_ids, batch_size=500):
+    """
+    Set the bits for `library_ids` in the bitmaps of every mutation they
+    carry in ncov_tools_amino_acid_mutation. Bits are only ever added, so
+    indexing a library again is harmless.
+    Returns the number of bitmaps written.
+    """
+    library_bits = assign_library_bits(session, library_ids)
+
+    new_bits = collections.defaultdict(int)
+    for library_batch in bulk.batched(sorted(library_bits), batch_size):
+        query = (
+            sa.select(ncov_tools_amino_acid_mutation.c.library_id, ncov_tools_amino_acid_mutation.c.mutation_name_by_amino_acid)
+            .where(ncov_tools_amino_acid_mutation.c.library_id.in_(library_batch))
+            .where(ncov_tools_amino_acid_mutation.c.mutation_name_by_amino_acid.isnot(None))
+            .distinct()
+        )
+        for library_id, mutation in session.execute(query):
+            new_bits[mutation] |= 1 << library_bits[library_id]
+
+    if not new_bits:
+        return 0
+
+    mutation_ids = assign_mutation_ids(session, new_bits)
+    bitmaps = load_bitmaps_by_id(session, mutation_ids.values())
+
+    rows = []
+    for mutation, bits in new_bits.items():
+        mutation_id = mutation_ids[mutation]
+        bitmap = bitmaps.get(mutation_id, 0) | bits
+        rows.append({'mutation_id': mutation_id, 'num_libraries': bin(bitmap).count('1'), 'bitmap': encode_bitmap(bitmap)})
+
+    stmt = sqlite.insert(mutation_bitmap)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['mutation_id'],
+        set_={'num_libraries': stmt.excluded.num_libraries, 'bitmap': stmt.excluded.bitmap},
+    )
+    session.execute(stmt, rows)
+
+    return len(rows)
+
+
+def load_bitmaps_by_id(session, mutation_ids):
+    bitmaps = {}
+    for mutation_id_batch in bulk.batched(sorted(mutation_ids), 500):
+        query = sa.select(mutation_bitmap.c.mutation_id, mutation_bitmap.c.bitmap).where(mutation_bitmap.c.mutation_id.in_(mutation_id_batch))
+        for mutation_id, data in session.execute(query):
+            bitmaps[mutation_id] = decode_bitmap(data)
+
+    return bitmaps
+
+
+def load_bitmaps(session, mutations):
+    """
+    Return a dict of mutation name -> bitmap for `mutations`. Mutations that
+    aren't in the index have an empty bitmap (0).
+    """
+    bitmaps = {mutation: 0 for mutation in mutations}
+    query = (
+        sa.select(mutation_dictionary.c.mutation_name_by_amino_acid, mutation_bitmap.c.bitmap)
+        .select_from(mutation_dictionary.join(mutation_bitmap, mutation_bitmap.c.mutation_id == mutation_dictionary.c.id))
+        .where(mutation_dictionary.c.mutation_name_by_amino_acid.in_(list(bitmaps)))
+    )
+    for mutation, data in session.execute(query):
+        bitmaps[mutation] = decode_bitmap(data)
+
+    return bitmaps
+
+
+def all_libraries_bitmap(session):
+    num_bits = session.execute(sa.select(sa.func.coalesce(sa.func.max(mutation_index_library.c.bit) + 1, 0))).scalar()
+    return (1 << num_bits) - 1
+
+
+def libraries_with_mutations(session, all_of=(), any_of=(), none_of=()):
+    """
+    Return the IDs of the indexed libraries that carry every mutation in
+    `all_of`, at least one in `any_of` (if given) and none in `none_of`.
+    """
+    bitmaps = load_bitmaps(session, set(all_of) | set(any_of) | set(none_of))
+
+    if all_of:
+        result = -1
+        for mutation in all_of:
+            result &= bitmaps[mutation]
+    else:
+        result = all_libraries_bitmap(session)
+    if any_of:
+        any_bitmap = 0
+        for mutation in any_of:
+            any_bitmap |= bitmaps[mutation]
+        result &= any_bitmap
+    for mutation in none_of:
+        result &= ~bitmaps[mutation]
+
+    library_ids = []
+    for bit_batch in bulk.batched(bitmap_bits(result), 500):
+        query = sa.select(mutation_index_library.c.library_id).where(mutation_index_library.c.bit.in_(bit_batch)).order_by(mutation_index_library.c.bit)
+        library_ids.extend(session.execute(query).scalars())
+
+    return library_ids
+
+
+def rebuild_mutation_index(session, batch_size=500):
+    """
+    Rebuild the mutation index from scratch, from every library in
+    ncov_tools_amino_acid_mutation.
+    """
+    start = time.perf_counter()
+    session.execute(sa.delete(mutation_bitmap))
+    session.execute(sa.delete(mutation_index_library))
+    session.execute(sa.delete(mutation_dictionary))
+
+    library_ids = session.execute(sa.select(ncov_tools_amino_acid_mutation.c.library_id).distinct()).scalars().all()
+    num_bitmaps = index_libraries(session, library_ids, batch_size)
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'mutation_index_rebuilt'
+    log_msg['libraries'] = len(library_ids)
+    log_msg['mutations'] = num_bitmaps
+    log_msg['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(log_msg))
+
+    return num_bitmaps
+
+
+def mark_changed(session, library_ids):
+    """
+    Remember that amino acid mutations were added for `library_ids` in this
+    session, so that update_changed() can index them.
+    """
+    changed = session.info.get('mutation_index_changed')
+    if changed is None:
+        changed = set()
+        session.info['mutation_index_changed'] = changed
+        if not sa.event.contains(session, 'after_soft_rollback', _drop_changed):
+            sa.event.listen(session, 'after_soft_rollback', _drop_changed)
+    changed.update(library_ids)
+
+
+def _drop_changed(session, previous_transaction):
+    if previous_transaction.nested:
+        return
+    session.info.pop('mutation_index_changed', None)
+
+
+def update_changed(session):
+    """
+    Index the libraries marked as changed in this session since the last
+    update. Called by the loaders before their final commit.
+    """
+    changed = session.info.pop('mutation_index_changed', None)
+    if not changed:
+        return 0
+
+    return index_libraries(session, changed)
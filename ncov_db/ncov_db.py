@@ -5,9 +5,17 @@ import sys
 
 import alembic.config
 
+from . import allele_matrix
+from . import db
+from . import export
+from . import indexes
+from . import mutation_index
+from . import query
+from . import rollups
 from . import store_sequencing_run
-from . import store_melted_freebayes_vcfs
+from . import store_sequencing_runs
 from . import store_pangolin_results
+from . import watch
 
 '''
 There are more sophisticated libraries for building sub-commands but
@@ -43,36 +51,198 @@ class SubCommands(object):
     def load_run(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('--db', required=True)
+        parser.add_argument('--commit-every', choices=store_sequencing_run.COMMIT_LEVELS, default='run')
+        parser.add_argument('--jobs', default=1, type=int, help='Number of worker processes used to parse variants files (default: 1)')
+        parser.add_argument('--batch-size', default=1000, type=int, help='Number of rows written per batch (default: 1000)')
+        parser.add_argument('--force-reload', action='store_true', help='Load every file, even if it is unchanged since it was last loaded')
+        parser.add_argument('--fast-load', action='store_true', help='Relax SQLite durability settings for a faster bulk load, and switch the database to WAL mode. Only use on a local database that can be rebuilt if the machine crashes mid-load')
+        parser.add_argument('--pragma', action='append', default=[], metavar='NAME=VALUE', help='Set a SQLite PRAGMA on connect, overriding the profile. Can be repeated')
+        parser.add_argument('--defer-indexes', action='store_true', help='Drop secondary indexes before loading and rebuild them afterwards')
+        parser.add_argument('--profile', metavar='DIR', help='Profile the load with cProfile, writing a profile and a summary of the hottest functions for each stage to DIR')
+        parser.add_argument('--profile-top', default=20, type=int, metavar='N', help='Number of functions (and allocation sites) in each profile summary (default: 20)')
+        parser.add_argument('--profile-memory', action='store_true', help='With --profile, also trace memory allocations with tracemalloc (slow)')
         parser.add_argument('run_dir')
         args = parser.parse_args(sys.argv[2:])
         kwargs = {
             'db': args.db,
             'run_dir': args.run_dir,
+            'commit_every': args.commit_every,
+            'jobs': args.jobs,
+            'batch_size': args.batch_size,
+            'force_reload': args.force_reload,
+            'fast_load': args.fast_load,
+            'pragma': args.pragma,
+            'defer_indexes': args.defer_indexes,
+            'profile': args.profile,
+            'profile_top': args.profile_top,
+            'profile_memory': args.profile_memory,
         }
         store_sequencing_run.main(args)
 
-    def load_melted_freebayes_vcfs(self):
+    def load_runs(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('--db', required=True)
-        parser.add_argument('melted_vcfs_dir')
+        parser.add_argument('--parent-dir', help='Load every run directory directly under this directory (eg. analysis_by_run)')
+        parser.add_argument('--runs-file', help='File listing run directories to load, one per line')
+        parser.add_argument('--commit-every', choices=store_sequencing_run.COMMIT_LEVELS, default='run')
+        parser.add_argument('--jobs', default=1, type=int, help='Number of worker processes used to parse variants files, shared by all runs (default: 1)')
+        parser.add_argument('--batch-size', default=1000, type=int, help='Number of rows written per batch (default: 1000)')
+        parser.add_argument('--force-reload', action='store_true', help='Load every run and file, even if already loaded')
+        parser.add_argument('--keep-going', action='store_true', help='If a run fails to load, roll it back and continue with the next run')
+        parser.add_argument('--fast-load', action='store_true', help='Relax SQLite durability settings for a faster bulk load, and switch the database to WAL mode. Only use on a local database that can be rebuilt if the machine crashes mid-load')
+        parser.add_argument('--pragma', action='append', default=[], metavar='NAME=VALUE', help='Set a SQLite PRAGMA on connect, overriding the profile. Can be repeated')
+        parser.add_argument('--defer-indexes', action='store_true', help='Drop secondary indexes before loading and rebuild them after the last run')
+        parser.add_argument('--profile', metavar='DIR', help='Profile the load with cProfile, writing a profile and a summary of the hottest functions for each stage to DIR')
+        parser.add_argument('--profile-top', default=20, type=int, metavar='N', help='Number of functions (and allocation sites) in each profile summary (default: 20)')
+        parser.add_argument('--profile-memory', action='store_true', help='With --profile, also trace memory allocations with tracemalloc (slow)')
+        parser.add_argument('run_dirs', nargs='*')
         args = parser.parse_args(sys.argv[2:])
-        kwargs = {
-            'db': args.db,
-            'melted_vcfs_dir': args.melted_vcfs_dir,
-        }
-        store_melted_freebayes_vcfs.main(args)
+        if not (args.run_dirs or args.parent_dir or args.runs_file):
+            parser.error('Give run directories, --parent-dir or --runs-file')
+        store_sequencing_runs.main(args)
+
+    def watch(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--db', required=True)
+        parser.add_argument('--interval', default=30, type=float, help='Seconds between polls of the root directories (default: 30)')
+        parser.add_argument('--sentinel', action='append', default=[], metavar='GLOB', help='Glob, relative to a run directory, of a file whose presence marks the run as complete. The run is loaded once its input files are also unchanged between two polls. Can be repeated (default: the ncov-tools summary QC report)')
+        parser.add_argument('--queue-size', default=4, type=int, help='Maximum number of ready runs waiting to be loaded (default: 4)')
+        parser.add_argument('--retry-delay', default=watch.RETRY_DELAY_SECONDS, type=float, help='Seconds before a run that failed to load is retried, doubling with each further failure (default: 60)')
+        parser.add_argument('--commit-every', choices=store_sequencing_run.COMMIT_LEVELS, default='run')
+        parser.add_argument('--jobs', default=1, type=int, help='Number of worker processes used to parse variants files, shared by all runs (default: 1)')
+        parser.add_argument('--batch-size', default=1000, type=int, help='Number of rows written per batch (default: 1000)')
+        parser.add_argument('--pragma', action='append', default=[], metavar='NAME=VALUE', help='Set a SQLite PRAGMA on connect, overriding the profile. Can be repeated')
+        parser.add_argument('--once', action='store_true', help='Load the runs that are ready now, then exit')
+        parser.add_argument('roots', nargs='+', help='Directories to watch for new runs (eg. analysis_by_run)')
+        args = parser.parse_args(sys.argv[2:])
+        watch.main(args)
 
     def load_pangolin_results(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('--db', required=True)
+        parser.add_argument('--batch-size', default=1000, type=int, help='Number of rows written per batch (default: 1000)')
+        parser.add_argument('--fast-load', action='store_true', help='Relax SQLite durability settings for a faster bulk load, and switch the database to WAL mode. Only use on a local database that can be rebuilt if the machine crashes mid-load')
+        parser.add_argument('--pragma', action='append', default=[], metavar='NAME=VALUE', help='Set a SQLite PRAGMA on connect, overriding the profile. Can be repeated')
+        parser.add_argument('--profile', metavar='DIR', help='Profile the load with cProfile, writing a profile and a summary of the hottest functions for each stage to DIR')
+        parser.add_argument('--profile-top', default=20, type=int, metavar='N', help='Number of functions (and allocation sites) in each profile summary (default: 20)')
+        parser.add_argument('--profile-memory', action='store_true', help='With --profile, also trace memory allocations with tracemalloc (slow)')
         parser.add_argument('pangolin_results')
         args = parser.parse_args(sys.argv[2:])
         kwargs = {
             'db': args.db,
             'pangolin_results': args.pangolin_results,
+            'batch_size': args.batch_size,
+            'fast_load': args.fast_load,
+            'pragma': args.pragma,
+            'profile': args.profile,
+            'profile_top': args.profile_top,
+            'profile_memory': args.profile_memory,
         }
         store_pangolin_results.main(args)
 
+    def reindex(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--db', required=True)
+        parser.add_argument('--drop', action='store_true', help='Only drop the secondary indexes (eg. before a very large bulk load)')
+        args = parser.parse_args(sys.argv[2:])
+        session = db.create_session(args.db)
+        indexes.drop_secondary_indexes(session)
+        if not args.drop:
+            indexes.create_secondary_indexes(session)
+        session.commit()
+        db.close_session(session)
+
+    def export(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--db', required=True)
+        parser.add_argument('--format', choices=list(export.FILE_EXTENSIONS), default='parquet', help='Output file format (default: parquet)')
+        parser.add_argument('--partition-by', choices=export.PARTITION_BY, default='sequencing_run_id', help='Write one file per sequencing run, or per month of collection (default: sequencing_run_id)')
+        parser.add_argument('--table', action='append', choices=list(export.EXPORT_TABLES), help='Table to export. Can be repeated (default: all)')
+        parser.add_argument('--batch-size', default=10000, type=int, help='Number of rows per record batch (default: 10000)')
+        parser.add_argument('--full', action='store_true', help='Rewrite every partition, not just those whose rows changed since the last export to OUT_DIR')
+        parser.add_argument('out_dir')
+        args = parser.parse_args(sys.argv[2:])
+        session = db.create_session(args.db)
+        export.export(session, args.out_dir, args.format, args.partition_by, args.table, args.full, args.batch_size)
+        db.close_session(session)
+
+    def export_allele_matrix(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--db', required=True)
+        parser.add_argument('--min-completeness', type=float, help='Only add libraries whose ncov-tools genome_completeness is at least this value (0-1)')
+        parser.add_argument('--batch-size', default=256, type=int, help='Number of libraries built in memory at a time (default: 256)')
+        parser.add_argument('matrix', help='Path to the .npy file to create or extend')
+        args = parser.parse_args(sys.argv[2:])
+        session = db.create_session(args.db)
+        allele_matrix.export_allele_matrix(session, args.matrix, args.min_completeness, args.batch_size)
+        db.close_session(session)
+
+    def rebuild_mutation_index(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--db', required=True)
+        args = parser.parse_args(sys.argv[2:])
+        session = db.create_session(args.db)
+        mutation_index.rebuild_mutation_index(session)
+        session.commit()
+        db.close_session(session)
+
+    def rebuild_rollups(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--db', required=True)
+        args = parser.parse_args(sys.argv[2:])
+        session = db.create_session(args.db)
+        rollups.rebuild_rollups(session)
+        session.commit()
+        db.close_session(session)
+
+    def query(self):
+        parser = argparse.ArgumentParser(prog='ncov-db query')
+        subparsers = parser.add_subparsers(dest='query', required=True)
+
+        libraries_with_mutation = subparsers.add_parser('libraries-with-mutation', help='Libraries carrying an amino acid mutation (eg. S:E484K)')
+        libraries_with_mutation.add_argument('mutation')
+        libraries_with_mutation.add_argument('--source', choices=list(query.MUTATION_TABLES), default='ivar', help='Read mutations from the ivar variants or the ncov-tools amino acid tables (default: ivar)')
+
+        lineage_counts_by_week = subparsers.add_parser('lineage-counts-by-week', help='Number of libraries per lineage, by week of collection (weeks start on Monday)')
+        lineage_counts_by_week.add_argument('--lineage')
+        lineage_counts_by_week.add_argument('--since', help='Earliest collection date (YYYY-MM-DD)')
+        lineage_counts_by_week.add_argument('--until', help='Latest collection date (YYYY-MM-DD)')
+
+        mutation_prevalence_by_week = subparsers.add_parser('mutation-prevalence-by-week', help='Fraction of libraries carrying each amino acid mutation, by week of collection (read from the rollup tables)')
+        mutation_prevalence_by_week.add_argument('--mutation')
+        mutation_prevalence_by_week.add_argument('--source', choices=list(query.MUTATION_TABLES), default='ivar', help='Read mutations from the ivar variants or the ncov-tools amino acid tables (default: ivar)')
+
+        mutation_co_occurrence = subparsers.add_parser('mutation-co-occurrence', help='Libraries carrying a combination of amino acid mutations (from the ncov-tools amino acid tables)')
+        mutation_co_occurrence.add_argument('--with', dest='all_of', action='append', default=[], metavar='MUTATION', help='Library carries this mutation. Can be repeated')
+        mutation_co_occurrence.add_argument('--any', dest='any_of', action='append', default=[], metavar='MUTATION', help='Library carries at least one of the --any mutations. Can be repeated')
+        mutation_co_occurrence.add_argument('--without', dest='none_of', action='append', default=[], metavar='MUTATION', help="Library doesn't carry this mutation. Can be repeated")
+
+        qc_failure_rate_by_run = subparsers.add_parser('qc-failure-rate-by-run', help='Fraction of libraries failing ncov-tools QC, per sequencing run')
+        qc_failure_rate_by_run.add_argument('--sequencing-run-id')
+
+        for subparser in subparsers.choices.values():
+            subparser.add_argument('--db', required=True)
+            subparser.add_argument('--format', choices=list(query.OUTPUT_WRITERS), default='tsv', help='Output format: tsv, or json (one object per line) (default: tsv)')
+            subparser.add_argument('--fetch-size', default=1000, type=int, help='Number of rows fetched from the database at a time (default: 1000)')
+
+        args = parser.parse_args(sys.argv[2:])
+        output_kwargs = {
+            'output_format': args.format,
+            'fetch_size': args.fetch_size,
+        }
+        session = db.create_session(args.db)
+        if args.query == 'libraries-with-mutation':
+            query.libraries_with_mutation(session, args.mutation, args.source, **output_kwargs)
+        elif args.query == 'lineage-counts-by-week':
+            query.lineage_counts_by_week(session, args.lineage, args.since, args.until, **output_kwargs)
+        elif args.query == 'mutation-prevalence-by-week':
+            query.mutation_prevalence_by_week(session, args.mutation, args.source, **output_kwargs)
+        elif args.query == 'mutation-co-occurrence':
+            query.mutation_co_occurrence(session, args.all_of, args.any_of, args.none_of, **output_kwargs)
+        elif args.query == 'qc-failure-rate-by-run':
+            query.qc_failure_rate_by_run(session, args.sequencing_run_id, **output_kwargs)
+        db.close_session(session)
+
 
 def main():
     SubCommands()
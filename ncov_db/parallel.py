@@ -0,0 +1,42 @@
+import collections
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+def imap_bounded(fn, items, jobs=1, max_in_flight=None, executor=None):
+    """
+    Yield fn(item) for each item, in input order.
+
+    With jobs > 1 the calls run in a pool of worker processes, and at most
+    `max_in_flight` results (default: 2 * jobs) are held before the caller
+    consumes them, so a slow consumer (the single database writer) can't
+    make parsed results pile up in memory. `fn` and its results must be
+    picklable.
+
+    An existing `executor` can be passed in to reuse its worker processes
+    (eg. across the runs of a load-runs backfill); otherwise a pool is
+    started and shut down for this call.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * jobs
+
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from _imap_bounded(fn, items, executor, max_in_flight)
+    else:
+        yield from _imap_bounded(fn, items, executor, max_in_flight)
+
+
+def _imap_bounded(fn, items, executor, max_in_flight):
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
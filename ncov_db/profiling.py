@@ -0,0 +1,172 @@
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import tracemalloc
+
+from .time import now
+
+
+# Profiles are kept per stage (eg. one per file type in load-run), and a
+# stage that runs more than once (eg. for each run in load-runs) adds to the
+# same profile. Only one stage is profiled at a time, since cProfile
+# profilers can't be nested. Worker processes (--jobs) aren't profiled.
+
+
+def take_snapshot():
+    # Leave out the memory used by tracemalloc's own snapshots.
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        # tracemalloc.reset_peak() was added in Python 3.9. Before that, the
+        # peak can only be reset by forgetting the memory blocks traced so
+        # far, so the stage's peak doesn't include memory allocated earlier
+        # and still in use.
+        tracemalloc.clear_traces()
+
+
+class Profiler(object):
+    """
+    Profiles named stages with cProfile, and optionally traces their memory
+    allocations with tracemalloc. write() saves a .prof file (readable with
+    pstats or snakeviz) and a text summary per stage, plus all.prof for the
+    whole command, and logs a profile_written event per stage with its
+    `top` hottest functions.
+    """
+    def __init__(self, out_dir, top=20, memory=False):
+        self.out_dir = out_dir
+        self.top = top
+        self.memory = memory
+        self.profiles = collections.OrderedDict()
+        self.allocations = {}
+        self.active_stage = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.active_stage is not None:
+            yield
+            return
+
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            reset_peak()
+            snapshot_before = take_snapshot()
+
+        self.active_stage = name
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.active_stage = None
+            if self.memory:
+                self.record_allocations(name, snapshot_before)
+
+    def record_allocations(self, name, snapshot_before):
+        """
+        Keep the peak memory of the stage, and the top allocation sites of
+        the invocation of the stage that had the highest peak.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        previous = self.allocations.get(name)
+        if previous is not None and previous['peak_bytes'] >= peak:
+            return
+        snapshot_after = take_snapshot()
+        top_allocations = []
+        for stat in snapshot_after.compare_to(snapshot_before, 'lineno')[:self.top]:
+            frame = stat.traceback[0]
+            top_allocations.append(collections.OrderedDict([
+                ('location', '{}:{}'.format(frame.filename, frame.lineno)),
+                ('size_diff_bytes', stat.size_diff),
+                ('count_diff', stat.count_diff),
+            ]))
+        self.allocations[name] = {
+            'peak_bytes': peak,
+            'top_allocations': top_allocations,
+        }
+
+    def top_functions(self, stats):
+        functions = []
+        for func in stats.fcn_list[:self.top]:
+            primitive_calls, total_calls, total_time, cumulative_time, callers = stats.stats[func]
+            filename, lineno, function_name = func
+            functions.append(collections.OrderedDict([
+                ('function', '{}:{}({})'.format(filename, lineno, function_name)),
+                ('ncalls', total_calls),
+                ('tottime', round(total_time, 4)),
+                ('cumtime', round(cumulative_time, 4)),
+            ]))
+        return functions
+
+    def write_stage(self, name, stats):
+        prof_path = os.path.join(self.out_dir, name + '.prof')
+        stats.dump_stats(prof_path)
+
+        summary = io.StringIO()
+        summary_stats = pstats.Stats(prof_path, stream=summary)
+        summary_stats.sort_stats('tottime').print_stats(self.top)
+        summary_stats.sort_stats('cumulative').print_stats(self.top)
+        with open(os.path.join(self.out_dir, name + '.txt'), 'w') as f:
+            f.write(summary.getvalue())
+
+        stats.sort_stats('tottime')
+        log_msg = collections.OrderedDict()
+        log_msg['timestamp'] = now()
+        log_msg['event_type'] = 'profile_written'
+        log_msg['stage'] = name
+        log_msg['path'] = os.path.abspath(prof_path)
+        log_msg['total_seconds'] = round(stats.total_tt, 3)
+        log_msg['top_functions'] = self.top_functions(stats)
+        if name in self.allocations:
+            log_msg['peak_traced_bytes'] = self.allocations[name]['peak_bytes']
+            log_msg['top_allocations'] = self.allocations[name]['top_allocations']
+        print(json.dumps(log_msg))
+
+    def write(self):
+        if not self.profiles:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        all_stats = None
+        for name, profile in self.profiles.items():
+            stats = pstats.Stats(profile)
+            self.write_stage(name, stats)
+            if all_stats is None:
+                all_stats = pstats.Stats(profile)
+            else:
+                all_stats.add(profile)
+        self.write_stage('all', all_stats)
+        if self.memory:
+            tracemalloc.stop()
+
+
+class NullProfiler(object):
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def write(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def args_to_profiler(args):
+    """
+    Return a Profiler for the --profile, --profile-top and --profile-memory
+    options (if present) in parsed args, or NULL_PROFILER if --profile
+    wasn't given.
+    """
+    profile_dir = getattr(args, 'profile', None)
+    if not profile_dir:
+        return NULL_PROFILER
+    return Profiler(profile_dir, getattr(args, 'profile_top', 20), getattr(args, 'profile_memory', False))
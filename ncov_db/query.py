@@ -0,0 +1,323 @@
+import collections
+import csv
+import json
+import sys
+import time
+
+import sqlalchemy as sa
+
+from . import models
+from . import mutation_index
+from .time import now
+
+
+container = models.Container.__table__
+library = models.Library.__table__
+library_dictionary = models.LibraryDictionary.__table__
+variant_ivar_encoded = models.VariantIvarEncoded.__table__
+ncov_tools_amino_acid_mutation = models.NcovToolsAminoAcidMutation.__table__
+ncov_tools_summary_qc = models.NcovToolsSummaryQC.__table__
+pangolin_result_encoded = models.PangolinResultEncoded.__table__
+mutation_prevalence_rollup = models.MutationPrevalenceRollup.__table__
+library_count_rollup = models.LibraryCountRollup.__table__
+
+# The variant_ivar and pangolin_result views look up every dictionary ID, and
+# SQLite only leaves out the lookups a query doesn't use in simple queries,
+# not in grouped ones. So the grouped queries (and the rollups) read the
+# encoded tables through these, which only decode the library ID.
+variant_ivar = (
+    sa.select(
+        library_dictionary.c.library_id,
+        variant_ivar_encoded.c.nucleotide_position,
+        variant_ivar_encoded.c.mutation_name_by_amino_acid,
+    )
+    .select_from(variant_ivar_encoded.join(library_dictionary, library_dictionary.c.id == variant_ivar_encoded.c.library_key))
+    .subquery('variant_ivar')
+)
+
+pangolin_result = (
+    sa.select(
+        library_dictionary.c.library_id,
+        pangolin_result_encoded.c.lineage,
+    )
+    .select_from(pangolin_result_encoded.join(library_dictionary, library_dictionary.c.id == pangolin_result_encoded.c.library_key))
+    .subquery('pangolin_result')
+)
+
+
+def week_start(date_column):
+    """
+    The Monday that starts the (Monday-Sunday) week containing `date_column`,
+    as an ISO 8601 date string.
+    """
+    return sa.func.date(date_column, 'weekday 0', '-6 days')
+
+
+# The statements are built once, with bound parameters, so SQLAlchemy's
+# compiled statement cache only has to compile each of them once per process.
+# A query with optional filters has one statement per combination of the
+# filters that are given, built on first use by filtered_statement(). Each
+# only has the WHERE clauses of its own filters, so SQLite can seek the
+# index on a filtered column.
+
+def filtered_statement(cache, build, params):
+    """
+    Return the statement built by `build` for the optional filters in
+    `params` that aren't None, keeping one per combination in `cache`.
+    """
+    filters = frozenset(name for name, value in params.items() if value is not None)
+    stmt = cache.get(filters)
+    if stmt is None:
+        stmt = build(filters)
+        cache[filters] = stmt
+
+    return stmt
+
+
+def given_params(params):
+    return {name: value for name, value in params.items() if value is not None}
+
+
+MUTATION_TABLES = {
+    'ivar': variant_ivar,
+    'ncov-tools': ncov_tools_amino_acid_mutation,
+}
+
+
+def _libraries_with_mutation(mutation_table):
+    return (
+        sa.select(
+            mutation_table.c.library_id,
+            library.c.container_id,
+            container.c.collection_date,
+            sa.func.group_concat(mutation_table.c.nucleotide_position.distinct()).label('nucleotide_positions'),
+        )
+        .select_from(
+            mutation_table
+            .join(library, library.c.id == mutation_table.c.library_id)
+            .outerjoin(container, container.c.id == library.c.container_id)
+        )
+        .where(mutation_table.c.mutation_name_by_amino_acid == sa.bindparam('mutation'))
+        .group_by(mutation_table.c.library_id)
+        .order_by(mutation_table.c.library_id)
+    )
+
+
+LIBRARIES_WITH_MUTATION = {source: _libraries_with_mutation(mutation_table) for source, mutation_table in MUTATION_TABLES.items()}
+
+
+_lineage_week_start = week_start(container.c.collection_date).label('week_start')
+
+def _lineage_counts_by_week(filters):
+    stmt = (
+        sa.select(
+            _lineage_week_start,
+            pangolin_result.c.lineage,
+            sa.func.count(pangolin_result.c.library_id.distinct()).label('num_libraries'),
+        )
+        .select_from(
+            pangolin_result
+            .join(library, library.c.id == pangolin_result.c.library_id)
+            .join(container, container.c.id == library.c.container_id)
+        )
+        .where(container.c.collection_date.isnot(None))
+    )
+    if 'lineage' in filters:
+        stmt = stmt.where(pangolin_result.c.lineage == sa.bindparam('lineage'))
+    if 'since' in filters:
+        stmt = stmt.where(container.c.collection_date >= sa.bindparam('since', type_=sa.String))
+    if 'until' in filters:
+        stmt = stmt.where(container.c.collection_date <= sa.bindparam('until', type_=sa.String))
+
+    return (
+        stmt
+        .group_by(_lineage_week_start, pangolin_result.c.lineage)
+        .order_by(_lineage_week_start, pangolin_result.c.lineage)
+    )
+
+
+LINEAGE_COUNTS_BY_WEEK = {}
+
+
+_num_failed = sa.func.sum(sa.case((sa.not_(ncov_tools_summary_qc.c.qc_pass), 1), else_=0))
+
+def _qc_failure_rate_by_run(filters):
+    stmt = sa.select(
+        ncov_tools_summary_qc.c.sequencing_run_id,
+        sa.func.count().label('num_libraries'),
+        _num_failed.label('num_failed'),
+        sa.func.round(_num_failed * 1.0 / sa.func.count(), 4).label('failure_rate'),
+    )
+    if 'sequencing_run_id' in filters:
+        stmt = stmt.where(ncov_tools_summary_qc.c.sequencing_run_id == sa.bindparam('sequencing_run_id'))
+
+    return (
+        stmt
+        .group_by(ncov_tools_summary_qc.c.sequencing_run_id)
+        .order_by(ncov_tools_summary_qc.c.sequencing_run_id)
+    )
+
+
+QC_FAILURE_RATE_BY_RUN = {}
+
+
+# Read from the rollup tables maintained by ncov_db.rollups, rather than
+# from variant_ivar / ncov_tools_amino_acid_mutation. A library sequenced on
+# more than one run is counted once per run.
+_libraries_per_week = (
+    sa.select(
+        library_count_rollup.c.week_start,
+        sa.func.sum(library_count_rollup.c.num_libraries).label('num_libraries'),
+    )
+    .group_by(library_count_rollup.c.week_start)
+    .subquery()
+)
+
+_num_libraries_with_mutation = sa.func.sum(mutation_prevalence_rollup.c.num_libraries)
+
+def _mutation_prevalence_by_week(filters):
+    stmt = (
+        sa.select(
+            mutation_prevalence_rollup.c.week_start,
+            mutation_prevalence_rollup.c.mutation_name_by_amino_acid,
+            _num_libraries_with_mutation.label('num_libraries_with_mutation'),
+            _libraries_per_week.c.num_libraries,
+            sa.func.round(_num_libraries_with_mutation * 1.0 / _libraries_per_week.c.num_libraries, 4).label('prevalence'),
+        )
+        .select_from(
+            mutation_prevalence_rollup
+            .join(_libraries_per_week, _libraries_per_week.c.week_start == mutation_prevalence_rollup.c.week_start)
+        )
+        .where(mutation_prevalence_rollup.c.source == sa.bindparam('source'))
+    )
+    if 'mutation' in filters:
+        stmt = stmt.where(mutation_prevalence_rollup.c.mutation_name_by_amino_acid == sa.bindparam('mutation'))
+
+    return (
+        stmt
+        .group_by(mutation_prevalence_rollup.c.week_start, mutation_prevalence_rollup.c.mutation_name_by_amino_acid)
+        .order_by(mutation_prevalence_rollup.c.week_start, mutation_prevalence_rollup.c.mutation_name_by_amino_acid)
+    )
+
+
+MUTATION_PREVALENCE_BY_WEEK = {}
+
+
+def to_output_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+
+def write_tsv(out, columns, batches):
+    writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows([['' if value is None else to_output_value(value) for value in row] for row in rows])
+
+
+def write_json(out, columns, batches):
+    """
+    Write one JSON object per line, so the output can be streamed.
+    """
+    for rows in batches:
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, map(to_output_value, row)))) + '\n')
+
+
+OUTPUT_WRITERS = {
+    'tsv': write_tsv,
+    'json': write_json,
+}
+
+
+def run_query(session, query_name, stmt, params, output_format='tsv', out=None, fetch_size=1000):
+    """
+    Execute `stmt` and stream its rows to `out` (default: stdout), `fetch_size`
+    rows at a time. A query_completed event with the row count and timings is
+    written to stderr, so it doesn't mix with the query results.
+    """
+    if out is None:
+        out = sys.stdout
+
+    start = time.perf_counter()
+    result = session.execute(stmt, params)
+    columns = list(result.keys())
+    counts = {'rows': 0}
+    first_row_seconds = []
+
+    def batches():
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not first_row_seconds:
+                first_row_seconds.append(time.perf_counter() - start)
+            if not rows:
+                break
+            counts['rows'] += len(rows)
+            yield rows
+
+    OUTPUT_WRITERS[output_format](out, columns, batches())
+    out.flush()
+    elapsed = time.perf_counter() - start
+
+    log_query_completed(query_name, params, counts['rows'], first_row_seconds[0] if first_row_seconds else None, elapsed)
+
+    return counts['rows']
+
+
+def log_query_completed(query_name, params, rows, first_row_seconds, elapsed):
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'query_completed'
+    log_msg['query'] = query_name
+    log_msg['params'] = params
+    log_msg['rows'] = rows
+    log_msg['first_row_seconds'] = round(first_row_seconds, 4) if first_row_seconds is not None else None
+    log_msg['elapsed_seconds'] = round(elapsed, 4)
+    print(json.dumps(log_msg), file=sys.stderr)
+
+
+def libraries_with_mutation(session, mutation, source='ivar', **kwargs):
+    params = {'mutation': mutation}
+    return run_query(session, 'libraries-with-mutation', LIBRARIES_WITH_MUTATION[source], params, **kwargs)
+
+
+def lineage_counts_by_week(session, lineage=None, since=None, until=None, **kwargs):
+    params = {'lineage': lineage, 'since': since, 'until': until}
+    stmt = filtered_statement(LINEAGE_COUNTS_BY_WEEK, _lineage_counts_by_week, params)
+    return run_query(session, 'lineage-counts-by-week', stmt, given_params(params), **kwargs)
+
+
+def mutation_prevalence_by_week(session, mutation=None, source='ivar', **kwargs):
+    stmt = filtered_statement(MUTATION_PREVALENCE_BY_WEEK, _mutation_prevalence_by_week, {'mutation': mutation})
+    params = given_params({'mutation': mutation, 'source': source})
+    return run_query(session, 'mutation-prevalence-by-week', stmt, params, **kwargs)
+
+
+def mutation_co_occurrence(session, all_of=(), any_of=(), none_of=(), output_format='tsv', out=None, fetch_size=None):
+    """
+    Libraries carrying all of `all_of`, any of `any_of` and none of
+    `none_of`, answered from the bitmaps in ncov_db.mutation_index rather
+    than by joining ncov_tools_amino_acid_mutation with itself.
+    """
+    if out is None:
+        out = sys.stdout
+
+    start = time.perf_counter()
+    library_ids = mutation_index.libraries_with_mutations(session, all_of, any_of, none_of)
+    first_row_seconds = time.perf_counter() - start
+    OUTPUT_WRITERS[output_format](out, ['library_id'], [[(library_id,) for library_id in library_ids]])
+    out.flush()
+
+    params = {'all_of': list(all_of), 'any_of': list(any_of), 'none_of': list(none_of)}
+    log_query_completed('mutation-co-occurrence', params, len(library_ids), first_row_seconds, time.perf_counter() - start)
+
+    return len(library_ids)
+
+
+def qc_failure_rate_by_run(session, sequencing_run_id=None, **kwargs):
+    params = {'sequencing_run_id': sequencing_run_id}
+    stmt = filtered_statement(QC_FAILURE_RATE_BY_RUN, _qc_failure_rate_by_run, params)
+    return run_query(session, 'qc-failure-rate-by-run', stmt, given_params(params), **kwargs)
@@ -0,0 +1,178 @@
+import collections
+import json
+import time
+
+import sqlalchemy as sa
+
+from . import bulk
+from . import models
+from .query import variant_ivar
+from .query import week_start
+from .time import now
+
+
+container = models.Container.__table__
+library = models.Library.__table__
+ncov_tools_summary_qc = models.NcovToolsSummaryQC.__table__
+mutation_prevalence_rollup = models.MutationPrevalenceRollup.__table__
+library_count_rollup = models.LibraryCountRollup.__table__
+
+# Source name -> table of per-library amino acid mutations.
+MUTATION_SOURCES = {
+    'ivar': variant_ivar,
+    'ncov-tools': models.NcovToolsAminoAcidMutation.__table__,
+}
+
+# Libraries are linked to the run they were sequenced on through their
+# ncov-tools summary QC, and to a week through their container's collection
+# date. Libraries without a collection date (eg. controls) aren't counted.
+_sequenced_libraries = (
+    ncov_tools_summary_qc
+    .join(library, library.c.id == ncov_tools_summary_qc.c.library_id)
+    .join(container, container.c.id == library.c.container_id)
+)
+
+
+def _run_filter(sequencing_run_ids):
+    if sequencing_run_ids is None:
+        return sa.true()
+    return ncov_tools_summary_qc.c.sequencing_run_id.in_(sequencing_run_ids)
+
+
+def _insert_mutation_prevalence(source, mutation_table, sequencing_run_ids):
+    library_week_start = week_start(container.c.collection_date)
+    select = (
+        sa.select(
+            sa.literal(source),
+            mutation_table.c.mutation_name_by_amino_acid,
+            library_week_start,
+            ncov_tools_summary_qc.c.sequencing_run_id,
+            sa.func.count(mutation_table.c.library_id.distinct()),
+        )
+        .select_from(_sequenced_libraries.join(mutation_table, mutation_table.c.library_id == ncov_tools_summary_qc.c.library_id))
+        .where(_run_filter(sequencing_run_ids))
+        .where(container.c.collection_date.isnot(None))
+        .where(mutation_table.c.mutation_name_by_amino_acid.isnot(None))
+        .group_by(mutation_table.c.mutation_name_by_amino_acid, library_week_start, ncov_tools_summary_qc.c.sequencing_run_id)
+    )
+    columns = ['source', 'mutation_name_by_amino_acid', 'week_start', 'sequencing_run_id', 'num_libraries']
+    return sa.insert(mutation_prevalence_rollup).from_select(columns, select)
+
+
+def _insert_library_counts(sequencing_run_ids):
+    library_week_start = week_start(container.c.collection_date)
+    select = (
+        sa.select(
+            library_week_start,
+            ncov_tools_summary_qc.c.sequencing_run_id,
+            sa.func.count(ncov_tools_summary_qc.c.library_id.distinct()),
+            sa.func.sum(sa.case((ncov_tools_summary_qc.c.qc_pass, 1), else_=0)),
+        )
+        .select_from(_sequenced_libraries)
+        .where(_run_filter(sequencing_run_ids))
+        .where(container.c.collection_date.isnot(None))
+        .group_by(library_week_start, ncov_tools_summary_qc.c.sequencing_run_id)
+    )
+    columns = ['week_start', 'sequencing_run_id', 'num_libraries', 'num_qc_pass']
+    return sa.insert(library_count_rollup).from_select(columns, select)
+
+
+def refresh_rollups(session, sequencing_run_ids=None, batch_size=500):
+    """
+    Recompute the rollup rows for `sequencing_run_ids` (or for every run,
+    if None) from the underlying tables. Runs are recomputed in batches of
+    `batch_size`, each as a delete followed by an INSERT ... SELECT.
+    """
+    start = time.perf_counter()
+    if sequencing_run_ids is None:
+        run_batches = [None]
+        session.execute(sa.delete(mutation_prevalence_rollup))
+        session.execute(sa.delete(library_count_rollup))
+    else:
+        run_batches = list(bulk.batched(sorted(sequencing_run_ids), batch_size))
+
+    num_rows = 0
+    for run_batch in run_batches:
+        if run_batch is not None:
+            session.execute(sa.delete(mutation_prevalence_rollup).where(mutation_prevalence_rollup.c.sequencing_run_id.in_(run_batch)))
+            session.execute(sa.delete(library_count_rollup).where(library_count_rollup.c.sequencing_run_id.in_(run_batch)))
+        for source, mutation_table in MUTATION_SOURCES.items():
+            num_rows += session.execute(_insert_mutation_prevalence(source, mutation_table, run_batch)).rowcount
+        num_rows += session.execute(_insert_library_counts(run_batch)).rowcount
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'rollups_refreshed'
+    log_msg['sequencing_runs'] = 'all' if sequencing_run_ids is None else len(sequencing_run_ids)
+    log_msg['rows'] = num_rows
+    log_msg['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(log_msg))
+
+    return num_rows
+
+
+def rebuild_rollups(session):
+    return refresh_rollups(session, None)
+
+
+def mark_changed(session, library_ids=(), container_ids=(), sequencing_run_ids=()):
+    """
+    Remember that rows for these libraries, containers (collection dates) or
+    sequencing runs (summary QC) were written in this session, so that
+    refresh_changed_rollups() knows which runs' rollups are out of date.
+    """
+    changed = session.info.get('rollups_changed')
+    if changed is None:
+        changed = {'library_ids': set(), 'container_ids': set(), 'sequencing_run_ids': set()}
+        session.info['rollups_changed'] = changed
+        if not sa.event.contains(session, 'after_soft_rollback', _drop_changed):
+            sa.event.listen(session, 'after_soft_rollback', _drop_changed)
+    changed['library_ids'].update(library_ids)
+    changed['container_ids'].update(container_ids)
+    changed['sequencing_run_ids'].update(sequencing_run_ids)
+
+
+def _drop_changed(session, previous_transaction):
+    if previous_transaction.nested:
+        return
+    session.info.pop('rollups_changed', None)
+
+
+def changed_sequencing_runs(session, changed, batch_size=500):
+    sequencing_run_ids = set(changed['sequencing_run_ids'])
+
+    for library_batch in bulk.batched(sorted(changed['library_ids']), batch_size):
+        query = (
+            sa.select(ncov_tools_summary_qc.c.sequencing_run_id)
+            .where(ncov_tools_summary_qc.c.library_id.in_(library_batch))
+            .distinct()
+        )
+        sequencing_run_ids.update(session.execute(query).scalars())
+
+    for container_batch in bulk.batched(sorted(changed['container_ids']), batch_size):
+        query = (
+            sa.select(ncov_tools_summary_qc.c.sequencing_run_id)
+            .select_from(ncov_tools_summary_qc.join(library, library.c.id == ncov_tools_summary_qc.c.library_id))
+            .where(library.c.container_id.in_(container_batch))
+            .distinct()
+        )
+        sequencing_run_ids.update(session.execute(query).scalars())
+
+    return sequencing_run_ids
+
+
+def refresh_changed_rollups(session):
+    """
+    Refresh the rollups for every run affected by the rows written in this
+    session since the last refresh. Called by the loaders before their
+    final commit.
+    """
+    changed = session.info.pop('rollups_changed', None)
+    if changed is None:
+        return 0
+
+    sequencing_run_ids = changed_sequencing_runs(session, changed)
+    if not sequencing_run_ids:
+        return 0
+
+    return refresh_rollups(session, sequencing_run_ids)
@@ -1,108 +1,210 @@
 #!/usr/bin/env python
 
 import argparse
-import collections
-import csv
-import json
-import os
-import sys
 
 from dataclasses import dataclass
 from datetime import date
 
 import sqlalchemy as sa
-import sqlalchemy.orm as sao
 
+from . import bulk
+from . import db
+from . import entities
 from . import models
+from . import rollups
+from . import tsv
 
 
-def parse_metadata_tsv(metadata_tsv_path):
+METADATA_FIELDS = [
+    ('library_id',      'sample', None),
+    ('collection_date', 'date',   tsv.null_if({'NA'}, date.fromisoformat)),
+    ('ct_value',        'ct',     tsv.null_if({'NA'})),
+]
 
-    date_fields = [
-        'date',
-    ]
-
-    metadata_records = []
-
-    with open(metadata_tsv_path, 'r', newline='') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            m = collections.OrderedDict()
-            m['library_id'] = row['sample']
-            if row['date'] == 'NA':
-                m['collection_date'] = None
-            else:
-                collection_date = date.fromisoformat(row['date'])
-                m['collection_date'] = collection_date
-            if row['ct'] == 'NA':
-                m['ct_value'] = None
-            else:
-                m['ct_value'] = row['ct']
-            metadata_records.append(m)
-
-    return metadata_records
-
-
-def store_metadata_records(session, metadata_records, force_update=False):
-    for idx, metadata_record in enumerate(metadata_records):
-        container_id = metadata_record['library_id'].split('-')[0]
-
-        existing_container = (
-            session.query(models.Container)
-            .filter(models.Container.id == container_id)
-            .one_or_none()
-        )
-
-        if existing_container is not None and existing_container.collection_date is None:
-            existing_container.collection_date = metadata_record['collection_date']
-        elif existing_container is not None and force_update:
-            existing_container.collection_date = metadata_record['collection_date']
-            session.commit()
-        elif existing_container is None:
-            if not (container_id.startswith('NEG') or container_id.startswith('POS')):
-                container = models.Container()
-                container.id = container_id
-                container.collection_date = metadata_record['collection_date']
-
-                session.add(container)
-
-        existing_qpcr_result = (
-            session.query(models.QpcrResult)
-            .filter(models.QpcrResult.container_id == container_id)
-            .one_or_none()
-        )
-
-        if existing_qpcr_result is not None and existing_qpcr_result.ct_value is None:
-            existing_qpcr_result.ct_value = metadata_record['ct_value']
-        elif existing_qpcr_result is None:
-            if not (metadata_record['library_id'].startswith('NEG') or metadata_record['library_id'].startswith('POS')):
-                qpcr_result = models.QpcrResult()
-                qpcr_result.container_id = container_id
-                qpcr_result.ct_value = metadata_record['ct_value']
-
-                session.add(qpcr_result)
-        
-        if idx % 1000 == 0:
-            session.flush()
-
-    session.commit()
-
-    return None
-    
 
-def main(args, kwargs=None):
+def parse_metadata_tsv(metadata_tsv_path):
+    field_names = [name for name, column, converter in METADATA_FIELDS]
+
+    for values in tsv.decode_rows(metadata_tsv_path, METADATA_FIELDS):
+        m = dict(zip(field_names, values))
+
+        yield m
+
+
+STAGING_TABLE = 'metadata_staging'
+
+CREATE_STAGING_TABLE = """
+CREATE TEMP TABLE {} (
+    container_id TEXT PRIMARY KEY,
+    is_control INTEGER NOT NULL,
+    collection_date DATE,
+    ct_value FLOAT,
+    num_records INTEGER NOT NULL,
+    container_inserted INTEGER NOT NULL DEFAULT 0,
+    container_updated INTEGER NOT NULL DEFAULT 0,
+    qpcr_result_inserted INTEGER NOT NULL DEFAULT 0,
+    qpcr_result_updated INTEGER NOT NULL DEFAULT 0
+)
+""".format(STAGING_TABLE)
+
+# Repeated containers are merged as they're staged: the first non-null
+# collection date and ct value are kept (or the last collection date, with
+# force_update), as they would be by loading the records one at a time.
+STAGE_RECORDS = """
+INSERT INTO {0} (container_id, is_control, collection_date, ct_value, num_records)
+VALUES (?, ?, ?, ?, 1)
+ON CONFLICT (container_id) DO UPDATE SET
+    collection_date = CASE WHEN ? THEN excluded.collection_date ELSE coalesce({0}.collection_date, excluded.collection_date) END,
+    ct_value = coalesce({0}.ct_value, excluded.ct_value),
+    num_records = {0}.num_records + 1
+""".format(STAGING_TABLE)
+
+FLAG_STAGED_RECORDS = [
+    """
+    UPDATE {0} SET container_inserted = 1
+    WHERE NOT is_control
+      AND NOT EXISTS (SELECT 1 FROM container WHERE container.id = {0}.container_id)
+    """,
+    """
+    UPDATE {0} SET container_updated = 1
+    FROM container
+    WHERE container.id = {0}.container_id
+      AND (container.collection_date IS NULL OR :force_update)
+    """,
+    """
+    UPDATE {0} SET qpcr_result_inserted = 1
+    WHERE NOT is_control
+      AND NOT EXISTS (SELECT 1 FROM qpcr_result WHERE qpcr_result.container_id = {0}.container_id)
+    """,
+    """
+    UPDATE {0} SET qpcr_result_updated = 1
+    FROM qpcr_result
+    WHERE qpcr_result.container_id = {0}.container_id
+      AND qpcr_result.ct_value IS NULL
+    """,
+]
+
+MERGE_STAGED_RECORDS = [
+    """
+    INSERT INTO container (id, collection_date)
+    SELECT container_id, collection_date FROM {0}
+    WHERE container_inserted
+    """,
+    """
+    UPDATE container SET collection_date = {0}.collection_date
+    FROM {0}
+    WHERE {0}.container_id = container.id
+      AND {0}.container_updated
+    """,
+    """
+    INSERT INTO qpcr_result (container_id, ct_value)
+    SELECT container_id, ct_value FROM {0}
+    WHERE qpcr_result_inserted
+    """,
+    """
+    UPDATE qpcr_result SET ct_value = {0}.ct_value
+    FROM {0}
+    WHERE {0}.container_id = qpcr_result.container_id
+      AND {0}.qpcr_result_updated
+    """,
+]
+
+COUNT_STAGED_RECORDS = """
+SELECT
+    container_id,
+    num_records,
+    container_inserted OR qpcr_result_inserted,
+    container_updated OR qpcr_result_updated
+FROM {}
+""".format(STAGING_TABLE)
+
+
+def stage_metadata_records(connection, metadata_records, force_update, batch_size):
+    for batch in bulk.batched(metadata_records, batch_size):
+        rows = []
+        for metadata_record in batch:
+            collection_date = metadata_record['collection_date']
+            rows.append((
+                metadata_record['library_id'].split('-')[0],
+                entities.is_control(metadata_record['library_id']),
+                None if collection_date is None else collection_date.isoformat(),
+                metadata_record['ct_value'],
+                force_update,
+            ))
+        connection.exec_driver_sql(STAGE_RECORDS, rows)
+
+
+def store_metadata_records(session, metadata_records, force_update=False, batch_size=1000):
+    """
+    Copy the metadata records into a temporary staging table, then add new
+    containers and qPCR results with one INSERT ... SELECT each, and fill in
+    missing collection dates and ct values (or overwrite collection dates,
+    with force_update) with one UPDATE ... FROM each.
+    When a container is repeated in the file, only its first record is
+    counted as inserted or updated.
+    """
+    entity_cache = entities.get_entity_cache(session)
+    counts = {
+        'parsed': 0,
+        'inserted': 0,
+        'updated': 0,
+        'skipped': 0,
+    }
+
+    session.flush()
+    connection = session.connection()
+    connection.exec_driver_sql('DROP TABLE IF EXISTS temp.{}'.format(STAGING_TABLE))
+    connection.exec_driver_sql(CREATE_STAGING_TABLE)
+    try:
+        stage_metadata_records(connection, metadata_records, force_update, batch_size)
+        for statement in FLAG_STAGED_RECORDS:
+            connection.execute(sa.text(statement.format(STAGING_TABLE)), {'force_update': force_update})
+        for statement in MERGE_STAGED_RECORDS:
+            connection.exec_driver_sql(statement.format(STAGING_TABLE))
+
+        changed_container_ids = []
+        for container_id, num_records, inserted, updated in connection.exec_driver_sql(COUNT_STAGED_RECORDS):
+            counts['parsed'] += num_records
+            if inserted:
+                counts['inserted'] += 1
+            elif updated:
+                counts['updated'] += 1
+            counts['skipped'] += num_records - (1 if inserted or updated else 0)
+            if inserted or updated:
+                changed_container_ids.append(container_id)
+    finally:
+        connection.exec_driver_sql('DROP TABLE IF EXISTS temp.{}'.format(STAGING_TABLE))
+
+    entity_cache.containers.update(changed_container_ids)
+    rollups.mark_changed(session, container_ids=changed_container_ids)
+
+    # Containers and qPCR results already in the session may have been
+    # updated underneath it.
+    for instance in list(session.identity_map.values()):
+        if isinstance(instance, (models.Container, models.QpcrResult)):
+            session.expire(instance)
+
+    return counts
+
+
+def main(args, kwargs=None, session=None):
     if not args:    
         args = Args(**kwargs)
 
-    connection_string = "sqlite+pysqlite:///" + args.db
-    engine = sa.create_engine(connection_string)
-    Session = sao.sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
+    own_session = session is None
+    if own_session:
+        session = db.create_session(args.db)
 
     metadata_records = parse_metadata_tsv(args.metadata)
 
-    store_metadata_records(session, metadata_records, args.force_update)
+    counts = store_metadata_records(session, metadata_records, args.force_update, args.batch_size)
+
+    if own_session:
+        rollups.refresh_changed_rollups(session)
+        session.commit()
+        db.close_session(session)
+
+    return counts
 
 
 @dataclass
@@ -110,11 +212,13 @@ class Args:
     db: str
     metadata: str
     force_update: bool = False
+    batch_size: int = 1000
     
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('metadata')
     parser.add_argument('--db', required=True)
     parser.add_argument('--force-update', action='store_true')
+    parser.add_argument('--batch-size', default=1000, type=int)
     args = parser.parse_args()
     main(args)
@@ -1,229 +1,211 @@
 #!/usr/bin/env python
 
 import argparse
-import collections
-import csv
-import json
-import os
+import functools
 import re
-import sys
 
 from dataclasses import dataclass
-from datetime import date
 
 import sqlalchemy as sa
-import sqlalchemy.orm as sao
 
+import ncov_db.bulk as bulk
+import ncov_db.db as db
+import ncov_db.entities as entities
 import ncov_db.models as models
+import ncov_db.mutation_index as mutation_index
+import ncov_db.rollups as rollups
+import ncov_db.tsv as tsv
+
+
+AMINO_ACID_MUTATION_FIELDS = [
+    ('library_id',                  'sample',      None),
+    ('ref_accession',               'chr',         None),
+    ('nucleotide_position',         'pos',         tsv.to_int),
+    ('ref_allele',                  'ref',         None),
+    ('alt_allele',                  'alt',         None),
+    ('consequence',                 'Consequence', None),
+    ('gene',                        'gene',        None),
+    ('amino_acid_change',           'protein',     tsv.null_if({''})),
+    ('mutation_name_by_amino_acid', 'aa',          tsv.null_if({'NA'})),
+]
+
+
+AMINO_ACID_MUTATION_COLUMNS = [
+    'library_id',
+    'ref_accession',
+    'nucleotide_position',
+    'ref_allele',
+    'alt_allele',
+    'consequence',
+    'gene',
+    'ref_amino_acid',
+    'alt_amino_acid',
+    'codon_position',
+    'mutation_name_by_amino_acid',
+]
+
+AMINO_ACID_MUTATION_KEY = ['library_id', 'ref_accession', 'nucleotide_position', 'ref_allele', 'alt_allele']
+
+# Most protein changes look like 'D614G': reference amino acid(s), codon
+# position, alternate amino acid(s). Anything else (eg. 'ins214EPE',
+# 'Q9*') falls back to finding each part separately.
+AMINO_ACID_CHANGE_PATTERN = re.compile('^([A-Z]+)([0-9]+)([A-Z]+)$')
+REF_AMINO_ACID_PATTERN = re.compile('^[A-Z]+')
+CODON_POSITION_PATTERN = re.compile('[0-9]+')
+ALT_AMINO_ACID_PATTERN = re.compile('[A-Z]+$')
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_amino_acid_change(amino_acid_change):
+    """
+    Return (ref_amino_acid, codon_position, alt_amino_acid) for a protein
+    change like 'D614G', with None for any part that isn't present.
+    """
+    match = AMINO_ACID_CHANGE_PATTERN.match(amino_acid_change)
+    if match:
+        return match.group(1), int(match.group(2)), match.group(3)
+
+    ref_aa_match = REF_AMINO_ACID_PATTERN.search(amino_acid_change)
+    codon_position_match = CODON_POSITION_PATTERN.search(amino_acid_change)
+    alt_aa_match = ALT_AMINO_ACID_PATTERN.search(amino_acid_change)
+    return (
+        ref_aa_match.group(0) if ref_aa_match else None,
+        int(codon_position_match.group(0)) if codon_position_match else None,
+        alt_aa_match.group(0) if alt_aa_match else None,
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_gene(gene):
+    return gene.replace('orf', 'ORF')
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_mutation_name(mutation_name_by_amino_acid):
+    return mutation_name_by_amino_acid.replace('-', ':').replace('orf', 'ORF')
 
 
-def library_id_to_container_id(library_id):
-    container_id = None
-    if not (library_id.startswith('POS') or library_id.startswith('NEG')):
-        container_id = library_id.split('-')[0]
-    return container_id
-
-
-def library_id_to_container_obj(library_id):
-    container_obj = models.Container()
-    container_obj.container_id = library_id_to_container_id(library_id)
-    return container_obj
-
-
-def library_id_to_library_obj(library_id):
-    library = {}
-    library_id_components = library_id.split('-')
-
-    library['library_id'] = library_id
-    if library_id.startswith('POS'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['plate_well'] = 'G12'
-    elif library_id.startswith('NEG'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['plate_well'] = 'H12'
-    else:
-        library['container_id'] = library_id_components[0]
-        library['library_plate_id'] = library_id_components[1]
-        library['index_set_id'] = library_id_components[2]
-        library['plate_well'] = library_id_components[3]
-    library['plate_row'] = library['plate_well'][0]
-    library['plate_col'] = int(library['plate_well'][-2:])
-    
-    library_obj = models.Library()
-    for key in library.keys():
-        setattr(library_obj, key, library[key])
+def parse_amino_acid_mutation_tsv(amino_acid_mutation_tsv_path):
+    """
+    Yield one dict per row of an ncov-tools amino acid table, with the
+    protein change split into reference amino acid, codon position and
+    alternate amino acid (not for deletions).
+    """
+    for values in tsv.decode_rows(amino_acid_mutation_tsv_path, AMINO_ACID_MUTATION_FIELDS):
+        library_id, ref_accession, nucleotide_position, ref_allele, alt_allele, consequence, gene, amino_acid_change, mutation_name_by_amino_acid = values
+
+        if amino_acid_change and 'deletion' not in consequence:
+            ref_amino_acid, codon_position, alt_amino_acid = parse_amino_acid_change(amino_acid_change)
+        else:
+            ref_amino_acid, codon_position, alt_amino_acid = None, None, None
+
+        yield {
+            'library_id': library_id,
+            'ref_accession': ref_accession,
+            'nucleotide_position': nucleotide_position,
+            'ref_allele': ref_allele,
+            'alt_allele': alt_allele,
+            'consequence': consequence,
+            'gene': None if gene is None else normalize_gene(gene),
+            'ref_amino_acid': ref_amino_acid,
+            'alt_amino_acid': alt_amino_acid,
+            'codon_position': codon_position,
+            'mutation_name_by_amino_acid': None if mutation_name_by_amino_acid is None else normalize_mutation_name(mutation_name_by_amino_acid),
+        }
+
+
+def existing_amino_acid_mutation_keys(session, library_ids):
+    """
+    Return the set of AMINO_ACID_MUTATION_KEY tuples of the mutations
+    already stored for `library_ids`.
+    """
+    amino_acid_mutation = models.NcovToolsAminoAcidMutation.__table__
+    query = (
+        sa.select(*[amino_acid_mutation.c[column] for column in AMINO_ACID_MUTATION_KEY])
+        .where(amino_acid_mutation.c.library_id.in_(sorted(library_ids)))
+    )
+    return set(tuple(row) for row in session.execute(query))
+
+
+def store_amino_acid_mutations(session, amino_acid_mutations, batch_size=1000):
+    """
+    Store the mutations that aren't in the database yet. The keys of the
+    existing mutations are read once for each batch's new libraries, and
+    the rest of the batch is bulk-inserted.
+    """
+    entity_cache = entities.get_entity_cache(session)
+    amino_acid_mutation_table = models.NcovToolsAminoAcidMutation.__table__
+    counts = {
+        'parsed': 0,
+        'inserted': 0,
+        'skipped': 0,
+    }
 
-    return library_obj
+    known_library_ids = set()
+    known_keys = set()
 
+    for batch in bulk.batched(amino_acid_mutations, batch_size):
+        new_library_ids = set(m['library_id'] for m in batch) - known_library_ids
+        if new_library_ids:
+            known_keys.update(existing_amino_acid_mutation_keys(session, new_library_ids))
+            known_library_ids.update(new_library_ids)
 
-def parse_amino_acid_mutation_tsv(amino_acid_mutation_tsv_path):
+        new_mutations = []
+        for m in batch:
+            key = (m['library_id'], m['ref_accession'], m['nucleotide_position'], m['ref_allele'], m['alt_allele'])
+            if key in known_keys:
+                counts['skipped'] += 1
+            else:
+                known_keys.add(key)
+                new_mutations.append(m)
+        counts['parsed'] += len(batch)
 
-    field_translation = {
-        'sample': 'library_id',
-        'chr': 'ref_accession',
-        'pos': 'nucleotide_position',
-        'ref': 'ref_allele',
-        'alt': 'alt_allele',
-        'Consequence': 'consequence',
-        'gene': 'gene',
-        'protein': 'amino_acid_change',
-        'aa': 'mutation_name_by_amino_acid',
-    }
+        inserted_library_ids = set(m['library_id'] for m in new_mutations)
+        entity_cache.ensure_libraries(inserted_library_ids)
 
-    int_fields = [
-        'nucleotide_position',
-    ]
-
-    na_null_fields = [
-        'mutation_name_by_amino_acid',
-    ]
-
-    empty_null_fields = [
-        'amino_acid_change',
-    ]
-
-    aa_mutations = []
-
-    with open(amino_acid_mutation_tsv_path, 'r', newline='') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            m = collections.OrderedDict()
-            for k, v in field_translation.items():
-                m[v] = row[k]
-
-            for f in int_fields:
-                m[f] = int(m[f])
-
-            for f in na_null_fields:
-                if m[f] == 'NA':
-                    m[f] = None
-
-            for f in empty_null_fields:
-                if m[f] == '':
-                    m[f] = None
-
-            if m['amino_acid_change'] and not re.search('deletion', m['consequence']):
-                ref_aa_match = re.search('^[A-Z]+', m['amino_acid_change'])
-                if ref_aa_match:
-                    m['ref_amino_acid'] = ref_aa_match.group(0)
-                else:
-                    m['ref_amino_acid'] = None
-                codon_position_match = re.search('[0-9]+', m['amino_acid_change'])
-                if codon_position_match:
-                    m['codon_position'] = int(codon_position_match.group(0))
-                else:
-                    m['codon_position'] = None
-                alt_aa_match = re.search('[A-Z]+$', m['amino_acid_change'])
-                if alt_aa_match:
-                    m['alt_amino_acid'] = alt_aa_match.group(0)
-                else:
-                    m['alt_amino_acid'] = None
-            else:
-                m['ref_amino_acid'] = None
-                m['codon_position'] = None
-                m['alt_amino_acid'] = None
-
-            m.pop('amino_acid_change')
-
-            if m['gene'] is not None:
-                m['gene'] = m['gene'].replace('orf', 'ORF')
-
-            if m['mutation_name_by_amino_acid'] is not None:
-                m['mutation_name_by_amino_acid'] = m['mutation_name_by_amino_acid'].replace('-', ':').replace('orf', 'ORF')
-            
-            aa_mutation_obj = models.NcovToolsAminoAcidMutation()
-            for key in m.keys():
-                setattr(aa_mutation_obj, key, m[key])
-                aa_mutations.append(aa_mutation_obj)
-
-    return aa_mutations
-
-
-def store_amino_acid_mutations(session, amino_acid_mutations):
-    for idx, amino_acid_mutation in enumerate(amino_acid_mutations):
-        container_id = library_id_to_container_id(amino_acid_mutation.library_id)
-        if container_id:
-            existing_container = (
-                session.query(models.Container)
-                .filter(
-                    sa.and_(
-                        models.Container.id == container_id
-                    )
-                )
-                .one_or_none()
-            )
-
-            if existing_container is None:
-                new_container = library_id_to_container_obj(amino_acid_mutation.library_id)
-                session.add(new_container)
-                session.commit()
-    
-        existing_library = (
-            session.query(models.Library)
-            .filter(
-                sa.and_(
-                    models.Library.id == amino_acid_mutation.library_id
-                )
-            )
-            .one_or_none()
-        )
-
-        if existing_library is None:
-            new_library = library_id_to_library_obj(amino_acid_mutation.library_id)
-            session.add(new_library)
-            session.commit()
-
-        existing_amino_acid_mutation = (
-            session.query(models.NcovToolsAminoAcidMutation)
-            .filter(
-                sa.and_(
-                    models.NcovToolsAminoAcidMutation.library_id == amino_acid_mutation.library_id,
-                    models.NcovToolsAminoAcidMutation.ref_accession == amino_acid_mutation.ref_accession,
-                    models.NcovToolsAminoAcidMutation.nucleotide_position == amino_acid_mutation.nucleotide_position,
-                    models.NcovToolsAminoAcidMutation.ref_allele == amino_acid_mutation.ref_allele,
-                    models.NcovToolsAminoAcidMutation.alt_allele == amino_acid_mutation.alt_allele,
-                )
-            )
-            .one_or_none()
-        )
-    
-        if existing_amino_acid_mutation is None:
-            session.add(amino_acid_mutation)
-            if idx % 1000 == 0:
-                session.flush()
+        rows = [tuple(m[column] for column in AMINO_ACID_MUTATION_COLUMNS) for m in new_mutations]
+        batch_counts = bulk.insert_ignore_duplicates(session, amino_acid_mutation_table, AMINO_ACID_MUTATION_COLUMNS, rows)
+        counts['inserted'] += batch_counts['inserted']
+        counts['skipped'] += batch_counts['skipped']
 
-    session.commit()
+        rollups.mark_changed(session, library_ids=inserted_library_ids)
+        mutation_index.mark_changed(session, inserted_library_ids)
 
-    return None
+    return counts
     
 
-def main(args, kwargs=None):
+def main(args, kwargs=None, session=None):
 
     if not args:
         args = Args(**kwargs)
 
-    connection_string = "sqlite+pysqlite:///" + args.db
-    engine = sa.create_engine(connection_string)
-    Session = sao.sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
+    own_session = session is None
+    if own_session:
+        session = db.create_session(args.db)
 
     aa_mutations = parse_amino_acid_mutation_tsv(args.ncov_tools_aa_table)
 
-    
-    store_amino_acid_mutations(session, aa_mutations)
+    counts = store_amino_acid_mutations(session, aa_mutations, args.batch_size)
+
+    if own_session:
+        rollups.refresh_changed_rollups(session)
+        mutation_index.update_changed(session)
+        session.commit()
+        db.close_session(session)
+
+    return counts
 
 
 @dataclass
 class Args:
     db: str
     ncov_tools_aa_table: str
+    batch_size: int = 1000
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('ncov_tools_aa_table')
     parser.add_argument('--db', required=True)
+    parser.add_argument('--batch-size', default=1000, type=int)
     args = parser.parse_args()
     main(args)
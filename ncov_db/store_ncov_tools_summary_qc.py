@@ -2,230 +2,195 @@
 
 import argparse
 import collections
-import csv
 import json
 import os
-import sys
 
 from dataclasses import dataclass
-from datetime import date
 
 import sqlalchemy as sa
-import sqlalchemy.orm as sao
 
+import ncov_db.bulk as bulk
+import ncov_db.db as db
+import ncov_db.entities as entities
 import ncov_db.models as models
+import ncov_db.rollups as rollups
+import ncov_db.tsv as tsv
 
+from ncov_db.time import now
 
-def sequencing_run_id_to_run_date(sequencing_run_id):
-    run_id_date_string = sequencing_run_id.split('_')[0]
-    year = '20' + run_id_date_string[0:2]
-    month = run_id_date_string[2:4]
-    day = run_id_date_string[4:6]
-    iso8601_date_string = year + '-' + month + '-' + day
-    run_date = date.fromisoformat(iso8601_date_string)
-    return run_date
-
-
-def sequencing_run_id_to_sequencing_run_obj(sequencing_run_id):
-    sequencing_run_obj = models.SequencingRun()
-    sequencing_run_obj.id = sequencing_run_id
-    sequencing_run_obj.run_date = sequencing_run_id_to_run_date(sequencing_run_id)
-    sequencing_run_obj.instrument_id = sequencing_run_id.split('_')[1]
-    if sequencing_run_obj.instrument_id.startswith('M'):
-        sequencing_run_obj.platform = 'MISEQ'
-    elif sequencing_run_obj.instrument_id.startswith('V'):
-        sequencing_run_obj.platform = 'NEXTSEQ'
-    return sequencing_run_obj
-
-
-def library_id_to_container_id(library_id):
-    container_id = None
-    if not (library_id.startswith('POS') or library_id.startswith('NEG')):
-        container_id = library_id.split('-')[0]
-    return container_id
-
-
-def library_id_to_container_obj(library_id):
-    container_obj = models.Container()
-    container_obj.container_id = library_id_to_container_id(library_id)
-    return container_obj
-
-
-def library_id_to_library_obj(library_id):
-    library = {}
-    library_id_components = library_id.split('-')
-
-    library['library_id'] = library_id
-    if library_id.startswith('POS'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['plate_well'] = 'G12'
-    elif library_id.startswith('NEG'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['plate_well'] = 'H12'
-    else:
-        library['container_id'] = library_id_components[0]
-        library['library_plate_id'] = library_id_components[1]
-        library['index_set_id'] = library_id_components[2]
-        library['plate_well'] = library_id_components[3]
-    library['plate_row'] = library['plate_well'][0]
-    library['plate_col'] = int(library['plate_well'][-2:])
-    
-    library_obj = models.Library()
-    for key in library.keys():
-        setattr(library_obj, key, library[key])
 
-    return library_obj
+QC_SUMMARY_FIELDS = [
+    ('library_id',                 'sample',                     None),
+    ('sequencing_run_id',          'run_name',                   None),
+    ('qc_flags',                   'qc_pass',                    None),
+    ('num_consensus_snvs',         'num_consensus_snvs',         tsv.to_int),
+    ('num_consensus_n',            'num_consensus_n',            tsv.to_int),
+    ('num_consensus_iupac',        'num_consensus_iupac',        tsv.to_int),
+    ('num_variants_snvs',          'num_variants_snvs',          tsv.to_int),
+    ('num_variants_indel',         'num_variants_indel',         tsv.to_int),
+    ('num_variants_indel_triplet', 'num_variants_indel_triplet', tsv.to_int),
+    ('median_sequencing_depth',    'median_sequencing_depth',    tsv.to_int),
+    ('mean_sequencing_depth',      'mean_sequencing_depth',      tsv.to_float),
+    ('genome_completeness',        'genome_completeness',        tsv.to_float),
+]
+
+QC_FAIL_FLAGS = {'INCOMPLETE_GENOME', 'PARTIAL_GENOME'}
+
 
 def parse_qc_summary_tsv(qc_summary_tsv_path):
+    """
+    Yield a dict for each row of an ncov-tools summary QC report. A row that
+    can't be decoded (eg. 'NA' in an integer column) is logged as a
+    loading_error and skipped, and the rest of the file is still read.
+    """
+    field_names = [name for name, column, converter in QC_SUMMARY_FIELDS]
 
-    int_fields = [
-        'num_consensus_snvs',
-        'num_consensus_n',
-        'num_consensus_iupac',
-        'num_variants_snvs',
-        'num_variants_indel',
-        'num_variants_indel_triplet',
-        'median_sequencing_depth',
-    ]
-
-    float_fields = [
-        'mean_sequencing_depth',
-        'genome_completeness',
-    ]
-    
-    qc_summaries = []
-
-    with open(qc_summary_tsv_path, 'r', newline='') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            q = collections.OrderedDict()
-            q['library_id'] = row['sample']
-            q['sequencing_run_id'] = row['run_name']
-            qc_flags = row['qc_pass'].split(',')
-
-            q['qc_flags'] = row['qc_pass']
-            q['qc_pass'] = True
-            if 'INCOMPLETE_GENOME' in qc_flags:
-                q['qc_pass'] = False
-            if 'PARTIAL_GENOME' in qc_flags:
-                q['qc_pass'] = False
-
-            for f in int_fields:
-                q[f] = int(row[f])
-            for f in float_fields:
-                q[f] = float(row[f])
-            
-            qc_summary_obj = models.NcovToolsSummaryQC()
-            for key in q.keys():
-                setattr(qc_summary_obj, key, q[key])
-
-            qc_summaries.append(qc_summary_obj)
-
-    return qc_summaries
-
-
-def store_sequencing_run(session, sequencing_run_id):
-    existing_run = (
-        session.query(models.SequencingRun)
-        .filter(
-            models.SequencingRun.id == sequencing_run_id
-        )
-        .one_or_none()
-    )
+    def log_invalid_row(row, error):
+        log_loading_error(qc_summary_tsv_path, row.get('sample'), row.get('run_name'), error)
 
-    if existing_run is None:
-        new_sequencing_run = sequencing_run_id_to_sequencing_run_obj(sequencing_run_id)
-        session.add(new_sequencing_run)
-        session.commit()
+    for values in tsv.decode_rows(qc_summary_tsv_path, QC_SUMMARY_FIELDS, on_error=log_invalid_row):
+        q = dict(zip(field_names, values))
 
+        if q['qc_flags'] is None:
+            log_loading_error(qc_summary_tsv_path, q['library_id'], q['sequencing_run_id'], 'missing qc_pass column')
+            continue
+        qc_flags = q['qc_flags'].split(',')
+        q['qc_pass'] = QC_FAIL_FLAGS.isdisjoint(qc_flags)
 
-def store_qc_summary(session, qc_summary):
-    container_id = library_id_to_container_id(qc_summary.library_id)
-    if container_id:
-        existing_container = (
-            session.query(models.Container)
-            .filter(
-                sa.and_(
-                    models.Container.id == container_id
-                )
-            )
-            .one_or_none()
-        )
-
-        if existing_container is None:
-            new_container = library_id_to_container_obj(qc_summary.library_id)
-            session.add(new_container)
-            session.commit()
-    
-    existing_library = (
-        session.query(models.Library)
-        .filter(
-            sa.and_(
-                models.Library.id == qc_summary.library_id
-            )
-        )
-        .one_or_none()
-    )
+        yield q
 
-    if existing_library is None:
-        new_library = library_id_to_library_obj(qc_summary.library_id)
-        session.add(new_library)
-        session.commit()
 
-    existing_qc_summary = (
-        session.query(models.NcovToolsSummaryQC)
-        .filter(
-            sa.and_(
-                models.NcovToolsSummaryQC.sequencing_run_id == qc_summary.sequencing_run_id,
-                models.NcovToolsSummaryQC.library_id == qc_summary.library_id
-            )
-        )
-        .one_or_none()
-    )
-    
-    if existing_qc_summary is not None:
-        return None
-    else:
-        session.add(qc_summary)
-        session.commit()
+QC_SUMMARY_COLUMNS = [name for name, column, converter in QC_SUMMARY_FIELDS] + ['qc_pass']
 
-    return None
+
+def existing_qc_summary_library_ids(session, sequencing_run_id):
+    ncov_tools_summary_qc = models.NcovToolsSummaryQC.__table__
+    query = (
+        sa.select(ncov_tools_summary_qc.c.library_id)
+        .where(ncov_tools_summary_qc.c.sequencing_run_id == sequencing_run_id)
+    )
+    return set(session.execute(query).scalars())
+
+
+def log_loading_error(input_file, library_id, sequencing_run_id, error):
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'loading_error'
+    if input_file is not None:
+        log_msg['input_file'] = os.path.abspath(input_file)
+    log_msg['input_data_details'] = {
+        'library_id': library_id,
+        'sequencing_run_id': sequencing_run_id,
+    }
+    log_msg['error'] = str(getattr(error, 'orig', error))
+    print(json.dumps(log_msg))
+
+
+def insert_qc_summaries(session, qc_summaries):
+    """
+    Insert qc_summaries (already decoded and validated by
+    parse_qc_summary_tsv) in a savepoint. If any of them violates a
+    constraint, insert them again one at a time, each in its own savepoint,
+    logging a loading_error for the ones that fail instead of aborting the
+    rest of the file. Rolling back a savepoint doesn't drop the session's
+    caches or the record of changed rollups.
+    Returns the QC summaries that were inserted.
+    """
+    if not qc_summaries:
+        return []
+
+    ncov_tools_summary_qc = models.NcovToolsSummaryQC.__table__
+    rows = [tuple(q[column] for column in QC_SUMMARY_COLUMNS) for q in qc_summaries]
+    try:
+        with session.begin_nested():
+            bulk.insert_ignore_duplicates(session, ncov_tools_summary_qc, QC_SUMMARY_COLUMNS, rows)
+        return qc_summaries
+    except sa.exc.IntegrityError:
+        pass
+
+    inserted = []
+    for qc_summary, row in zip(qc_summaries, rows):
+        try:
+            with session.begin_nested():
+                bulk.insert_ignore_duplicates(session, ncov_tools_summary_qc, QC_SUMMARY_COLUMNS, [row])
+        except sa.exc.IntegrityError as e:
+            log_loading_error(None, qc_summary['library_id'], qc_summary['sequencing_run_id'], e)
+            continue
+        inserted.append(qc_summary)
+
+    return inserted
+
+
+def store_qc_summaries(session, qc_summaries, batch_size=1000):
+    """
+    Store the QC summaries that aren't in the database yet, without
+    committing: the caller commits once for the whole file (or run). The
+    libraries already summarized are read once per run, and parent runs and
+    libraries are added in bulk through the entity cache.
+    """
+    entity_cache = entities.get_entity_cache(session)
+    counts = {
+        'parsed': 0,
+        'inserted': 0,
+        'skipped': 0,
+    }
+
+    # Library IDs with a QC summary, for each run seen so far.
+    known_library_ids = {}
+
+    for batch in bulk.batched(qc_summaries, batch_size):
+        for sequencing_run_id in set(q['sequencing_run_id'] for q in batch) - set(known_library_ids):
+            known_library_ids[sequencing_run_id] = existing_qc_summary_library_ids(session, sequencing_run_id)
+
+        new_qc_summaries = []
+        for q in batch:
+            run_library_ids = known_library_ids[q['sequencing_run_id']]
+            if q['library_id'] not in run_library_ids:
+                run_library_ids.add(q['library_id'])
+                new_qc_summaries.append(q)
+        counts['parsed'] += len(batch)
+
+        entity_cache.ensure_sequencing_runs(q['sequencing_run_id'] for q in new_qc_summaries)
+        entity_cache.ensure_libraries(q['library_id'] for q in new_qc_summaries)
+
+        inserted = insert_qc_summaries(session, new_qc_summaries)
+        rollups.mark_changed(session, sequencing_run_ids=set(q['sequencing_run_id'] for q in inserted))
+        counts['inserted'] += len(inserted)
+        counts['skipped'] += len(batch) - len(inserted)
+
+    return counts
     
 
-def main(args, kwargs):
+def main(args, kwargs=None, session=None):
     if not args:
         args = Args(**kwargs)
 
-    connection_string = "sqlite+pysqlite:///" + args.db
-    engine = sa.create_engine(connection_string)
-    Session = sao.sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
+    own_session = session is None
+    if own_session:
+        session = db.create_session(args.db)
 
     qc_summaries = parse_qc_summary_tsv(args.qc_summary)
 
-    sequencing_run_ids = set()
+    counts = store_qc_summaries(session, qc_summaries, args.batch_size)
 
-    for qc_summary in qc_summaries:
-        sequencing_run_ids.add(qc_summary.sequencing_run_id)
-
-    for sequencing_run_id in sequencing_run_ids:
-        store_sequencing_run(session, sequencing_run_id)
+    if own_session:
+        rollups.refresh_changed_rollups(session)
+        session.commit()
+        db.close_session(session)
 
-    for qc_summary in qc_summaries:
-        store_qc_summary(session, qc_summary)
+    return counts
 
 
 @dataclass
 class Args:
     db: str
     qc_summary: str
+    batch_size: int = 1000
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('qc_summary')
     parser.add_argument('--db', required=True)
+    parser.add_argument('--batch-size', default=1000, type=int)
     args = parser.parse_args()
     main(args)
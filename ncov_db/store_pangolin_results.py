@@ -1,235 +1,202 @@
 #!/usr/bin/env python
 
 import argparse
-import collections
-import csv
-from datetime import date
-import json
-import os
-import sys
 
 import sqlalchemy as sa
-import sqlalchemy.orm as sao
 
+import ncov_db.bulk as bulk
+import ncov_db.db
+import ncov_db.dictionaries as dictionaries
+import ncov_db.entities as entities
 import ncov_db.models as models
+import ncov_db.profiling as profiling
+import ncov_db.tsv as tsv
 
 
 
-def sequencing_run_id_to_run_date(sequencing_run_id):
-    run_id_date_string = sequencing_run_id.split('_')[0]
-    year = '20' + run_id_date_string[0:2]
-    month = run_id_date_string[2:4]
-    day = run_id_date_string[4:6]
-    iso8601_date_string = year + '-' + month + '-' + day
-    run_date = date.fromisoformat(iso8601_date_string)
-    return run_date
+empty = tsv.null_if({''})
+empty_float = tsv.null_if({''}, tsv.to_float)
 
+PANGOLIN_FIELDS = [
+    ('sequencing_run_id',  'run_id',             empty),
+    ('library_id',         'sample_id',          empty),
+    ('lineage',            'lineage',            empty),
+    ('conflict',           'conflict',           empty_float),
+    ('ambiguity_score',    'ambiguity_score',    empty_float),
+    ('scorpio_call',       'scorpio_call',       empty),
+    ('scorpio_support',    'scorpio_support',    empty_float),
+    ('scorpio_conflict',   'scorpio_conflict',   empty_float),
+    ('version',            'version',            empty),
+    ('pangolin_version',   'pangolin_version',   empty),
+    ('pangolearn_version', 'pangoLEARN_version', empty),
+    ('pango_version',      'pango_version',      empty),
+    ('status',             'status',             empty),
+    ('note',               'note',               empty),
+]
 
-def sequencing_run_id_to_sequencing_run_obj(sequencing_run_id):
-    sequencing_run_obj = models.SequencingRun()
-    sequencing_run_obj.sequencing_run_id = sequencing_run_id
-    sequencing_run_obj.run_date = sequencing_run_id_to_run_date(sequencing_run_id)
-    sequencing_run_obj.instrument_id = sequencing_run_id.split('_')[1]
-    if sequencing_run_obj.instrument_id.startswith('M'):
-        sequencing_run_obj.platform = 'MISEQ'
-    elif sequencing_run_obj.instrument_id.startswith('V'):
-        sequencing_run_obj.platform = 'NEXTSEQ'
-    return sequencing_run_obj
 
+def parse_pangolin_results(pangolin_results_path):
+    field_names = [name for name, column, converter in PANGOLIN_FIELDS]
+
+    for values in tsv.decode_rows(pangolin_results_path, PANGOLIN_FIELDS, delimiter=','):
+        p = dict(zip(field_names, values))
+
+        yield p
+
+
+PANGOLIN_RESULT_KEY = ['sequencing_run_id', 'library_id', 'version', 'pangolin_version', 'pangolearn_version', 'pango_version']
+
+PANGOLIN_VERSION_COLUMNS = ['version', 'pangolin_version', 'pangolearn_version', 'pango_version']
+
+# Columns of pangolin_result_encoded, where library_id and the four
+# versions are replaced by dictionary IDs.
+PANGOLIN_RESULT_ENCODED_COLUMNS = [
+    'sequencing_run_id',
+    'library_key',
+    'lineage',
+    'conflict',
+    'ambiguity_score',
+    'scorpio_call',
+    'scorpio_support',
+    'scorpio_conflict',
+    'pangolin_version_id',
+    'status',
+    'note',
+]
+
+
+def existing_pangolin_result_keys(session, sequencing_run_id):
+    """
+    Return the set of PANGOLIN_RESULT_KEY tuples of the results already
+    stored for `sequencing_run_id`.
+    """
+    pangolin_result = models.PangolinResult.__table__
+    query = (
+        sa.select(*[pangolin_result.c[column] for column in PANGOLIN_RESULT_KEY])
+        .where(pangolin_result.c.sequencing_run_id == sequencing_run_id)
+    )
+    return set(tuple(row) for row in session.execute(query))
+
+
+def encode_pangolin_results(session, pangolin_results):
+    """
+    Return a pangolin_result_encoded row tuple for each of pangolin_results,
+    adding new libraries and versions to their dictionaries.
+    """
+    dictionary_cache = dictionaries.get_dictionary_cache(session)
+    library_keys = dictionary_cache.libraries.ids(p['library_id'] for p in pangolin_results)
+    pangolin_version_ids = dictionary_cache.pangolin_versions.ids(tuple(p[column] for column in PANGOLIN_VERSION_COLUMNS) for p in pangolin_results)
+
+    rows = []
+    for p in pangolin_results:
+        rows.append((
+            p['sequencing_run_id'],
+            library_keys[p['library_id']],
+            p['lineage'],
+            p['conflict'],
+            p['ambiguity_score'],
+            p['scorpio_call'],
+            p['scorpio_support'],
+            p['scorpio_conflict'],
+            pangolin_version_ids[tuple(p[column] for column in PANGOLIN_VERSION_COLUMNS)],
+            p['status'],
+            p['note'],
+        ))
+
+    return rows
+
+
+def store_pangolin_results(session, pangolin_results, batch_size=1000):
+    """
+    Store the results that aren't in the database yet. The keys of the
+    existing results are read once for each run in the input, and new
+    results are found by comparing against them in memory, so a report
+    covering many runs costs one query per run rather than one per row.
+    """
+    entity_cache = entities.get_entity_cache(session)
+    pangolin_result_table = models.PangolinResultEncoded.__table__
+    counts = {
+        'parsed': 0,
+        'inserted': 0,
+        'skipped': 0,
+    }
 
-def library_id_to_container_id(library_id):
-    container_id = None
-    if not (library_id.startswith('POS') or library_id.startswith('NEG')):
-        container_id = library_id.split('-')[0]
-    return container_id
+    # Key tuples of the results stored so far, for each run seen so far.
+    known_keys = {}
 
+    for batch in bulk.batched(pangolin_results, batch_size):
+        for sequencing_run_id in set(p['sequencing_run_id'] for p in batch) - set(known_keys):
+            known_keys[sequencing_run_id] = existing_pangolin_result_keys(session, sequencing_run_id)
 
-def library_id_to_container_obj(library_id):
-    container_obj = models.Container()
-    container_obj.container_id = library_id_to_container_id(library_id)
-    return container_obj
+        new_results = []
+        for p in batch:
+            key = tuple(p[column] for column in PANGOLIN_RESULT_KEY)
+            run_keys = known_keys[p['sequencing_run_id']]
+            if key in run_keys:
+                counts['skipped'] += 1
+            else:
+                run_keys.add(key)
+                new_results.append(p)
+        counts['parsed'] += len(batch)
 
+        entity_cache.ensure_sequencing_runs(p['sequencing_run_id'] for p in new_results)
+        entity_cache.ensure_libraries(p['library_id'] for p in new_results)
 
-def library_id_to_library_obj(library_id):
-    library = {}
-    library_id_components = library_id.split('-')
+        rows = encode_pangolin_results(session, new_results)
+        batch_counts = bulk.insert_ignore_duplicates(session, pangolin_result_table, PANGOLIN_RESULT_ENCODED_COLUMNS, rows)
+        counts['inserted'] += batch_counts['inserted']
+        counts['skipped'] += batch_counts['skipped']
 
-    library['library_id'] = library_id
-    if library_id.startswith('POS'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['plate_well'] = 'G12'
-    elif library_id.startswith('NEG'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['plate_well'] = 'H12'
-    else:
-        library['container_id'] = library_id_components[0]
-        library['library_plate_id'] = library_id_components[1]
-        library['index_set_id'] = library_id_components[2]
-        library['plate_well'] = library_id_components[3]
-    library['plate_row'] = library['plate_well'][0]
-    library['plate_col'] = int(library['plate_well'][-2:])
-    
-    library_obj = models.Library()
-    for key in library.keys():
-        setattr(library_obj, key, library[key])
-
-    return library_obj
+    return counts
 
-def parse_pangolin_results(pangolin_results_path):
 
-    field_translation = {
-        'run_id': 'sequencing_run_id',
-        'sample_id': 'library_id',
-        'lineage': 'lineage',
-        'conflict': 'conflict',
-        'ambiguity_score': 'ambiguity_score',
-        'scorpio_call': 'scorpio_call',
-        'scorpio_support': 'scorpio_support',
-        'scorpio_conflict': 'scorpio_conflict',
-        'version': 'version',
-        'pangolin_version': 'pangolin_version',
-        'pangoLEARN_version': 'pangolearn_version',
-        'pango_version': 'pango_version',
-        'status': 'status',
-        'note': 'note',
-    }
-    
-    float_fields = [
-        'conflict',
-        'ambiguity_score',
-        'scorpio_support',
-        'scorpio_conflict',
-    ]
-    
-    pangolin_results = []
-
-    with open(pangolin_results_path, 'r', newline='') as f:
-        reader = csv.DictReader(f, delimiter=',')
-        for row in reader:
-            p = collections.OrderedDict()
-            for k, v in field_translation.items():
-                if row[k] == '':
-                    p[v] = None
-                else:
-                    p[v] = row[k]
-            
-            for f in float_fields:
-                if p[f]:
-                    p[f] = float(p[f])
-            
-            pangolin_result_obj = models.PangolinResult()
-            for key in p.keys():
-                setattr(pangolin_result_obj, key, p[key])
-
-            pangolin_results.append(pangolin_result_obj)
-
-    return pangolin_results
-
-
-def store_sequencing_run(session, sequencing_run_id):
-    existing_run = (
-        session.query(models.SequencingRun)
-        .filter(
-            models.SequencingRun.sequencing_run_id == sequencing_run_id
-        )
-        .one_or_none()
-    )
-
-    if existing_run is None:
-        new_sequencing_run = sequencing_run_id_to_sequencing_run_obj(sequencing_run_id)
-        session.add(new_sequencing_run)
-        session.commit()
-
-
-def store_pangolin_results(session, pangolin_results):
-    for idx, pangolin_result in enumerate(pangolin_results):
-        container_id = library_id_to_container_id(pangolin_result.library_id)
-        if container_id:
-            existing_container = (
-                session.query(models.Container)
-                .filter(
-                    sa.and_(
-                        models.Container.container_id == container_id
-                    )
-                )
-                .one_or_none()
-            )
-
-            if existing_container is None:
-                new_container = library_id_to_container_obj(pangolin_result.library_id)
-                session.add(new_container)
-    
-        existing_library = (
-            session.query(models.Library)
-            .filter(
-                sa.and_(
-                    models.Library.library_id == pangolin_result.library_id
-                )
-            )
-            .one_or_none()
-        )
-
-        if existing_library is None:
-            new_library = library_id_to_library_obj(pangolin_result.library_id)
-            session.add(new_library)
-
-        existing_pangolin_result = (
-            session.query(models.PangolinResult)
-            .filter(
-                sa.and_(
-                    models.PangolinResult.sequencing_run_id == pangolin_result.sequencing_run_id,
-                    models.PangolinResult.library_id == pangolin_result.library_id,
-                    models.PangolinResult.version == pangolin_result.version,
-                    models.PangolinResult.pangolin_version == pangolin_result.pangolin_version,
-                    models.PangolinResult.pangolearn_version == pangolin_result.pangolearn_version,
-                    models.PangolinResult.pango_version == pangolin_result.pango_version,
-                )
-            )
-            .one_or_none()
-        )
-    
-        if existing_pangolin_result is None:
-            session.add(pangolin_result)
-
-        if idx % 1000 == 0:
-            session.flush()
-
-    session.commit()
-
-    return None
-    
-
-def main(args):
+def main(args, session=None):
 
     if args.db:
         db = args.db
     else:
         db = ':memory:'
 
-    connection_string = "sqlite+pysqlite:///" + db
-    engine = sa.create_engine(connection_string)
-    Session = sao.sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
+    sqlite_profile, sqlite_pragmas = ncov_db.db.args_to_sqlite_options(args)
+
+    own_session = session is None
+    if own_session:
+        session = ncov_db.db.create_session(db, sqlite_profile, sqlite_pragmas)
 
-    pangolin_results = parse_pangolin_results(args.pangolin_results)
+    batch_size = getattr(args, 'batch_size', 1000)
+    profiler = profiling.args_to_profiler(args)
 
-    sequencing_run_ids = set()
+    try:
+        with profiler.stage('pangolin_results'):
+            pangolin_results = parse_pangolin_results(args.pangolin_results)
 
-    for pangolin_result in pangolin_results:
-        sequencing_run_ids.add(pangolin_result.sequencing_run_id)
+            counts = store_pangolin_results(session, pangolin_results, batch_size)
 
-    for sequencing_run_id in sequencing_run_ids:
-        store_sequencing_run(session, sequencing_run_id)
+            if own_session:
+                session.commit()
+                if sqlite_profile == 'fast-load':
+                    ncov_db.db.checkpoint(session)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        if own_session:
+            ncov_db.db.close_session(session)
+        # Written even if the load fails.
+        profiler.write()
 
-    store_pangolin_results(session, pangolin_results)
+    return counts
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('pangolin_results')
     parser.add_argument('--db')
+    parser.add_argument('--batch-size', default=1000, type=int)
+    parser.add_argument('--fast-load', action='store_true')
+    parser.add_argument('--pragma', action='append', default=[])
+    parser.add_argument('--profile')
+    parser.add_argument('--profile-top', default=20, type=int)
+    parser.add_argument('--profile-memory', action='store_true')
     args = parser.parse_args()
     main(args)
@@ -2,15 +2,24 @@
 
 import argparse
 import collections
-import datetime
+import functools
 import json
 import os
-import pathlib
+import time
 
+from . import db
+from . import discovery
+from . import indexes
+from . import manifest as load_manifest
+from . import mutation_index
+from . import parallel
+from . import profiling
+from . import rollups
 from . import store_metadata_tsv
 from . import store_variants_tsv
 from . import store_ncov_tools_summary_qc
 from . import store_ncov_tools_amino_acid_mutation_table
+from . import timing
 
 from .time import now
 
@@ -18,114 +27,250 @@ def percent(n, d):
     pct = round(n  / d * 100, 2)
     return pct
 
-def main(args):
+COMMIT_LEVELS = ['run', 'stage', 'file']
+
+
+def checkpoint(session, level, commit_every):
+    """
+    Commit the load-run transaction if `level` ('file' or 'stage') is at least
+    as fine-grained as the configured `commit_every` level. With the default
+    of 'run', nothing is committed until the whole run has been loaded.
+    The rollups and mutation index are brought up to date with the rows
+    being committed first: the marks of what changed are only kept in the
+    session, and a later rollback throws them away.
+    """
+    if COMMIT_LEVELS.index(level) <= COMMIT_LEVELS.index(commit_every):
+        rollups.refresh_changed_rollups(session)
+        mutation_index.update_changed(session)
+        session.commit()
+
+
+def main(args, session=None):
+    commit_every = getattr(args, 'commit_every', 'run')
+    sqlite_profile, sqlite_pragmas = db.args_to_sqlite_options(args)
+
+    own_session = session is None
+    if own_session:
+        session = db.create_session(args.db, sqlite_profile, sqlite_pragmas)
+
+    defer_indexes = getattr(args, 'defer_indexes', False)
+    profiler = profiling.args_to_profiler(args)
+
+    start = time.perf_counter()
+    commits_before = db.commit_count(session)
+    try:
+        if defer_indexes:
+            indexes.drop_secondary_indexes(session)
+        stats = load_run(args, session, commit_every, profiler=profiler)
+        if defer_indexes:
+            with profiler.stage('create_indexes'):
+                indexes.create_secondary_indexes(session)
+        complete_run(session, args.run_dir, stats, profiler)
+        session.commit()
+        stats.commits = db.commit_count(session) - commits_before
+        if sqlite_profile == 'fast-load':
+            db.checkpoint(session)
+    except Exception:
+        session.rollback()
+        # With --commit-every stage or file, the drop may already have been
+        # committed along with part of the run.
+        if defer_indexes and commit_every != 'run':
+            indexes.create_secondary_indexes(session)
+            session.commit()
+        raise
+    finally:
+        if own_session:
+            db.close_session(session)
+        # Written even if the load fails or is interrupted, since that's
+        # often when a profile is wanted.
+        profiler.write()
 
     log_msg = collections.OrderedDict()
     log_msg['timestamp'] = now()
-    log_msg['event_type'] = 'load_run_started'
+    log_msg['event_type'] = 'load_run_completed'
     log_msg['run_dir'] = os.path.abspath(args.run_dir)
+    log_msg['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+    log_msg.update(stats.summary())
     print(json.dumps(log_msg))
 
-    artic_version = '1.3'
-    ncov_tools_version = '1.5'
-    
-    store_metadata_args = {
-        'db': args.db,
-    }
-
-    metadata_files = list(pathlib.Path(args.run_dir).rglob('metadata.tsv'))
-    total_metadata_files = len(metadata_files)
-    for n, f in enumerate(metadata_files):
-        store_metadata_args['metadata'] = f
-        store_metadata_tsv.main(None, store_metadata_args)
-        log_msg = collections.OrderedDict()
-        log_msg['timestamp'] = now()
-        log_msg['event_type'] = 'file_loaded'
-        log_msg['file_type'] = 'metadata_tsv'
-        log_msg['filename'] = os.path.basename(f)
-        log_msg['progress_pct'] = percent((n + 1), total_metadata_files)
-        print(json.dumps(log_msg))
-
-
-    store_ivar_variants_args = {
-        'db': args.db,
-    }
-
-    ivar_variants_dir = os.path.join(
-        args.run_dir,
-        'ncov2019-artic-nf-v' + artic_version + '-output',
-        'ncovIllumina_sequenceAnalysis_addCodonPositionToVariants',
-    )
-    
-    ivar_variant_files = list(pathlib.Path(ivar_variants_dir).rglob('*.tsv'))
-    total_ivar_variant_files = len(ivar_variant_files)
-    for n, f in enumerate(ivar_variant_files):
-        store_ivar_variants_args['variants'] = f
-        store_variants_tsv.main(None, store_ivar_variants_args)
-        log_msg = collections.OrderedDict()
-        log_msg['timestamp'] = now()
-        log_msg['event_type'] = 'file_loaded'
-        log_msg['file_type'] = 'ivar_variants_tsv'
-        log_msg['filename'] = os.path.basename(f)
-        log_msg['progress_pct'] = percent((n + 1), total_ivar_variant_files)
-        print(json.dumps(log_msg))
-
-
-    store_ncov_tools_summary_qc_args = {
-        'db': args.db,
-    }
-    
-    ncov_tools_qc_output_dir = os.path.join(
-        args.run_dir,
-        'ncov2019-artic-nf-v' + artic_version + '-output',
-        'ncov-tools-v' + ncov_tools_version + '-output',
-    )
-
-    ncov_tools_qc_reports_dir = os.path.join(
-        ncov_tools_qc_output_dir,
-        'qc_reports',
-    )
-    
-    ncov_tools_summary_qc = list(pathlib.Path(ncov_tools_qc_reports_dir).rglob('*_summary_qc.tsv'))
-    total_ncov_tools_summary_qc_files = len(ncov_tools_summary_qc)
-    for n, f in enumerate(ncov_tools_summary_qc):
-        store_ncov_tools_summary_qc_args['qc_summary'] = f
-        store_ncov_tools_summary_qc.main(None, store_ncov_tools_summary_qc_args)
-        log_msg = collections.OrderedDict()
-        log_msg['timestamp'] = now()
-        log_msg['event_type'] = 'file_loaded'
-        log_msg['file_type'] = 'ncov_tools_summary_qc'
-        log_msg['filename'] = os.path.basename(f)
-        log_msg['progress_pct'] = percent((n + 1), total_ncov_tools_summary_qc_files)
-        print(json.dumps(log_msg))
-    
-
-    store_ncov_tools_aa_mutation_args = {
-        'db': args.db,
-    }
-    ncov_tools_aa_tables = list(pathlib.Path(ncov_tools_qc_output_dir).rglob('by_plate/*/qc_annotation/*_aa_table.tsv'))
-    total_ncov_tools_aa_table_files = len(ncov_tools_aa_tables)
-    for n, f in enumerate(ncov_tools_aa_tables):
-        store_ncov_tools_aa_mutation_args['ncov_tools_aa_table'] = f
-        store_ncov_tools_amino_acid_mutation_table.main(None, store_ncov_tools_aa_mutation_args)
-        log_msg = collections.OrderedDict()
-        log_msg['timestamp'] = now()
-        log_msg['event_type'] = 'file_loaded'
-        log_msg['file_type'] = 'ncov_tools_aa_table'
-        log_msg['filename'] = os.path.basename(f)
-        log_msg['progress_pct'] = percent((n + 1), total_ncov_tools_aa_table_files)
-        print(json.dumps(log_msg))
+    return stats
+
+
+def complete_run(session, run_dir, stats=None, profiler=profiling.NULL_PROFILER):
+    """
+    Bring the derived tables (rollups, mutation index) up to date with the
+    rows loaded from `run_dir`, and record the run as loaded. Called before
+    the run's final commit. The time taken is added to `stats` as the
+    derived_tables stage.
+    """
+    start = time.perf_counter()
+    with profiler.stage('derived_tables'):
+        rollups.refresh_changed_rollups(session)
+        mutation_index.update_changed(session)
+        load_manifest.record_loaded_run(session, run_dir)
+    if stats is not None:
+        stats.add_stage_seconds('derived_tables', time.perf_counter() - start)
 
+
+def log_file_loaded(file_type, path, counts, progress_pct, parse_seconds=None, write_seconds=None):
     log_msg = collections.OrderedDict()
     log_msg['timestamp'] = now()
-    log_msg['event_type'] = 'load_run_completed'
+    log_msg['event_type'] = 'file_loaded'
+    log_msg['file_type'] = file_type
+    log_msg['filename'] = os.path.basename(path)
+    log_msg['rows_parsed'] = counts['parsed']
+    log_msg['rows_inserted'] = counts['inserted']
+    log_msg['rows_skipped'] = counts['skipped']
+    if parse_seconds is not None:
+        log_msg['parse_seconds'] = round(parse_seconds, 4)
+        log_msg['write_seconds'] = round(write_seconds, 4)
+        log_msg['rows_per_sec'] = timing.rows_per_sec(counts['parsed'], parse_seconds + write_seconds)
+    log_msg['progress_pct'] = progress_pct
+    print(json.dumps(log_msg))
+
+
+def log_file_skipped(file_type, path, progress_pct):
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'file_skipped'
+    log_msg['file_type'] = file_type
+    log_msg['filename'] = os.path.basename(path)
+    log_msg['reason'] = 'unchanged_since_last_load'
+    log_msg['progress_pct'] = progress_pct
+    print(json.dumps(log_msg))
+
+
+def split_unchanged(manifest, file_type, paths, force_reload=False):
+    """
+    Split paths into those that need loading and those the manifest says
+    are unchanged since they were last loaded, logging a file_skipped
+    event for each of the latter. The manifest state of each file to load
+    is taken now, before it's parsed.
+    """
+    paths_to_load = []
+    total_paths = len(paths)
+    for n, path in enumerate(paths):
+        if not force_reload and manifest.is_unchanged(path):
+            log_file_skipped(file_type, path, percent((n + 1), total_paths))
+        else:
+            manifest.snapshot(path)
+            paths_to_load.append(path)
+
+    return paths_to_load
+
+
+def store_file(session, manifest, stats, file_type, path, rows, store, progress_pct, parse_seconds=0.0):
+    """
+    Write the parsed `rows` of one file with `store`, record the file in the
+    manifest, and log a file_loaded event. The time spent pulling rows from
+    `rows` is counted as parse time (plus `parse_seconds`, for files parsed
+    ahead of time), and the rest as write time.
+    """
+    timed_rows = timing.TimedIterator(rows)
+    start = time.perf_counter()
+    counts = store(session, timed_rows)
+    write_seconds = time.perf_counter() - start - timed_rows.seconds
+    parse_seconds += timed_rows.seconds
+
+    manifest.record(path, file_type, counts['parsed'])
+    stats.add_file(file_type, counts, parse_seconds, write_seconds)
+    log_file_loaded(file_type, path, counts, progress_pct, parse_seconds, write_seconds)
+
+
+def load_run(args, session, commit_every, executor=None, profiler=profiling.NULL_PROFILER):
+    """
+    Load the files of the run in args.run_dir through `session`, profiling
+    each stage with `profiler`. Returns a timing.LoadStats with the rows and
+    time taken per stage.
+    """
+    batch_size = getattr(args, 'batch_size', 1000)
+    force_reload = getattr(args, 'force_reload', False)
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'load_run_started'
     log_msg['run_dir'] = os.path.abspath(args.run_dir)
     print(json.dumps(log_msg))
 
+    manifest = load_manifest.LoadManifest(session, args.run_dir)
+    run_files = discovery.discover_run_files(args.run_dir)
+    stats = timing.LoadStats()
+
+
+    stage_start = time.perf_counter()
+    with profiler.stage('metadata_tsv'):
+        store_metadata = functools.partial(store_metadata_tsv.store_metadata_records, batch_size=batch_size)
+        metadata_files_to_load = split_unchanged(manifest, 'metadata_tsv', run_files['metadata_tsv'], force_reload)
+        total_metadata_files = len(metadata_files_to_load)
+        for n, f in enumerate(metadata_files_to_load):
+            rows = store_metadata_tsv.parse_metadata_tsv(f)
+            store_file(session, manifest, stats, 'metadata_tsv', f, rows, store_metadata, percent((n + 1), total_metadata_files))
+            checkpoint(session, 'file', commit_every)
+        checkpoint(session, 'stage', commit_every)
+    stats.add_stage_seconds('metadata_tsv', time.perf_counter() - stage_start)
+
+
+    stage_start = time.perf_counter()
+    with profiler.stage('ivar_variants_tsv'):
+        store_ivar_variants_args = store_variants_tsv.Args(db=args.db, variants=None, batch_size=batch_size)
+        filters = store_variants_tsv.args_to_filters(store_ivar_variants_args)
+        parse_variants_file = functools.partial(store_variants_tsv.parse_variants_file, filters=filters)
+        jobs = getattr(args, 'jobs', 1)
+
+        ivar_variant_files_to_load = split_unchanged(manifest, 'ivar_variants_tsv', run_files['ivar_variants_tsv'], force_reload)
+        total_ivar_variant_files = len(ivar_variant_files_to_load)
+        # With --jobs, files are parsed in worker processes, so the parse time
+        # logged is the time spent waiting for each parsed file.
+        parsed_ivar_variant_files = timing.TimedIterator(parallel.imap_bounded(parse_variants_file, ivar_variant_files_to_load, jobs, executor=executor))
+        for n, (f, (library_id, rows)) in enumerate(zip(ivar_variant_files_to_load, parsed_ivar_variant_files)):
+            store_variants = lambda session, rows: store_variants_tsv.store_parsed_variants(session, library_id, rows, batch_size)
+            store_file(session, manifest, stats, 'ivar_variants_tsv', f, rows, store_variants, percent((n + 1), total_ivar_variant_files), parsed_ivar_variant_files.last_seconds)
+            checkpoint(session, 'file', commit_every)
+        checkpoint(session, 'stage', commit_every)
+    stats.add_stage_seconds('ivar_variants_tsv', time.perf_counter() - stage_start)
+
+
+    stage_start = time.perf_counter()
+    with profiler.stage('ncov_tools_summary_qc'):
+        store_qc_summaries = functools.partial(store_ncov_tools_summary_qc.store_qc_summaries, batch_size=batch_size)
+        ncov_tools_summary_qc_to_load = split_unchanged(manifest, 'ncov_tools_summary_qc', run_files['ncov_tools_summary_qc'], force_reload)
+        total_ncov_tools_summary_qc_files = len(ncov_tools_summary_qc_to_load)
+        for n, f in enumerate(ncov_tools_summary_qc_to_load):
+            rows = store_ncov_tools_summary_qc.parse_qc_summary_tsv(f)
+            store_file(session, manifest, stats, 'ncov_tools_summary_qc', f, rows, store_qc_summaries, percent((n + 1), total_ncov_tools_summary_qc_files))
+            checkpoint(session, 'file', commit_every)
+        checkpoint(session, 'stage', commit_every)
+    stats.add_stage_seconds('ncov_tools_summary_qc', time.perf_counter() - stage_start)
+
+
+    stage_start = time.perf_counter()
+    with profiler.stage('ncov_tools_aa_table'):
+        store_aa_mutations = functools.partial(store_ncov_tools_amino_acid_mutation_table.store_amino_acid_mutations, batch_size=batch_size)
+        ncov_tools_aa_tables_to_load = split_unchanged(manifest, 'ncov_tools_aa_table', run_files['ncov_tools_aa_table'], force_reload)
+        total_ncov_tools_aa_table_files = len(ncov_tools_aa_tables_to_load)
+        for n, f in enumerate(ncov_tools_aa_tables_to_load):
+            rows = store_ncov_tools_amino_acid_mutation_table.parse_amino_acid_mutation_tsv(f)
+            store_file(session, manifest, stats, 'ncov_tools_aa_table', f, rows, store_aa_mutations, percent((n + 1), total_ncov_tools_aa_table_files))
+            checkpoint(session, 'file', commit_every)
+        checkpoint(session, 'stage', commit_every)
+    stats.add_stage_seconds('ncov_tools_aa_table', time.perf_counter() - stage_start)
+
+    return stats
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('run_dir')
     parser.add_argument('--db', required=True)
+    parser.add_argument('--commit-every', choices=COMMIT_LEVELS, default='run')
+    parser.add_argument('--jobs', default=1, type=int)
+    parser.add_argument('--batch-size', default=1000, type=int)
+    parser.add_argument('--force-reload', action='store_true')
+    parser.add_argument('--fast-load', action='store_true')
+    parser.add_argument('--pragma', action='append', default=[])
+    parser.add_argument('--defer-indexes', action='store_true')
+    parser.add_argument('--profile')
+    parser.add_argument('--profile-top', default=20, type=int)
+    parser.add_argument('--profile-memory', action='store_true')
     args = parser.parse_args()
     main(args)
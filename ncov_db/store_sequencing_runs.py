@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import json
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from . import db
+from . import discovery
+from . import indexes
+from . import manifest as load_manifest
+from . import profiling
+from . import store_sequencing_run
+
+from .time import now
+
+
+def read_runs_file(runs_file):
+    with open(runs_file, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def args_to_run_dirs(args):
+    run_dirs = list(getattr(args, 'run_dirs', None) or [])
+    if getattr(args, 'runs_file', None):
+        run_dirs += read_runs_file(args.runs_file)
+    if getattr(args, 'parent_dir', None):
+        run_dirs += discovery.find_run_dirs(args.parent_dir)
+
+    # Keep the first occurrence of each run, in the order given.
+    return list(collections.OrderedDict.fromkeys(os.path.abspath(run_dir) for run_dir in run_dirs))
+
+
+def log_run_event(event_type, run_dir, **fields):
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = event_type
+    log_msg['run_dir'] = run_dir
+    log_msg.update(fields)
+    print(json.dumps(log_msg))
+
+
+def load_and_commit_run(args, session, run_dir, executor=None, profiler=profiling.NULL_PROFILER):
+    """
+    Load `run_dir` with the options in `args`, bring the derived tables up
+    to date and commit. The caller rolls back if this raises.
+    Returns the run's timing.LoadStats.
+    """
+    run_args = argparse.Namespace(**vars(args))
+    run_args.run_dir = run_dir
+    commits_before = db.commit_count(session)
+    stats = store_sequencing_run.load_run(run_args, session, getattr(args, 'commit_every', 'run'), executor, profiler)
+    store_sequencing_run.complete_run(session, run_dir, stats, profiler)
+    session.commit()
+    stats.commits = db.commit_count(session) - commits_before
+
+    return stats
+
+
+def load_runs(args, session, executor=None, profiler=profiling.NULL_PROFILER):
+    """
+    Load each run in turn through `session`, committing after each run.
+    Runs recorded in the loaded_run table are skipped (unless
+    force_reload), so an interrupted backfill picks up where it stopped.
+    Returns a dict of loaded, skipped and failed run counts.
+    """
+    force_reload = getattr(args, 'force_reload', False)
+    keep_going = getattr(args, 'keep_going', False)
+
+    run_dirs = args_to_run_dirs(args)
+    loaded_run_dirs = load_manifest.loaded_run_dirs(session)
+
+    counts = {
+        'loaded': 0,
+        'skipped': 0,
+        'failed': 0,
+    }
+    for n, run_dir in enumerate(run_dirs):
+        progress_pct = store_sequencing_run.percent((n + 1), len(run_dirs))
+        if not force_reload and run_dir in loaded_run_dirs:
+            log_run_event('load_run_skipped', run_dir, reason='already_loaded', progress_pct=progress_pct)
+            counts['skipped'] += 1
+            continue
+
+        start = time.perf_counter()
+        try:
+            stats = load_and_commit_run(args, session, run_dir, executor, profiler)
+        except Exception as e:
+            session.rollback()
+            counts['failed'] += 1
+            log_run_event('load_run_failed', run_dir, error=repr(e), progress_pct=progress_pct)
+            if not keep_going:
+                raise
+            continue
+
+        counts['loaded'] += 1
+        log_run_event('load_run_completed', run_dir, elapsed_seconds=round(time.perf_counter() - start, 3), progress_pct=progress_pct, **stats.summary())
+
+    return counts
+
+
+def main(args, session=None):
+    sqlite_profile, sqlite_pragmas = db.args_to_sqlite_options(args)
+    defer_indexes = getattr(args, 'defer_indexes', False)
+    jobs = getattr(args, 'jobs', 1)
+    profiler = profiling.args_to_profiler(args)
+
+    own_session = session is None
+    if own_session:
+        session = db.create_session(args.db, sqlite_profile, sqlite_pragmas)
+
+    start = time.perf_counter()
+    executor = None
+    try:
+        if jobs > 1:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+        if defer_indexes:
+            indexes.drop_secondary_indexes(session)
+            session.commit()
+        try:
+            counts = load_runs(args, session, executor, profiler)
+        finally:
+            # The drop was committed, so rebuild the indexes even if a run
+            # failed, rather than leaving the database without them.
+            if defer_indexes:
+                session.rollback()
+                with profiler.stage('create_indexes'):
+                    indexes.create_secondary_indexes(session)
+                session.commit()
+        if sqlite_profile == 'fast-load':
+            db.checkpoint(session)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if own_session:
+            db.close_session(session)
+        profiler.write()
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'load_runs_completed'
+    log_msg['runs_loaded'] = counts['loaded']
+    log_msg['runs_skipped'] = counts['skipped']
+    log_msg['runs_failed'] = counts['failed']
+    log_msg['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(log_msg))
+
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('run_dirs', nargs='*')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--parent-dir')
+    parser.add_argument('--runs-file')
+    parser.add_argument('--commit-every', choices=store_sequencing_run.COMMIT_LEVELS, default='run')
+    parser.add_argument('--jobs', default=1, type=int)
+    parser.add_argument('--batch-size', default=1000, type=int)
+    parser.add_argument('--force-reload', action='store_true')
+    parser.add_argument('--keep-going', action='store_true')
+    parser.add_argument('--fast-load', action='store_true')
+    parser.add_argument('--pragma', action='append', default=[])
+    parser.add_argument('--defer-indexes', action='store_true')
+    parser.add_argument('--profile')
+    parser.add_argument('--profile-top', default=20, type=int)
+    parser.add_argument('--profile-memory', action='store_true')
+    args = parser.parse_args()
+    main(args)
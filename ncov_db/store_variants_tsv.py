@@ -2,319 +2,256 @@
 
 import argparse
 import collections
-import csv
 import json
 import os
-import sys
 
 from dataclasses import dataclass
 
-import sqlalchemy as sa
-import sqlalchemy.orm as sao
-
+from . import bulk
+from . import db
+from . import dictionaries
+from . import discovery
+from . import entities
 from . import models
+from . import rollups
+from . import tsv
 from .time import now
 
-def library_id_to_container_id(library_id):
-    container_id = None
-    if not (library_id.startswith('POS') or library_id.startswith('NEG')):
-        container_id = library_id.split('-')[0]
-    return container_id
-
-
-def library_id_to_container_obj(library_id):
-    container_obj = models.Container()
-    container_obj.container_id = library_id_to_container_id(library_id)
-    return container_obj
-
-def library_id_to_library_obj(library_id):
-    library = {}
-    library_id_components = library_id.split('-')
-
-    library['id'] = library_id
-    if library_id.startswith('POS'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['index_set_id'] = library_id_components[3]
-        library['plate_well'] = 'G12'
-    elif library_id.startswith('NEG'):
-        library['container_id'] = None
-        library['library_plate_id'] = library_id_components[2]
-        library['index_set_id'] = library_id_components[3]
-        library['plate_well'] = 'H12'
-    else:
-        library['container_id'] = library_id_components[0]
-        library['library_plate_id'] = library_id_components[1]
-        library['index_set_id'] = library_id_components[2]
-        library['plate_well'] = library_id_components[3]
-    library['plate_row'] = library['plate_well'][0]
-    library['plate_col'] = int(library['plate_well'][-2:])
-    
-    library_obj = models.Library()
-    for key in library.keys():
-        setattr(library_obj, key, library[key])
-
-    return library_obj
-
-def parse_variants_tsv(variants_tsv_path, library_id, filters):
-    field_name_conversion = {
-        'REGION':      'ref_accession',
-        'POS':         'nucleotide_position',
-        'REF':         'ref_allele',
-        'ALT':         'alt_allele',
-        'REF_DP':      'ref_allele_depth',
-        'REF_RV':      'ref_allele_depth_reverse_reads',
-        'REF_QUAL':    'ref_allele_mean_quality',
-        'ALT_DP':      'alt_allele_depth',
-        'ALT_RV':      'alt_allele_depth_reverse_reads',
-        'ALT_QUAL':    'alt_allele_mean_quality',
-        'ALT_FREQ':    'alt_allele_frequency',
-        'TOTAL_DP':    'total_depth',
-        'PVAL':        'p_value_fishers_exact',
-        'PASS':        'p_value_pass',
-        'GFF_FEATURE': 'gene_name',
-        'REF_CODON':   'ref_codon',
-        'REF_AA':      'ref_amino_acid',
-        'ALT_CODON':   'alt_codon',
-        'ALT_AA':      'alt_amino_acid',
-        'CODON_POS':   'codon_position',
-        'MUT_NAME':    'mutation_name_by_amino_acid',
-    }
-
-    int_fields = [
-        'nucleotide_position',
-        'ref_allele_depth',
-        'ref_allele_depth_reverse_reads',
-        'ref_allele_mean_quality',
-        'alt_allele_depth',
-        'alt_allele_depth_reverse_reads',
-        'alt_allele_mean_quality',
-        'total_depth',
-        'codon_position',
-    ]
-
-    float_fields = [
-        'alt_allele_frequency',
-        'p_value_fishers_exact',
-    ]
-
-    bool_fields = [
-        'p_value_pass',
-    ]
-
-    na_null_fields = [
-        'gene_name',
-        'ref_codon',
-        'ref_amino_acid',
-        'alt_codon',
-        'alt_amino_acid',
-        'codon_position',
-        'mutation_name_by_amino_acid',
-    ]
-
-    iupac_ambiguity = {
-        ('A', 'A'): 'A',
-        ('A', 'C'): 'M',
-        ('A', 'G'): 'R',
-        ('A', 'T'): 'W',
-        ('C', 'A'): 'M',
-        ('C', 'C'): 'C',
-        ('C', 'G'): 'S',
-        ('C', 'T'): 'Y',
-        ('G', 'A'): 'R',
-        ('G', 'C'): 'S',
-        ('G', 'G'): 'G',
-        ('G', 'T'): 'K',
-        ('T', 'A'): 'W',
-        ('T', 'C'): 'Y',
-        ('T', 'G'): 'K',
-        ('T', 'T'): 'T',
-    }
-
-    variants = []
-
-    with open(variants_tsv_path, 'r', newline='') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            variant = collections.OrderedDict()
-            variant['library_id'] = library_id
-            variant['variant_calling_tool'] = 'ivar'
-            variant['variant_calling_tool_version'] = '1.3'
-
-            for k, v in field_name_conversion.items():
-                if k in row:
-                    variant[v] = row[k]
-                else:
-                    variant[v] = None
-
-            for f in na_null_fields:
-                if variant[f] == 'NA':
-                    variant[f] = None
-
-            for f in int_fields:
-                if variant[f] is not None:
-                    variant[f] = int(variant[f])
-
-            for f in float_fields:
-                if variant[f] is not None:
-                    variant[f] = float(variant[f])
-
-            for f in bool_fields:
-                if variant[f] is not None:
-                    variant[f] = bool(variant[f])
-            
-
-            if len(variant['ref_allele']) == 1 and len(variant['alt_allele']) == 1:
-                variant['variant_type'] = 'snp'
-            elif variant['alt_allele'].startswith('+'):
-                variant['variant_type'] = 'ins'
-            elif variant['alt_allele'].startswith('-'):
-                variant['variant_type'] = 'del'
+na = tsv.null_if({'NA'})
+
+VARIANT_FIELDS = [
+    ('ref_accession',                  'REGION',      None),
+    ('nucleotide_position',            'POS',         tsv.to_int),
+    ('ref_allele',                     'REF',         None),
+    ('alt_allele',                     'ALT',         None),
+    ('ref_allele_depth',               'REF_DP',      tsv.to_int),
+    ('ref_allele_depth_reverse_reads', 'REF_RV',      tsv.to_int),
+    ('ref_allele_mean_quality',        'REF_QUAL',    tsv.to_int),
+    ('alt_allele_depth',               'ALT_DP',      tsv.to_int),
+    ('alt_allele_depth_reverse_reads', 'ALT_RV',      tsv.to_int),
+    ('alt_allele_mean_quality',        'ALT_QUAL',    tsv.to_int),
+    ('alt_allele_frequency',           'ALT_FREQ',    tsv.to_float),
+    ('total_depth',                    'TOTAL_DP',    tsv.to_int),
+    ('p_value_fishers_exact',          'PVAL',        tsv.to_float),
+    ('p_value_pass',                   'PASS',        tsv.to_bool),
+    ('gene_name',                      'GFF_FEATURE', na),
+    ('ref_codon',                      'REF_CODON',   na),
+    ('ref_amino_acid',                 'REF_AA',      na),
+    ('alt_codon',                      'ALT_CODON',   na),
+    ('alt_amino_acid',                 'ALT_AA',      na),
+    ('codon_position',                 'CODON_POS',   tsv.null_if({'NA'}, tsv.to_int)),
+    ('mutation_name_by_amino_acid',    'MUT_NAME',    na),
+]
+
+# The variant_calling_tool_version recorded for variants files that aren't in
+# a versioned ncov2019-artic-nf output directory.
+DEFAULT_VARIANT_CALLING_TOOL_VERSION = '1.3'
+
+# Column order of the tuples yielded by parse_variants_tsv
+VARIANT_COLUMNS = (
+    ['library_id', 'variant_calling_tool', 'variant_calling_tool_version'] +
+    [name for name, column, converter in VARIANT_FIELDS] +
+    ['variant_type', 'consensus_allele', 'is_ambiguous']
+)
+
+# Columns of variant_ivar_encoded, where library_id, the variant calling
+# tool and version, ref_accession and gene_name are replaced by dictionary
+# IDs (see encode_variants).
+GENE_NAME_IDX = VARIANT_COLUMNS.index('gene_name')
+VARIANT_ENCODED_COLUMNS = (
+    ['library_key', 'variant_calling_tool_id', 'ref_accession_id'] +
+    VARIANT_COLUMNS[4:GENE_NAME_IDX] +
+    ['gene_name_id'] +
+    VARIANT_COLUMNS[GENE_NAME_IDX + 1:]
+)
+
+IUPAC_AMBIGUITY = {
+    ('A', 'A'): 'A',
+    ('A', 'C'): 'M',
+    ('A', 'G'): 'R',
+    ('A', 'T'): 'W',
+    ('C', 'A'): 'M',
+    ('C', 'C'): 'C',
+    ('C', 'G'): 'S',
+    ('C', 'T'): 'Y',
+    ('G', 'A'): 'R',
+    ('G', 'C'): 'S',
+    ('G', 'G'): 'G',
+    ('G', 'T'): 'K',
+    ('T', 'A'): 'W',
+    ('T', 'C'): 'Y',
+    ('T', 'G'): 'K',
+    ('T', 'T'): 'T',
+}
+
+AMBIGUOUS_ALLELES = {'M', 'R', 'W', 'S', 'Y', 'K'}
+
+
+def parse_variants_tsv(variants_tsv_path, library_id, filters, variant_calling_tool_version=DEFAULT_VARIANT_CALLING_TOOL_VERSION):
+    field_names = [name for name, column, converter in VARIANT_FIELDS]
+    nucleotide_position_idx = field_names.index('nucleotide_position')
+    ref_allele_idx = field_names.index('ref_allele')
+    alt_allele_idx = field_names.index('alt_allele')
+    alt_allele_frequency_idx = field_names.index('alt_allele_frequency')
+
+    min_freq_threshold = filters['min_freq_threshold']
+    freq_threshold = filters['freq_threshold']
+
+    variant_prefix = (library_id, 'ivar', variant_calling_tool_version)
+
+    for variant in tsv.decode_rows(variants_tsv_path, VARIANT_FIELDS):
+        ref_allele = variant[ref_allele_idx]
+        alt_allele = variant[alt_allele_idx]
+        alt_allele_frequency = variant[alt_allele_frequency_idx]
+
+        consensus_allele = None
+        is_ambiguous = None
+        if len(ref_allele) == 1 and len(alt_allele) == 1:
+            variant_type = 'snp'
+            if alt_allele_frequency < min_freq_threshold:
+                consensus_allele = ref_allele
+            elif alt_allele_frequency > min_freq_threshold and alt_allele_frequency < freq_threshold:
+                consensus_allele = IUPAC_AMBIGUITY.get((ref_allele, alt_allele))
+            elif alt_allele_frequency > freq_threshold:
+                consensus_allele = alt_allele
+
+            if consensus_allele is not None:
+                is_ambiguous = consensus_allele in AMBIGUOUS_ALLELES
             else:
-                variant['variant_type'] = 'undetermined'
-
-            if variant['variant_type'] == 'snp':
-                try:
-                    if variant['alt_allele_frequency'] < filters['min_freq_threshold']:
-                        variant['consensus_allele'] = variant['ref_allele']
-                    elif variant['alt_allele_frequency'] > filters['min_freq_threshold'] and variant['alt_allele_frequency'] < filters['freq_threshold']:
-                        variant['consensus_allele'] = iupac_ambiguity[(variant['ref_allele'], variant['alt_allele'])]
-                    elif variant['alt_allele_frequency'] > filters['freq_threshold']:
-                        variant['consensus_allele'] = variant['alt_allele']
-                except KeyError as e:
-                    log_msg = collections.OrderedDict()
-                    log_msg['timestamp'] = now()
-                    log_msg['event_type'] = 'loading_error'
-                    log_msg['input_file'] = os.path.abspath(variants_tsv_path)
-                    log_msg['input_data_details'] = {
-                        'library_id': variant['library_id'],
-                        'nucleotide_position': str(variant['nucleotide_position']),
-                        'ref_allele': variant['ref_allele'],
-                        'alt_allele': variant['alt_allele'],
-                        'alt_allele_frequency': str(variant['alt_allele_frequency']),
-                    }
-                    print(json.dumps(log_msg))
-
-            if variant['variant_type'] == 'snp':
-                try:
-                    if variant['consensus_allele'] in {'M', 'R', 'W', 'S', 'Y', 'K'}:
-                        variant['is_ambiguous'] = True
-                    else:
-                        variant['is_ambiguous'] = False
-                except KeyError as e:
-                    log_msg = collections.OrderedDict()
-                    log_msg['timestamp'] = now()
-                    log_msg['event_type'] = 'loading_error'
-                    log_msg['input_file'] = os.path.abspath(variants_tsv_path)
-                    log_msg['input_data_details'] = {
-                        'library_id': variant['library_id'],
-                        'nucleotide_position': str(variant['nucleotide_position']),
-                        'ref_allele': variant['ref_allele'],
-                        'alt_allele': variant['alt_allele'],
-                        'alt_allele_frequency': str(variant['alt_allele_frequency']),
-                    }
-                    print(json.dumps(log_msg))
-
-            variant_obj = models.VariantIvar()
-            for key in variant.keys():
-                setattr(variant_obj, key, variant[key])
-
-            variants.append(variant_obj)
-
-    return variants
-
-
-def store_container_for_library(session, library):
-    container_id = library.id.split('-')[0]
-    
-    existing_container = (
-        session.query(models.Container)
-        .filter(
-            models.Container.id == container_id
+                log_msg = collections.OrderedDict()
+                log_msg['timestamp'] = now()
+                log_msg['event_type'] = 'loading_error'
+                log_msg['input_file'] = os.path.abspath(variants_tsv_path)
+                log_msg['input_data_details'] = {
+                    'library_id': library_id,
+                    'nucleotide_position': str(variant[nucleotide_position_idx]),
+                    'ref_allele': ref_allele,
+                    'alt_allele': alt_allele,
+                    'alt_allele_frequency': str(alt_allele_frequency),
+                }
+                print(json.dumps(log_msg))
+        elif alt_allele.startswith('+'):
+            variant_type = 'ins'
+        elif alt_allele.startswith('-'):
+            variant_type = 'del'
+        else:
+            variant_type = 'undetermined'
+
+        yield variant_prefix + variant + (variant_type, consensus_allele, is_ambiguous)
+
+
+def encode_variants(session, variants):
+    """
+    Return a variant_ivar_encoded row tuple for each of the parsed
+    `variants` (VARIANT_COLUMNS tuples), adding new values to the
+    dictionaries.
+    """
+    dictionary_cache = dictionaries.get_dictionary_cache(session)
+    library_keys = dictionary_cache.libraries.ids(v[0] for v in variants)
+    variant_calling_tool_ids = dictionary_cache.variant_calling_tools.ids((v[1], v[2]) for v in variants)
+    ref_accession_ids = dictionary_cache.ref_accessions.ids(v[3] for v in variants)
+    gene_name_ids = dictionary_cache.gene_names.ids(v[GENE_NAME_IDX] for v in variants)
+
+    rows = []
+    for v in variants:
+        rows.append(
+            (library_keys[v[0]], variant_calling_tool_ids[(v[1], v[2])], ref_accession_ids[v[3]]) +
+            v[4:GENE_NAME_IDX] +
+            (gene_name_ids.get(v[GENE_NAME_IDX]),) +
+            v[GENE_NAME_IDX + 1:]
         )
-        .one_or_none()
-    )
 
-    if existing_container is None:
-        container = models.Container()
-        container.id = container_id
-        session.add(container)
-        session.commit()
+    return rows
 
-    return None
 
+def store_variants(session, variants, batch_size=1000):
+    variant_table = models.VariantIvarEncoded.__table__
+    counts = {
+        'parsed': 0,
+        'inserted': 0,
+        'skipped': 0,
+    }
 
-def store_library(session, library):
-    if not (library.id.startswith('POS') or library.id.startswith('NEG')):
-        store_container_for_library(session, library)
-    
-    existing_library = (
-        session.query(models.Library)
-        .filter(
-            models.Library.id == library.id
-        )
-        .one_or_none()
-    )
-    if existing_library is None:
-        session.add(library)
-
-    session.commit()
-
-    return None
-
-
-def store_variants(session, variants):
-    for idx, variant in enumerate(variants):
-        existing_variant = (
-            session.query(models.VariantIvar)
-            .filter(
-                sa.and_(
-                    models.VariantIvar.library_id == variant.library_id,
-                    models.VariantIvar.variant_calling_tool == variant.variant_calling_tool,
-                    models.VariantIvar.variant_calling_tool_version == variant.variant_calling_tool_version,
-                    models.VariantIvar.ref_accession == variant.ref_accession,
-                    models.VariantIvar.nucleotide_position == variant.nucleotide_position,
-                    models.VariantIvar.ref_allele == variant.ref_allele,
-                    models.VariantIvar.alt_allele == variant.alt_allele,
-                )
-            )
-            .one_or_none()
-        )
-        if existing_variant is None:
-            session.add(variant)
-            if idx % 1000 == 0:
-                session.flush()
+    for batch in bulk.batched(variants, batch_size):
+        batch_counts = bulk.insert_ignore_duplicates(session, variant_table, VARIANT_ENCODED_COLUMNS, encode_variants(session, batch))
+        counts['parsed'] += len(batch)
+        counts['inserted'] += batch_counts['inserted']
+        counts['skipped'] += batch_counts['skipped']
 
-    session.commit()
+    return counts
 
-    return None
-    
 
-def main(args, kwargs=None):
-    if not args:    
-        args = Args(**kwargs)
+def variants_path_to_library_id(variants_path):
+    library_id = os.path.basename(variants_path).split('.')[0]
+    return library_id
 
-    connection_string = "sqlite+pysqlite:///" + args.db
-    engine = sa.create_engine(connection_string)
-    Session = sao.sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
-    
-    library_id = os.path.basename(args.variants).split('.')[0]
 
-    library = library_id_to_library_obj(library_id)
+def variants_path_to_variant_calling_tool_version(variants_path):
+    """
+    Return the version of the ncov2019-artic-nf output directory that a
+    variants file is in, or DEFAULT_VARIANT_CALLING_TOOL_VERSION.
+    """
+    artic_output_dir = os.path.dirname(os.path.dirname(os.path.abspath(variants_path)))
+    return discovery.output_dir_version(artic_output_dir) or DEFAULT_VARIANT_CALLING_TOOL_VERSION
 
-    store_library(session, library)
 
+def args_to_filters(args):
     filters = {
         'min_freq_threshold': args.min_freq_threshold,
         'freq_threshold': args.freq_threshold,
         'min_depth': args.min_depth,
     }
+    return filters
+
 
-    variants = parse_variants_tsv(args.variants, library_id, filters)
+def parse_variants_file(variants_path, filters):
+    """
+    Parse one variants file into a list of row tuples.
+    This runs in worker processes during a parallel load-run, so it must not
+    touch the database, and its return value must be picklable.
+    """
+    library_id = variants_path_to_library_id(variants_path)
+    variant_calling_tool_version = variants_path_to_variant_calling_tool_version(variants_path)
+    rows = list(parse_variants_tsv(variants_path, library_id, filters, variant_calling_tool_version))
+
+    return library_id, rows
+
+
+def store_parsed_variants(session, library_id, variants, batch_size=1000):
+    entity_cache = entities.get_entity_cache(session)
+    entity_cache.ensure_libraries([library_id])
+
+    counts = store_variants(session, variants, batch_size)
+    if counts['inserted']:
+        rollups.mark_changed(session, library_ids=[library_id])
+
+    return counts
+    
+
+def main(args, kwargs=None, session=None):
+    if not args:    
+        args = Args(**kwargs)
+
+    own_session = session is None
+    if own_session:
+        session = db.create_session(args.db)
+
+    filters = args_to_filters(args)
+
+    library_id = variants_path_to_library_id(args.variants)
+
+    variant_calling_tool_version = variants_path_to_variant_calling_tool_version(args.variants)
+
+    variants = parse_variants_tsv(args.variants, library_id, filters, variant_calling_tool_version)
+
+    counts = store_parsed_variants(session, library_id, variants, args.batch_size)
+
+    if own_session:
+        rollups.refresh_changed_rollups(session)
+        session.commit()
+        db.close_session(session)
 
-    store_variants(session, variants)
+    return counts
 
 
 @dataclass
@@ -324,6 +261,7 @@ class Args:
     min_freq_threshold: float = 0.25
     freq_threshold: float = 0.75
     min_depth: int = 10
+    batch_size: int = 1000
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -332,5 +270,6 @@ if __name__ == '__main__':
     parser.add_argument('--min-freq-threshold', default=0.25, type=float)
     parser.add_argument('--freq-threshold', default=0.75, type=float)
     parser.add_argument('--min-depth', default=10, type=int)
+    parser.add_argument('--batch-size', default=1000, type=int)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+
+from . import discovery
+from .time import now
+
+
+# Writes synthetic run directories in the layout load-run reads (see
+# ncov_db.discovery), for benchmarks and tests. Libraries are named
+# <container>-<plate>-<index set>-<well>, with a positive and negative
+# control in wells G12 and H12 of each plate, as on the real plates.
+
+GENOME_LENGTH = 29903
+REF_ACCESSION = 'MN908947.3'
+ARTIC_VERSION = '1.3'
+NCOV_TOOLS_VERSION = '1.5'
+
+# (gene, first nucleotide, last nucleotide) of the main SARS-CoV-2 genes.
+GENES = [
+    ('orf1ab', 266, 21555),
+    ('S', 21563, 25384),
+    ('ORF3a', 25393, 26220),
+    ('E', 26245, 26472),
+    ('M', 26523, 27191),
+    ('ORF6', 27202, 27387),
+    ('ORF7a', 27394, 27759),
+    ('ORF8', 27894, 28259),
+    ('N', 28274, 29533),
+]
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+WELLS = [row + '%02d' % col for row in 'ABCDEFGH' for col in range(1, 13)]
+SAMPLE_WELLS = [well for well in WELLS if well not in ('G12', 'H12')]
+
+IVAR_VARIANTS_HEADER = [
+    'REGION', 'POS', 'REF', 'ALT', 'REF_DP', 'REF_RV', 'REF_QUAL', 'ALT_DP', 'ALT_RV', 'ALT_QUAL', 'ALT_FREQ',
+    'TOTAL_DP', 'PVAL', 'PASS', 'GFF_FEATURE', 'REF_CODON', 'REF_AA', 'ALT_CODON', 'ALT_AA', 'CODON_POS', 'MUT_NAME',
+]
+METADATA_HEADER = ['sample', 'date', 'ct']
+SUMMARY_QC_HEADER = [
+    'sample', 'run_name', 'num_consensus_snvs', 'num_consensus_n', 'num_consensus_iupac', 'num_variants_snvs',
+    'num_variants_indel', 'num_variants_indel_triplet', 'mean_sequencing_depth', 'median_sequencing_depth',
+    'qc_pass', 'genome_completeness',
+]
+AA_TABLE_HEADER = ['sample', 'chr', 'pos', 'ref', 'alt', 'Consequence', 'gene', 'protein', 'aa']
+PANGOLIN_HEADER = [
+    'run_id', 'sample_id', 'lineage', 'conflict', 'ambiguity_score', 'scorpio_call', 'scorpio_support', 'scorpio_conflict',
+    'version', 'pangolin_version', 'pangoLEARN_version', 'pango_version', 'status', 'note',
+]
+LINEAGES = ['B.1.1.7', 'B.1.351', 'P.1', 'B.1.617.2', 'AY.4', 'AY.25', 'BA.1', 'BA.1.1', 'BA.2']
+
+
+def reference_sequence(seed=0):
+    rng = random.Random(seed)
+    return ''.join(rng.choice('ACGT') for n in range(GENOME_LENGTH))
+
+
+def gene_at(position):
+    for gene, start, end in GENES:
+        if start <= position <= end:
+            return gene, (position - start) // 3 + 1
+    return None, None
+
+
+def make_mutation(reference, position, rng):
+    """
+    Return a dict describing a SNP at `position`, with its amino acid change
+    if it falls in a gene.
+    """
+    ref = reference[position - 1]
+    alt = rng.choice([base for base in 'ACGT' if base != ref])
+    gene, codon = gene_at(position)
+    mutation = {
+        'position': position,
+        'ref': ref,
+        'alt': alt,
+        'gene': gene,
+        'codon': codon,
+    }
+    if gene is not None:
+        ref_aa, alt_aa = rng.sample(AMINO_ACIDS, 2)
+        mutation['ref_aa'] = ref_aa
+        mutation['alt_aa'] = alt_aa
+        mutation['protein'] = '%s%d%s' % (ref_aa, codon, alt_aa)
+    return mutation
+
+
+def library_ids_for_run(num_libraries, num_plates, first_container=1, index_set=1):
+    """
+    Return {plate: [library IDs]} with `num_libraries` samples spread evenly
+    over `num_plates` plates, plus a positive and negative control per plate.
+    """
+    plates = collections.OrderedDict()
+    container = first_container
+    for plate_number in range(num_plates):
+        plate = str(1000 + plate_number)
+        num_samples = num_libraries // num_plates + (1 if plate_number < num_libraries % num_plates else 0)
+        if num_samples > len(SAMPLE_WELLS):
+            raise ValueError('At most {} libraries fit on {} plates'.format(len(SAMPLE_WELLS) * num_plates, num_plates))
+        library_ids = []
+        for well in SAMPLE_WELLS[:num_samples]:
+            library_ids.append('R%09d-%s-%d-%s' % (container, plate, index_set, well))
+            container += 1
+        plates[plate] = library_ids
+    return plates
+
+
+def control_ids(run_date, plate, index_set=1):
+    return ['POS-%s-%s-%d' % (run_date.strftime('%y%m%d'), plate, index_set), 'NEG-%s-%s-%d' % (run_date.strftime('%y%m%d'), plate, index_set)]
+
+
+def write_tsv(path, header, rows, delimiter='\t'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(delimiter.join(header) + '\n')
+        for row in rows:
+            f.write(delimiter.join(row) + '\n')
+
+
+def ivar_variant_row(mutation, rng):
+    alt_freq = rng.choice([rng.uniform(0.05, 0.5), rng.uniform(0.75, 1.0), rng.uniform(0.75, 1.0)])
+    total_dp = rng.randint(20, 3000)
+    alt_dp = max(1, int(total_dp * alt_freq))
+    gene = mutation['gene']
+    return [
+        REF_ACCESSION, str(mutation['position']), mutation['ref'], mutation['alt'],
+        str(total_dp - alt_dp), str((total_dp - alt_dp) // 2), '35', str(alt_dp), str(alt_dp // 2), '36',
+        '%.4f' % (alt_dp / total_dp), str(total_dp), '0', 'TRUE' if alt_dp >= 10 else 'FALSE',
+        'cds-' + gene if gene else 'NA',
+        'NA', mutation.get('ref_aa', 'NA'), 'NA', mutation.get('alt_aa', 'NA'),
+        str(mutation['codon']) if gene else 'NA',
+        '%s:%s' % (gene, mutation['protein']) if gene else 'NA',
+    ]
+
+
+def aa_table_row(library_id, mutation):
+    gene = mutation['gene']
+    if gene is None:
+        return [library_id, REF_ACCESSION, str(mutation['position']), mutation['ref'], mutation['alt'], 'upstream_gene_variant', 'NA', '', 'NA']
+    return [
+        library_id, REF_ACCESSION, str(mutation['position']), mutation['ref'], mutation['alt'],
+        'missense_variant', gene, mutation['protein'], '%s-%s' % (gene, mutation['protein']),
+    ]
+
+
+def generate_run(out_dir, run_id='210501_M01234_0123_000000000-ABC12', num_libraries=94, variants_per_library=40, num_plates=1, first_container=1, seed=0):
+    """
+    Write a synthetic analysis directory for sequencing run `run_id` under
+    `out_dir`, with `num_libraries` samples over `num_plates` plates, each
+    with about `variants_per_library` SNPs. Half of each library's SNPs
+    come from a shared pool of lineage-defining mutations, so mutations
+    recur across libraries. Returns the path of the run directory.
+    """
+    rng = random.Random(seed)
+    reference = reference_sequence()
+    run_date = datetime.datetime.strptime(run_id.split('_')[0], '%y%m%d').date()
+
+    run_dir = os.path.join(out_dir, run_id)
+    artic_output_dir = os.path.join(run_dir, 'ncov2019-artic-nf-v' + ARTIC_VERSION + '-output')
+    ivar_variants_dir = os.path.join(artic_output_dir, discovery.IVAR_VARIANTS_DIR)
+    ncov_tools_output_dir = os.path.join(artic_output_dir, 'ncov-tools-v' + NCOV_TOOLS_VERSION + '-output')
+
+    lineage_mutations = [
+        [make_mutation(reference, position, rng) for position in sorted(rng.sample(range(1, GENOME_LENGTH + 1), max(1, variants_per_library // 2)))]
+        for lineage in LINEAGES
+    ]
+
+    plates = library_ids_for_run(num_libraries, num_plates, first_container)
+    metadata_rows = []
+    summary_qc_rows = []
+    for plate, library_ids in plates.items():
+        aa_table_rows = []
+        for library_id in library_ids:
+            shared = rng.choice(lineage_mutations)
+            num_private = max(0, variants_per_library - len(shared))
+            private_positions = set(rng.sample(range(1, GENOME_LENGTH + 1), num_private)) - {m['position'] for m in shared}
+            mutations = sorted(shared + [make_mutation(reference, position, rng) for position in private_positions], key=lambda m: m['position'])
+
+            write_tsv(os.path.join(ivar_variants_dir, library_id + '.variants.tsv'), IVAR_VARIANTS_HEADER, (ivar_variant_row(m, rng) for m in mutations))
+            aa_table_rows.extend(aa_table_row(library_id, m) for m in mutations)
+
+            collection_date = run_date - datetime.timedelta(days=rng.randint(3, 21))
+            metadata_rows.append([library_id, collection_date.isoformat(), '%.1f' % rng.uniform(14, 32)])
+
+            completeness = rng.choice([rng.uniform(0.95, 1.0)] * 4 + [rng.uniform(0.5, 0.9)])
+            qc_pass = 'TRUE' if completeness >= 0.9 else 'INCOMPLETE_GENOME'
+            depth = rng.uniform(200, 3000)
+            summary_qc_rows.append([
+                library_id, run_id, str(len(mutations)), str(int((1 - completeness) * GENOME_LENGTH)), '0', str(len(mutations)),
+                '0', '0', '%.2f' % depth, str(int(depth)), qc_pass, '%.4f' % completeness,
+            ])
+
+        for library_id in control_ids(run_date, plate):
+            write_tsv(os.path.join(ivar_variants_dir, library_id + '.variants.tsv'), IVAR_VARIANTS_HEADER, [])
+            metadata_rows.append([library_id, 'NA', 'NA'])
+            summary_qc_rows.append([library_id, run_id, '0', str(GENOME_LENGTH), '0', '0', '0', '0', '0.00', '0', 'INCOMPLETE_GENOME', '0.0000'])
+
+        write_tsv(os.path.join(ncov_tools_output_dir, discovery.BY_PLATE_DIR, plate, discovery.QC_ANNOTATION_DIR, plate + '_aa_table.tsv'), AA_TABLE_HEADER, aa_table_rows)
+
+    write_tsv(os.path.join(ncov_tools_output_dir, 'metadata.tsv'), METADATA_HEADER, metadata_rows)
+    write_tsv(os.path.join(ncov_tools_output_dir, discovery.QC_REPORTS_DIR, run_id + '_summary_qc.tsv'), SUMMARY_QC_HEADER, summary_qc_rows)
+
+    return run_dir
+
+
+def generate_pangolin_results(path, run_dir, seed=0):
+    """
+    Write a pangolin lineage report (CSV) for the libraries of the synthetic
+    run at `run_dir`.
+    """
+    rng = random.Random(seed)
+    run_id = os.path.basename(run_dir)
+    ivar_variants_dir = os.path.join(run_dir, 'ncov2019-artic-nf-v' + ARTIC_VERSION + '-output', discovery.IVAR_VARIANTS_DIR)
+    rows = []
+    for variants_path in discovery.Scanner().files(ivar_variants_dir, '*.tsv'):
+        library_id = os.path.basename(variants_path).split('.')[0]
+        if library_id.startswith('NEG'):
+            rows.append([run_id, library_id, 'None', '', '', '', '', '', 'PLEARN-v1.2.123', '3.1.17', '2022-01-20', 'v1.2.123', 'fail', 'seq_len:0'])
+            continue
+        lineage = rng.choice(LINEAGES)
+        rows.append([
+            run_id, library_id, lineage, '0.0', '%.4f' % rng.uniform(0.9, 1.0), '', '', '',
+            'PLEARN-v1.2.123', '3.1.17', '2022-01-20', 'v1.2.123', 'passed_qc', '',
+        ])
+    write_tsv(path, PANGOLIN_HEADER, rows, delimiter=',')
+    return path
+
+
+def main(args):
+    run_dirs = []
+    for n in range(args.runs):
+        run_date = datetime.date.fromisoformat(args.first_run_date) + datetime.timedelta(weeks=n)
+        run_id = '%s_M01234_%04d_000000000-A%04d' % (run_date.strftime('%y%m%d'), n + 1, n + 1)
+        run_dir = generate_run(
+            args.out_dir, run_id, args.libraries, args.variants_per_library, args.plates,
+            first_container=n * args.libraries + 1, seed=args.seed + n,
+        )
+        if args.pangolin:
+            generate_pangolin_results(os.path.join(args.out_dir, run_id + '_lineage_report.csv'), run_dir, seed=args.seed + n)
+        run_dirs.append(run_dir)
+
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = 'synthetic_runs_generated'
+    log_msg['out_dir'] = os.path.abspath(args.out_dir)
+    log_msg['runs'] = len(run_dirs)
+    log_msg['libraries_per_run'] = args.libraries
+    log_msg['variants_per_library'] = args.variants_per_library
+    log_msg['plates_per_run'] = args.plates
+    print(json.dumps(log_msg))
+
+    return run_dirs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_dir')
+    parser.add_argument('--runs', default=1, type=int)
+    parser.add_argument('--libraries', default=94, type=int)
+    parser.add_argument('--variants-per-library', default=40, type=int)
+    parser.add_argument('--plates', default=1, type=int)
+    parser.add_argument('--first-run-date', default='2021-05-01')
+    parser.add_argument('--pangolin', action='store_true')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    main(args)
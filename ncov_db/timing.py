@@ -0,0 +1,114 @@
+import collections
+import math
+import time
+
+
+class TimedIterator(object):
+    """
+    Wraps an iterator, adding up the time spent waiting for its items. For
+    a parser's row iterator, that is the time spent parsing, as opposed to
+    the time the consumer spends writing the rows.
+    """
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+        self.last_seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.last_seconds = time.perf_counter() - start
+            self.seconds += self.last_seconds
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of `values` (0 < pct <= 100), or None if empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def rows_per_sec(rows, seconds):
+    if seconds <= 0:
+        return None
+    return round(rows / seconds, 1)
+
+
+class LoadStats(object):
+    """
+    Per-stage (file type) totals for a load-run: files, rows, parse and
+    write time, and the time taken by each file. `commits` is set by the
+    caller once the run has been committed.
+    """
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.commits = None
+
+    def stage(self, file_type):
+        if file_type not in self.stages:
+            self.stages[file_type] = {
+                'files': 0,
+                'rows_parsed': 0,
+                'rows_inserted': 0,
+                'rows_skipped': 0,
+                'parse_seconds': 0.0,
+                'write_seconds': 0.0,
+                'elapsed_seconds': 0.0,
+                'file_seconds': [],
+            }
+        return self.stages[file_type]
+
+    def add_file(self, file_type, counts, parse_seconds, write_seconds):
+        stage = self.stage(file_type)
+        stage['files'] += 1
+        stage['rows_parsed'] += counts['parsed']
+        stage['rows_inserted'] += counts['inserted']
+        stage['rows_skipped'] += counts['skipped']
+        stage['parse_seconds'] += parse_seconds
+        stage['write_seconds'] += write_seconds
+        stage['file_seconds'].append(parse_seconds + write_seconds)
+
+    def add_stage_seconds(self, file_type, seconds):
+        self.stage(file_type)['elapsed_seconds'] += seconds
+
+    def summary(self):
+        """
+        Return the run totals and a summary of each stage, with percentiles
+        of the time taken per file, as a dict for a JSON log event.
+        """
+        summary = collections.OrderedDict()
+        for key in ['rows_parsed', 'rows_inserted', 'rows_skipped']:
+            summary[key] = sum(stage[key] for stage in self.stages.values())
+        summary['parse_seconds'] = round(sum(stage['parse_seconds'] for stage in self.stages.values()), 3)
+        summary['write_seconds'] = round(sum(stage['write_seconds'] for stage in self.stages.values()), 3)
+        summary['rows_per_sec'] = rows_per_sec(summary['rows_parsed'], sum(stage['elapsed_seconds'] for stage in self.stages.values()))
+        summary['commits'] = self.commits
+
+        stages = collections.OrderedDict()
+        for file_type, stage in self.stages.items():
+            stage_summary = collections.OrderedDict()
+            stage_summary['files'] = stage['files']
+            stage_summary['rows_parsed'] = stage['rows_parsed']
+            stage_summary['rows_inserted'] = stage['rows_inserted']
+            stage_summary['rows_skipped'] = stage['rows_skipped']
+            stage_summary['parse_seconds'] = round(stage['parse_seconds'], 3)
+            stage_summary['write_seconds'] = round(stage['write_seconds'], 3)
+            stage_summary['elapsed_seconds'] = round(stage['elapsed_seconds'], 3)
+            stage_summary['rows_per_sec'] = rows_per_sec(stage['rows_parsed'], stage['elapsed_seconds'])
+            for pct in [50, 90, 99]:
+                value = percentile(stage['file_seconds'], pct)
+                stage_summary['file_seconds_p' + str(pct)] = None if value is None else round(value, 4)
+            stage_summary['file_seconds_max'] = round(max(stage['file_seconds']), 4) if stage['file_seconds'] else None
+            stages[file_type] = stage_summary
+        summary['stages'] = stages
+
+        return summary
@@ -0,0 +1,103 @@
+import csv
+
+
+def to_int(value):
+    return int(value)
+
+
+def to_float(value):
+    return float(value)
+
+
+def to_bool(value):
+    return value.upper() in {'TRUE', 'T', '1', 'YES'}
+
+
+def null_if(null_values, convert=None):
+    """
+    Wrap `convert` so that any value in `null_values` (eg. 'NA' or '')
+    decodes to None instead of being converted.
+    """
+    null_values = frozenset(null_values)
+    if convert is None:
+        def decode(value):
+            if value in null_values:
+                return None
+            return value
+    else:
+        def decode(value):
+            if value in null_values:
+                return None
+            return convert(value)
+    return decode
+
+
+class RowDecoder(object):
+    """
+    Decodes rows of a delimited file (as lists of strings, from csv.reader)
+    into tuples.
+
+    `fields` is a list of (name, column, converter) triples. Column positions
+    are looked up in the header once, and a single decode function is
+    compiled for the whole row, so decoding a row costs one function call
+    and one tuple construction. Columns missing from the header decode to
+    None; a converter of None passes the string through unchanged.
+    """
+    def __init__(self, header, fields):
+        self.names = [name for name, column, converter in fields]
+        self.header = list(header)
+
+        column_index = {}
+        for idx, column in enumerate(self.header):
+            column_index.setdefault(column, idx)
+
+        namespace = {}
+        expressions = []
+        for idx, (name, column, converter) in enumerate(fields):
+            if column not in column_index:
+                expressions.append('None')
+            elif converter is None:
+                expressions.append('row[%d]' % column_index[column])
+            else:
+                converter_name = '_convert_%d' % idx
+                namespace[converter_name] = converter
+                expressions.append('%s(row[%d])' % (converter_name, column_index[column]))
+
+        source = 'def decode(row):\n    return (%s,)\n' % ', '.join(expressions)
+        exec(source, namespace)
+        self.decode = namespace['decode']
+
+    def index(self, name):
+        return self.names.index(name)
+
+
+def decode_rows(path, fields, delimiter='\t', on_error=None):
+    """
+    Yield a decoded tuple for every row of the delimited file at `path`.
+    The first line of the file is the header.
+
+    If `on_error` is given, a row whose values can't be converted (a
+    ValueError or TypeError from a converter) is skipped, after calling
+    on_error(row, error) with the row as a dict of column -> string.
+    Otherwise the error is raised.
+    """
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        if header is None:
+            return
+        decode = RowDecoder(header, fields).decode
+        if on_error is None:
+            for row in reader:
+                if row:
+                    yield decode(row)
+            return
+        for row in reader:
+            if not row:
+                continue
+            try:
+                values = decode(row)
+            except (ValueError, TypeError) as e:
+                on_error(dict(zip(header, row)), e)
+                continue
+            yield values
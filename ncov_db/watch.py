@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import glob
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from . import db
+from . import discovery
+from . import manifest as load_manifest
+from . import store_sequencing_run
+from . import store_sequencing_runs
+
+from .time import now
+
+
+# A run is a candidate for loading once one of these files exists (relative
+# to the run directory). The ncov-tools summary QC report is written near the
+# end of the pipeline, but it is itself an input file, and may still be being
+# written; so a candidate is only loaded once its input files are unchanged
+# between two polls (see RunWatcher).
+DEFAULT_SENTINELS = [
+    os.path.join(discovery.ARTIC_OUTPUT_DIR_PATTERN, discovery.NCOV_TOOLS_OUTPUT_DIR_PATTERN, discovery.QC_REPORTS_DIR, '*_summary_qc.tsv'),
+]
+
+# A run that fails to load is retried after RETRY_DELAY_SECONDS, doubling
+# with each further failure up to MAX_RETRY_DELAY_SECONDS.
+RETRY_DELAY_SECONDS = 60
+MAX_RETRY_DELAY_SECONDS = 3600
+
+
+def log_watch_event(event_type, **fields):
+    log_msg = collections.OrderedDict()
+    log_msg['timestamp'] = now()
+    log_msg['event_type'] = event_type
+    log_msg.update(fields)
+    print(json.dumps(log_msg), flush=True)
+
+
+def is_run_complete(run_dir, sentinels):
+    return any(glob.glob(os.path.join(glob.escape(run_dir), sentinel)) for sentinel in sentinels)
+
+
+def run_files_signature(run_dir):
+    """
+    Return the (path, size, mtime) of each of the files load-run would read
+    from `run_dir`.
+    """
+    files, artic_output_dir, ncov_tools_output_dir = discovery.find_run_files(run_dir, discovery.Scanner())
+    signature = []
+    for paths in files.values():
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+
+    return tuple(sorted(signature))
+
+
+class RunWatcher(object):
+    """
+    Finds runs under the `roots` that are complete and haven't been seen
+    before. A root is only listed again when its mtime changes (ie. when a
+    run directory is added or removed); directories that were found before
+    they were complete are checked for their sentinel files on every poll.
+
+    A run with a sentinel file is only ready once its input files have the
+    same sizes and mtimes as on the previous poll, so a run found while the
+    pipeline is still writing it isn't loaded partially. Runs that fail to
+    load can be handed back with retry(), and are ready again after a
+    delay.
+    """
+    def __init__(self, roots, sentinels, seen_run_dirs=(), retry_delay=RETRY_DELAY_SECONDS):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.sentinels = sentinels
+        self.retry_delay = retry_delay
+        self.seen = set(seen_run_dirs)
+        self.pending = set()
+        self.root_mtimes = {}
+        self.signatures = {}
+        self.failures = collections.Counter()
+        self.retry_after = {}
+        self.lock = threading.Lock()
+
+    def is_ready(self, run_dir):
+        if self.retry_after.get(run_dir, 0) > time.monotonic():
+            return False
+        if not is_run_complete(run_dir, self.sentinels):
+            return False
+        signature = run_files_signature(run_dir)
+        previous_signature = self.signatures.get(run_dir)
+        self.signatures[run_dir] = signature
+        return signature == previous_signature
+
+    def settling(self):
+        """
+        Return the pending runs that have a sentinel file, but whose input
+        files haven't yet been seen unchanged across two polls.
+        """
+        with self.lock:
+            return sorted(run_dir for run_dir in self.pending if run_dir in self.signatures and run_dir not in self.retry_after)
+
+    def list_root(self, root):
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if root in self.root_mtimes and self.root_mtimes[root] == mtime:
+            return
+        # Pipelines create the run directory before its output, so every
+        # new subdirectory is pending until its sentinel appears.
+        run_dirs = set(discovery.Scanner().dirs(root))
+        self.root_mtimes[root] = mtime
+        for run_dir in run_dirs - self.seen:
+            self.pending.add(run_dir)
+        # Forget pending runs whose directory has been removed, rather than
+        # checking them for their sentinel files forever.
+        for run_dir in [run_dir for run_dir in self.pending if os.path.dirname(run_dir) == root and run_dir not in run_dirs]:
+            self.forget(run_dir)
+
+    def forget(self, run_dir):
+        self.pending.discard(run_dir)
+        self.signatures.pop(run_dir, None)
+        self.retry_after.pop(run_dir, None)
+        self.failures.pop(run_dir, None)
+
+    def poll(self):
+        """
+        Return the runs that have become ready since the last poll. A root or
+        run that can't be read (eg. because of its permissions) is logged and
+        tried again on the next poll.
+        """
+        with self.lock:
+            for root in self.roots:
+                try:
+                    self.list_root(root)
+                except OSError as e:
+                    log_watch_event('root_list_failed', root=root, error=repr(e))
+
+            ready = []
+            for run_dir in sorted(self.pending, key=os.path.basename):
+                try:
+                    if self.is_ready(run_dir):
+                        ready.append(run_dir)
+                except OSError as e:
+                    log_watch_event('run_check_failed', run_dir=run_dir, error=repr(e))
+            for run_dir in ready:
+                self.pending.discard(run_dir)
+                self.signatures.pop(run_dir, None)
+                self.retry_after.pop(run_dir, None)
+                self.seen.add(run_dir)
+
+        return ready
+
+    def retry(self, run_dir):
+        """
+        Put a run that failed to load back in pending, to be ready again
+        after a delay that doubles with each failure. Returns the delay in
+        seconds.
+        """
+        with self.lock:
+            self.failures[run_dir] += 1
+            delay = min(self.retry_delay * 2 ** (self.failures[run_dir] - 1), MAX_RETRY_DELAY_SECONDS)
+            self.seen.discard(run_dir)
+            self.pending.add(run_dir)
+            self.retry_after[run_dir] = time.monotonic() + delay
+
+        return delay
+
+
+def poll_runs(watcher, work_queue, interval, stop):
+    """
+    Poll for ready runs every `interval` seconds and put them on
+    `work_queue`. Blocks while the queue is full, so at most its maxsize
+    runs are waiting to be loaded. A poll that fails is logged, and polling
+    continues.
+    """
+    while not stop.is_set():
+        try:
+            ready = watcher.poll()
+        except Exception as e:
+            # Keep polling; the runs are found again once whatever failed
+            # succeeds.
+            log_watch_event('poll_failed', error=repr(e))
+            ready = []
+        for run_dir in ready:
+            log_watch_event('run_ready', run_dir=run_dir)
+            while not stop.is_set():
+                try:
+                    work_queue.put(run_dir, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        stop.wait(interval)
+
+
+def watch(args, session, executor=None, once=False):
+    """
+    Load runs as they finish, through `session`, until stopped (or, with
+    `once`, after loading the runs that are ready now).
+    Returns a dict of loaded and failed run counts.
+    """
+    sentinels = getattr(args, 'sentinel', None) or DEFAULT_SENTINELS
+    watcher = RunWatcher(args.roots, sentinels, load_manifest.loaded_run_dirs(session), getattr(args, 'retry_delay', RETRY_DELAY_SECONDS))
+    counts = {
+        'loaded': 0,
+        'failed': 0,
+    }
+
+    def load(run_dir):
+        start = time.perf_counter()
+        try:
+            stats = store_sequencing_runs.load_and_commit_run(args, session, run_dir, executor)
+        except Exception as e:
+            session.rollback()
+            counts['failed'] += 1
+            store_sequencing_runs.log_run_event('load_run_failed', run_dir, error=repr(e))
+            return False
+        counts['loaded'] += 1
+        store_sequencing_runs.log_run_event('load_run_completed', run_dir, elapsed_seconds=round(time.perf_counter() - start, 3), **stats.summary())
+        return True
+
+    if once:
+        # A run is only ready once its files are unchanged between two
+        # polls, so poll again after one interval if any runs were found
+        # with their sentinel file. Runs still changing then are left for
+        # the next watch.
+        ready = watcher.poll()
+        if watcher.settling():
+            time.sleep(args.interval)
+            ready += watcher.poll()
+        for run_dir in ready:
+            log_watch_event('run_ready', run_dir=run_dir)
+            load(run_dir)
+        return counts
+
+    stop = threading.Event()
+    work_queue = queue.Queue(maxsize=getattr(args, 'queue_size', 4))
+    poller = threading.Thread(target=poll_runs, args=(watcher, work_queue, args.interval, stop), daemon=True)
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    poller.start()
+    try:
+        while not stop.is_set():
+            try:
+                run_dir = work_queue.get(timeout=1)
+            except queue.Empty:
+                if not poller.is_alive():
+                    raise RuntimeError('The run poller stopped unexpectedly')
+                continue
+            if not load(run_dir):
+                retry_seconds = watcher.retry(run_dir)
+                log_watch_event('run_retry_scheduled', run_dir=run_dir, failures=watcher.failures[run_dir], retry_in_seconds=retry_seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+        poller.join()
+
+    return counts
+
+
+def main(args, session=None):
+    sqlite_profile, sqlite_pragmas = db.args_to_sqlite_options(args)
+    jobs = getattr(args, 'jobs', 1)
+    once = getattr(args, 'once', False)
+
+    own_session = session is None
+    if own_session:
+        session = db.create_session(args.db, sqlite_profile, sqlite_pragmas)
+
+    log_watch_event('watch_started', roots=[os.path.abspath(root) for root in args.roots], interval_seconds=args.interval)
+    executor = None
+    try:
+        if jobs > 1:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+        counts = watch(args, session, executor, once)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if own_session:
+            db.close_session(session)
+
+    log_watch_event('watch_stopped', runs_loaded=counts['loaded'], runs_failed=counts['failed'])
+
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('roots', nargs='+')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--interval', default=30, type=float)
+    parser.add_argument('--sentinel', action='append', default=[])
+    parser.add_argument('--queue-size', default=4, type=int)
+    parser.add_argument('--retry-delay', default=RETRY_DELAY_SECONDS, type=float)
+    parser.add_argument('--commit-every', choices=store_sequencing_run.COMMIT_LEVELS, default='run')
+    parser.add_argument('--jobs', default=1, type=int)
+    parser.add_argument('--batch-size', default=1000, type=int)
+    parser.add_argument('--pragma', action='append', default=[])
+    parser.add_argument('--once', action='store_true')
+    args = parser.parse_args()
+    main(args)
@@ -14,6 +14,10 @@ setup(
     packages=find_packages(exclude=('tests', 'tests.*')),
     python_requires='>=3.5',
     install_requires=Path('requirements.txt').read_text(),
+    extras_require={
+        'export': ['pyarrow'],
+        'matrix': ['numpy'],
+    },
     setup_requires=['pytest-runner', 'flake8'],
     tests_require=Path('requirements-tests.txt').read_text(),
     entry_points = {
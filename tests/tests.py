@@ -1,19 +1,44 @@
 #!/usr/bin/env python
 
+import argparse
+import collections
+import functools
+import io
+import json
 import os
+import queue
 import string
+import threading
 
-from datetime import date
+from datetime import date, timedelta
 
 import alembic
 import alembic.config
+import pytest
 import sqlalchemy as sa
 import sqlalchemy.orm as sao
 
 from hypothesis import settings, example, given, Verbosity, strategies as st
 from hypothesis_sqlalchemy import tabular
 
-import ncov_db.model as model
+import ncov_db.allele_matrix as allele_matrix
+import ncov_db.bulk as bulk
+import ncov_db.db as db
+import ncov_db.discovery as discovery
+import ncov_db.entities as entities
+import ncov_db.export as export
+import ncov_db.indexes as indexes
+import ncov_db.manifest as manifest
+import ncov_db.models as model
+import ncov_db.mutation_index as mutation_index
+import ncov_db.query as query
+import ncov_db.rollups as rollups
+import ncov_db.store_metadata_tsv as store_metadata_tsv
+import ncov_db.store_pangolin_results as store_pangolin_results
+import ncov_db.store_sequencing_run as store_sequencing_run
+import ncov_db.store_sequencing_runs as store_sequencing_runs
+import ncov_db.synthetic as synthetic
+import ncov_db.watch as watch
 
 
 connection_string = "sqlite+pysqlite:///:memory:"
@@ -67,12 +92,12 @@ def test_hypothesis_sqlalchemy(container_id, **kwargs):
     session = Session()
 
     created_container = model.Container()
-    created_container.container_id=container_id
+    created_container.id=container_id
     created_container.collection_date=kwargs['collection_date']
 
     existing_container = (
         session.query(model.Container)
-        .filter(model.Container.container_id == container_id)
+        .filter(model.Container.id == container_id)
         .one_or_none()
     )
 
@@ -82,13 +107,728 @@ def test_hypothesis_sqlalchemy(container_id, **kwargs):
         
     retrieved_container = (
         session.query(model.Container)
-        .filter(model.Container.container_id == container_id)
+        .filter(model.Container.id == container_id)
         .one_or_none()
     )
 
-    assert retrieved_container.container_id == created_container.container_id
+    assert retrieved_container.id == created_container.id
 
 
+def migrate(db_path, command, revision):
+    with sa.create_engine('sqlite:///' + db_path).begin() as connection:
+        alembic_cfg.attributes['connection'] = connection
+        command(alembic_cfg, revision)
+
+
+def init_db(tmp_path, revision='head'):
+    db_path = str(tmp_path / 'ncov.db')
+    migrate(db_path, alembic.command.upgrade, revision)
+
+    return db_path
+
+
+def read_table(db_path, table):
+    with sa.create_engine('sqlite:///' + db_path).connect() as connection:
+        return sorted(tuple(row) for row in connection.execute(sa.select(table)))
+
+
+def test_load_synthetic_run(tmp_path):
+    db_path = init_db(tmp_path)
+
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=20, variants_per_library=10, num_plates=2)
+    args = argparse.Namespace(db=db_path, run_dir=run_dir)
+    store_sequencing_run.main(args)
+
+    with sa.create_engine('sqlite:///' + db_path).connect() as connection:
+        num_libraries = connection.execute(sa.select(sa.func.count()).select_from(model.NcovToolsSummaryQC)).scalar()
+        num_aa_mutations = connection.execute(sa.select(sa.func.count()).select_from(model.NcovToolsAminoAcidMutation)).scalar()
+        loaded_runs = connection.execute(sa.select(model.LoadedRun.run_dir)).scalars().all()
+        num_variants = connection.execute(sa.select(sa.func.count()).select_from(model.VariantIvar).where(model.VariantIvar.library_id.isnot(None))).scalar()
+        num_encoded_variants = connection.execute(sa.select(sa.func.count()).select_from(model.VariantIvarEncoded)).scalar()
+
+    # 20 samples, plus a positive and negative control on each plate.
+    assert num_libraries == 24
+    assert num_aa_mutations == 20 * 10
+    assert loaded_runs == [run_dir]
+    # The variant_ivar view decodes every row of variant_ivar_encoded.
+    assert num_variants == num_encoded_variants > 0
+
+
+def test_summary_qc_malformed_row_is_skipped(tmp_path, capsys):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=20, variants_per_library=10)
+    qc_summary_path = discovery.discover_run_files(run_dir)['ncov_tools_summary_qc'][0]
+    with open(qc_summary_path) as f:
+        lines = f.readlines()
+    header = lines[0].rstrip('\n').split('\t')
+    bad_row = lines[1].rstrip('\n').split('\t')
+    bad_row[header.index('num_consensus_snvs')] = 'NA'
+    lines[1] = '\t'.join(bad_row) + '\n'
+    with open(qc_summary_path, 'w') as f:
+        f.writelines(lines)
+
+    store_sequencing_run.main(argparse.Namespace(db=db_path, run_dir=run_dir))
+    loading_errors = [line for line in capsys.readouterr().out.splitlines() if '"loading_error"' in line]
+
+    qc_library_ids = [row[0] for row in read_table(db_path, model.NcovToolsSummaryQC.__table__.c.library_id)]
+    # 20 samples and 2 controls, less the malformed row.
+    assert len(qc_library_ids) == 21
+    assert bad_row[header.index('sample')] not in qc_library_ids
+    assert any(bad_row[header.index('sample')] in line for line in loading_errors)
+
+    # The rollups refreshed during the load match a rebuild from scratch.
+    library_counts = read_table(db_path, model.LibraryCountRollup.__table__)
+    mutation_prevalence = read_table(db_path, model.MutationPrevalenceRollup.__table__)
+    # Controls have no collection date, so only the 19 loaded samples are counted.
+    assert sum(row[2] for row in library_counts) == 19
+    session = db.create_session(db_path)
+    rollups.rebuild_rollups(session)
+    session.commit()
+    db.close_session(session)
+    assert read_table(db_path, model.LibraryCountRollup.__table__) == library_counts
+    assert read_table(db_path, model.MutationPrevalenceRollup.__table__) == mutation_prevalence
+
+
+def test_savepoint_rollback_keeps_session_state(tmp_path):
+    session = db.create_session(init_db(tmp_path))
+    entity_cache = entities.get_entity_cache(session)
+    rollups.mark_changed(session, sequencing_run_ids=['run'])
+
+    with pytest.raises(ValueError):
+        with session.begin_nested():
+            raise ValueError()
+    assert session.info['rollups_changed']['sequencing_run_ids'] == {'run'}
+    assert entities.get_entity_cache(session) is entity_cache
+
+    session.rollback()
+    assert 'rollups_changed' not in session.info
+    assert entities.get_entity_cache(session) is not entity_cache
+    db.close_session(session)
+
+
+def generate_runs(tmp_path, num_runs, **kwargs):
+    """
+    Generate `num_runs` synthetic runs a week apart, with distinct containers.
+    """
+    return [
+        synthetic.generate_run(
+            str(tmp_path), run_id='2105%02d_M01234_%04d_000000000-ABC%02d' % (1 + 7 * n, n + 1, n),
+            first_container=1 + 1000 * n, seed=n, **kwargs
+        )
+        for n in range(num_runs)
+    ]
+
+
+def load_run(db_path, run_dir, **kwargs):
+    return store_sequencing_run.main(argparse.Namespace(db=db_path, run_dir=run_dir, **kwargs))
+
+
+def read_events(capsys, event_type):
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    return [event for event in events if event['event_type'] == event_type]
+
+
+def load_pangolin_results(db_path, pangolin_results_path):
+    return store_pangolin_results.main(argparse.Namespace(db=db_path, pangolin_results=pangolin_results_path))
+
+
+
+def test_manifest_skips_unchanged_files(tmp_path, capsys):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=10, variants_per_library=10)
+    load_run(db_path, run_dir)
+    loaded = read_events(capsys, 'file_loaded')
+    variants = read_table(db_path, model.VariantIvarEncoded.__table__)
+    qc_summaries = read_table(db_path, model.NcovToolsSummaryQC.__table__)
+
+    load_run(db_path, run_dir)
+    assert read_events(capsys, 'file_loaded') == []
+
+    # A touched file with the same content is still skipped; a modified one
+    # is loaded again.
+    qc_summary_path = discovery.discover_run_files(run_dir)['ncov_tools_summary_qc'][0]
+    os.utime(qc_summary_path, (0, 0))
+    metadata_path = discovery.discover_run_files(run_dir)['metadata_tsv'][0]
+    with open(metadata_path, 'a') as f:
+        f.write('R999999999-1000-1-A01\t2021-04-01\t20.0\n')
+    load_run(db_path, run_dir)
+    assert [event['filename'] for event in read_events(capsys, 'file_loaded')] == [os.path.basename(metadata_path)]
+
+    load_run(db_path, run_dir, force_reload=True)
+    assert len(read_events(capsys, 'file_loaded')) == len(loaded)
+    assert read_table(db_path, model.VariantIvarEncoded.__table__) == variants
+    assert read_table(db_path, model.NcovToolsSummaryQC.__table__) == qc_summaries
+
+
+def test_manifest_records_file_state_from_before_the_load(tmp_path, capsys, monkeypatch):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=10, variants_per_library=10)
+    metadata_path = discovery.discover_run_files(run_dir)['metadata_tsv'][0]
+
+    # The metadata file is appended to while it's being loaded.
+    parse_metadata_tsv = store_metadata_tsv.parse_metadata_tsv
+    def parse_and_modify(path):
+        yield from parse_metadata_tsv(path)
+        with open(path, 'a') as f:
+            f.write('R999999999-1000-1-A01\t2021-04-01\t20.0\n')
+    monkeypatch.setattr(store_metadata_tsv, 'parse_metadata_tsv', parse_and_modify)
+    load_run(db_path, run_dir)
+    monkeypatch.undo()
+    capsys.readouterr()
+
+    load_run(db_path, run_dir)
+    assert [event['filename'] for event in read_events(capsys, 'file_loaded')] == [os.path.basename(metadata_path)]
+
+    # A touched file is hashed once to tell that it's unchanged.
+    hashed_paths = []
+    file_content_hash = manifest.file_content_hash
+    def count_hashes(path, *args):
+        hashed_paths.append(path)
+        return file_content_hash(path, *args)
+    monkeypatch.setattr(manifest, 'file_content_hash', count_hashes)
+    os.utime(metadata_path, (0, 0))
+    load_run(db_path, run_dir)
+    assert read_events(capsys, 'file_loaded') == []
+    assert hashed_paths == [os.path.abspath(metadata_path)]
+
+
+def query_output(query_fn, *args, **kwargs):
+    out = io.StringIO()
+    query_fn(*args, output_format='json', out=out, **kwargs)
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_query_output(tmp_path):
+    db_path = init_db(tmp_path)
+    run_dirs = generate_runs(tmp_path, 2, num_libraries=20, variants_per_library=10)
+    for n, run_dir in enumerate(run_dirs):
+        load_run(db_path, run_dir)
+        load_pangolin_results(db_path, synthetic.generate_pangolin_results(str(tmp_path / 'lineage_report_{}.csv'.format(n)), run_dir, seed=n))
+    session = db.create_session(db_path)
+
+    # Lineage counts, computed here from the decoded pangolin results.
+    collection_dates = dict(session.execute(
+        sa.select(model.Library.__table__.c.id, model.Container.__table__.c.collection_date)
+        .join(model.Container.__table__, model.Container.__table__.c.id == model.Library.__table__.c.container_id)
+    ).all())
+    libraries_by_week = collections.defaultdict(set)
+    for library_id, lineage in session.execute(sa.select(model.PangolinResult.library_id, model.PangolinResult.lineage)):
+        collection_date = collection_dates.get(library_id)
+        if collection_date is not None:
+            week_start = collection_date - timedelta(days=collection_date.weekday())
+            libraries_by_week[(week_start.isoformat(), lineage)].add(library_id)
+    expected = [
+        {'week_start': week_start, 'lineage': lineage, 'num_libraries': len(library_ids)}
+        for (week_start, lineage), library_ids in sorted(libraries_by_week.items())
+    ]
+    assert expected
+    assert query_output(query.lineage_counts_by_week, session) == expected
+    assert query_output(query.lineage_counts_by_week, session, lineage='BA.1') == [row for row in expected if row['lineage'] == 'BA.1']
+    # From the Monday of the second week to the Sunday of the last but one.
+    weeks = sorted(set(row['week_start'] for row in expected))
+    since = weeks[1]
+    until = (date.fromisoformat(weeks[-2]) + timedelta(days=6)).isoformat()
+    in_range = [row for row in expected if since <= row['week_start'] <= until]
+    assert 0 < len(in_range) < len(expected)
+    assert query_output(query.lineage_counts_by_week, session, since=since, until=until) == in_range
+
+    qc_failure_rates = query_output(query.qc_failure_rate_by_run, session)
+    assert [row['sequencing_run_id'] for row in qc_failure_rates] == [os.path.basename(run_dir) for run_dir in run_dirs]
+    for row in qc_failure_rates:
+        qc_passes = session.execute(
+            sa.select(model.NcovToolsSummaryQC.qc_pass).where(model.NcovToolsSummaryQC.sequencing_run_id == row['sequencing_run_id'])
+        ).scalars().all()
+        assert row['num_libraries'] == len(qc_passes)
+        assert row['num_failed'] == qc_passes.count(False)
+        assert query_output(query.qc_failure_rate_by_run, session, sequencing_run_id=row['sequencing_run_id']) == [row]
+
+    mutation = session.execute(
+        sa.select(model.VariantIvar.mutation_name_by_amino_acid)
+        .where(model.VariantIvar.mutation_name_by_amino_acid.isnot(None))
+        .group_by(model.VariantIvar.mutation_name_by_amino_acid)
+        .order_by(sa.func.count().desc())
+    ).scalars().first()
+    library_ids = session.execute(
+        sa.select(model.VariantIvar.library_id.distinct()).where(model.VariantIvar.mutation_name_by_amino_acid == mutation).order_by(model.VariantIvar.library_id)
+    ).scalars().all()
+    assert [row['library_id'] for row in query_output(query.libraries_with_mutation, session, mutation)] == library_ids
+    db.close_session(session)
+
+
+def read_rollups(db_path):
+    return read_table(db_path, model.LibraryCountRollup.__table__), read_table(db_path, model.MutationPrevalenceRollup.__table__)
+
+
+def rebuilt_rollups(db_path):
+    """
+    Rebuild the rollups from scratch, returning them along with the rollups
+    the loads had left.
+    """
+    refreshed = read_rollups(db_path)
+    session = db.create_session(db_path)
+    rollups.rebuild_rollups(session)
+    session.commit()
+    db.close_session(session)
+
+    return refreshed, read_rollups(db_path)
+
+
+def test_rollups_refreshed_on_reload(tmp_path):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=10, variants_per_library=10)
+    load_run(db_path, run_dir)
+    refreshed, rebuilt = rebuilt_rollups(db_path)
+    assert refreshed == rebuilt
+    assert sum(row[2] for row in refreshed[0]) == 10
+
+    # Rewrite the run with more libraries, and load it again.
+    synthetic.generate_run(str(tmp_path), num_libraries=20, variants_per_library=10)
+    load_run(db_path, run_dir)
+    refreshed, rebuilt = rebuilt_rollups(db_path)
+    assert refreshed == rebuilt
+    assert sum(row[2] for row in refreshed[0]) == 20
+
+
+def fail_once(monkeypatch, module, name):
+    """
+    Make `module.name` raise the first time it's called.
+    """
+    fn = getattr(module, name)
+    calls = []
+    def fail_first_call(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError('{} failed'.format(name))
+        return fn(*args, **kwargs)
+    monkeypatch.setattr(module, name, fail_first_call)
+
+
+@pytest.mark.parametrize('commit_every', ['stage', 'file'])
+def test_derived_tables_after_load_fails_past_a_commit(tmp_path, monkeypatch, commit_every):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=10, variants_per_library=10)
+
+    # The load fails after its files have been committed, and is retried.
+    fail_once(monkeypatch, store_sequencing_run.load_manifest, 'record_loaded_run')
+    with pytest.raises(RuntimeError):
+        load_run(db_path, run_dir, commit_every=commit_every)
+    load_run(db_path, run_dir, commit_every=commit_every)
+
+    assert read_table(db_path, model.LoadedRun.__table__.c.run_dir) == [(run_dir,)]
+    refreshed, rebuilt = rebuilt_rollups(db_path)
+    assert refreshed == rebuilt
+    assert refreshed[1]
+
+    # The mutation index covers the run's libraries, as when loaded in one go.
+    session = db.create_session(db_path)
+    mutation_index_libraries = session.execute(sa.select(mutation_index.mutation_index_library.c.library_id)).scalars().all()
+    mutation_index.rebuild_mutation_index(session)
+    session.commit()
+    assert sorted(mutation_index_libraries) == sorted(session.execute(sa.select(mutation_index.mutation_index_library.c.library_id)).scalars())
+    assert mutation_index_libraries
+    db.close_session(session)
+
+
+CO_OCCURRENCE_SQL = """
+SELECT DISTINCT a.library_id
+FROM ncov_tools_amino_acid_mutation AS a
+JOIN ncov_tools_amino_acid_mutation AS b ON b.library_id = a.library_id
+WHERE a.mutation_name_by_amino_acid = :first
+  AND b.mutation_name_by_amino_acid = :second
+  AND NOT EXISTS (
+    SELECT 1 FROM ncov_tools_amino_acid_mutation AS c
+    WHERE c.library_id = a.library_id AND c.mutation_name_by_amino_acid = :without
+  )
+"""
+
+
+def test_mutation_co_occurrence_matches_join(tmp_path):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=40, variants_per_library=6)
+    load_run(db_path, run_dir)
+    session = db.create_session(db_path)
+
+    aa_mutation = model.NcovToolsAminoAcidMutation.__table__
+    mutations_by_library = collections.defaultdict(set)
+    for library_id, mutation in session.execute(sa.select(aa_mutation.c.library_id, aa_mutation.c.mutation_name_by_amino_acid)):
+        if mutation is not None:
+            mutations_by_library[library_id].add(mutation)
+    mutation_counts = collections.Counter(mutation for mutations in mutations_by_library.values() for mutation in mutations)
+    first, second = [mutation for mutation, count in mutation_counts.most_common(2)]
+    # A mutation that some, but not all, of the libraries with both carry.
+    with_both = [mutations - {first, second} for mutations in mutations_by_library.values() if {first, second} <= mutations]
+    without = sorted(set.union(*with_both) - set.intersection(*with_both))[0]
+
+    params = {'first': first, 'second': second, 'without': without}
+    expected = sorted(session.execute(sa.text(CO_OCCURRENCE_SQL), params).scalars())
+    assert 0 < len(expected) < len(with_both)
+    assert sorted(mutation_index.libraries_with_mutations(session, all_of=[first, second], none_of=[without])) == expected
+
+    any_of = set(session.execute(
+        sa.select(aa_mutation.c.library_id).where(aa_mutation.c.mutation_name_by_amino_acid.in_([first, without]))
+    ).scalars())
+    assert set(mutation_index.libraries_with_mutations(session, any_of=[first, without])) == any_of
+
+    # The index kept up to date by the load matches one rebuilt from scratch.
+    mutation_index.rebuild_mutation_index(session)
+    assert sorted(mutation_index.libraries_with_mutations(session, all_of=[first, second], none_of=[without])) == expected
+    db.close_session(session)
+
+
+
+def export_db(db_path, export_fn, path):
+    session = db.create_session(db_path)
+    result = export_fn(session, path)
+    db.close_session(session)
+
+    return result
+
+
+def exported_files(out_dir):
+    exported = {}
+    for dir_path, dir_names, filenames in os.walk(out_dir):
+        for filename in filenames:
+            if filename != export.STATE_FILENAME:
+                path = os.path.join(dir_path, filename)
+                exported[os.path.relpath(path, out_dir)] = path
+    return exported
+
+
+def test_incremental_export(tmp_path):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    db_path = init_db(tmp_path)
+    first_run_dir, second_run_dir = generate_runs(tmp_path, 2, num_libraries=10, variants_per_library=10)
+    out_dir = str(tmp_path / 'export')
+
+    load_run(db_path, first_run_dir)
+    load_pangolin_results(db_path, synthetic.generate_pangolin_results(str(tmp_path / 'lineage_report_0.csv'), first_run_dir))
+    export_db(db_path, export.export, out_dir)
+    first_export = {path: os.stat(full_path).st_mtime_ns for path, full_path in exported_files(out_dir).items()}
+    assert len(first_export) == len(export.EXPORT_TABLES)
+
+    # Only the new run's partitions are written by the next export.
+    load_run(db_path, second_run_dir)
+    load_pangolin_results(db_path, synthetic.generate_pangolin_results(str(tmp_path / 'lineage_report_1.csv'), second_run_dir))
+    export_db(db_path, export.export, out_dir)
+    second_export = exported_files(out_dir)
+    assert {path: os.stat(full_path).st_mtime_ns for path, full_path in second_export.items() if path in first_export} == first_export
+    assert len(second_export) == 2 * len(first_export)
+    state = export.read_state(out_dir)
+    assert sorted(state['tables']) == sorted(export.EXPORT_TABLES)
+    for table_state in state['tables'].values():
+        assert sorted(table_state['partitions']) == [os.path.basename(first_run_dir), os.path.basename(second_run_dir)]
+
+    full_out_dir = str(tmp_path / 'full_export')
+    export_db(db_path, export.export, full_out_dir)
+    full_export = exported_files(full_out_dir)
+    assert sorted(full_export) == sorted(second_export)
+    for path in full_export:
+        assert pyarrow_parquet.read_table(second_export[path]).equals(pyarrow_parquet.read_table(full_export[path]))
+
+
+def test_export_rewrites_changed_partitions(tmp_path):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=10, variants_per_library=10)
+    load_run(db_path, run_dir)
+    run_out_dir = str(tmp_path / 'by_run')
+    month_out_dir = str(tmp_path / 'by_month')
+    export_db(db_path, export.export, run_out_dir)
+    export_db(db_path, functools.partial(export.export, partition_by='collection_month'), month_out_dir)
+    assert not os.path.exists(os.path.join(run_out_dir, 'pangolin_result'))
+
+    # Pangolin results loaded later for the exported run are exported.
+    load_pangolin_results(db_path, synthetic.generate_pangolin_results(str(tmp_path / 'lineage_report.csv'), run_dir))
+    export_db(db_path, export.export, run_out_dir)
+    pangolin_result_paths = list(exported_files(os.path.join(run_out_dir, 'pangolin_result')).values())
+    assert [pyarrow_parquet.read_table(path).num_rows for path in pangolin_result_paths] == [12]
+
+    # Every library moves to a month of its own; the old months' partitions
+    # are removed.
+    session = db.create_session(db_path)
+    container_ids = session.execute(sa.select(model.Container.id).order_by(model.Container.id)).scalars().all()
+    for n, container_id in enumerate(container_ids):
+        session.execute(sa.update(model.Container.__table__).where(model.Container.id == container_id).values(collection_date=date(2020, 1 + n, 1)))
+    session.commit()
+    db.close_session(session)
+    export_db(db_path, functools.partial(export.export, partition_by='collection_month'), month_out_dir)
+    full_out_dir = str(tmp_path / 'full_by_month')
+    export_db(db_path, functools.partial(export.export, partition_by='collection_month', full=True), full_out_dir)
+    month_export = exported_files(month_out_dir)
+    full_export = exported_files(full_out_dir)
+    assert sorted(month_export) == sorted(full_export)
+    assert any('collection_month=2020-10' in path for path in month_export)
+    for path in full_export:
+        assert pyarrow_parquet.read_table(month_export[path]).equals(pyarrow_parquet.read_table(full_export[path]))
+
+
+def test_allele_matrix_append(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    db_path = init_db(tmp_path)
+    first_run_dir, second_run_dir = generate_runs(tmp_path, 2, num_libraries=10, variants_per_library=10)
+    matrix_path = str(tmp_path / 'alleles.npy')
+
+    load_run(db_path, first_run_dir)
+    assert export_db(db_path, allele_matrix.export_allele_matrix, matrix_path) == 12
+    first_index = allele_matrix.read_library_index(matrix_path)
+
+    load_run(db_path, second_run_dir)
+    assert export_db(db_path, allele_matrix.export_allele_matrix, matrix_path) == 12
+    assert export_db(db_path, allele_matrix.export_allele_matrix, matrix_path) == 0
+    matrix, library_index = allele_matrix.open_allele_matrix(matrix_path)
+    assert library_index[:12] == first_index
+    assert numpy.load(matrix_path).shape == (24, allele_matrix.GENOME_LENGTH)
+
+    full_matrix_path = str(tmp_path / 'full_alleles.npy')
+    export_db(db_path, allele_matrix.export_allele_matrix, full_matrix_path)
+    full_matrix, full_library_index = allele_matrix.open_allele_matrix(full_matrix_path)
+    assert library_index == full_library_index
+    assert numpy.array_equal(matrix, full_matrix)
+    assert matrix.any()
+
+    # An export interrupted before the library index was written leaves rows
+    # past its end, which the next export overwrites.
+    index_path = allele_matrix.library_index_path(matrix_path)
+    with open(index_path) as f:
+        lines = f.readlines()
+    with open(index_path, 'w') as f:
+        f.writelines(lines[:1 + 12])
+    with open(matrix_path, 'ab') as f:
+        f.write(b'\xff' * allele_matrix.GENOME_LENGTH)
+    assert allele_matrix.open_allele_matrix(matrix_path)[0].shape == (12, allele_matrix.GENOME_LENGTH)
+    assert export_db(db_path, allele_matrix.export_allele_matrix, matrix_path) == 12
+    matrix, library_index = allele_matrix.open_allele_matrix(matrix_path)
+    assert library_index == full_library_index
+    assert numpy.array_equal(numpy.load(matrix_path), numpy.asarray(full_matrix))
+
+
+
+def corrupt_variants_file(run_dir):
+    """
+    Make one of the run's ivar variants files unloadable. Returns a function
+    that restores it.
+    """
+    variants_path = sorted(discovery.discover_run_files(run_dir)['ivar_variants_tsv'])[-1]
+    with open(variants_path) as f:
+        content = f.read()
+    lines = content.split('\n')
+    fields = lines[1].split('\t')
+    fields[1] = 'notanint'
+    lines[1] = '\t'.join(fields)
+    with open(variants_path, 'w') as f:
+        f.write('\n'.join(lines))
+
+    def restore():
+        with open(variants_path, 'w') as f:
+            f.write(content)
+
+    return restore
+
+
+def index_names(db_path):
+    with sa.create_engine('sqlite:///' + db_path).connect() as connection:
+        return set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+
+
+def load_runs(db_path, run_dirs, **kwargs):
+    return store_sequencing_runs.main(argparse.Namespace(db=db_path, run_dirs=run_dirs, defer_indexes=True, **kwargs))
+
+
+def test_load_runs_resume(tmp_path):
+    db_path = init_db(tmp_path)
+    secondary_indexes = set(index_name for index_name, table, columns in indexes.SECONDARY_INDEXES)
+    run_dirs = generate_runs(tmp_path, 3, num_libraries=10, variants_per_library=10)
+    restore = corrupt_variants_file(run_dirs[1])
+
+    # The failed run is rolled back, and the indexes dropped for the load
+    # are rebuilt whether or not the load stops at the failure.
+    assert load_runs(db_path, run_dirs, keep_going=True) == {'loaded': 2, 'skipped': 0, 'failed': 1}
+    assert secondary_indexes <= index_names(db_path)
+    assert read_table(db_path, model.LoadedRun.__table__.c.run_dir) == [(run_dirs[0],), (run_dirs[2],)]
+    assert os.path.basename(run_dirs[1]) not in [row[0] for row in read_table(db_path, model.NcovToolsSummaryQC.__table__.c.sequencing_run_id)]
+    with pytest.raises(ValueError):
+        load_runs(db_path, run_dirs)
+    assert secondary_indexes <= index_names(db_path)
+
+    # Loading again only loads the run that failed.
+    restore()
+    assert load_runs(db_path, run_dirs) == {'loaded': 1, 'skipped': 2, 'failed': 0}
+    assert read_table(db_path, model.LoadedRun.__table__.c.run_dir) == [(run_dir,) for run_dir in run_dirs]
+    refreshed, rebuilt = rebuilt_rollups(db_path)
+    assert refreshed == rebuilt
+
+
+def test_watch_once(tmp_path):
+    db_path = init_db(tmp_path)
+    root = tmp_path / 'runs'
+    first_run_dir, second_run_dir = generate_runs(root, 2, num_libraries=10, variants_per_library=10)
+    # A run whose pipeline hasn't finished yet.
+    os.remove(discovery.discover_run_files(second_run_dir)['ncov_tools_summary_qc'][0])
+    args = argparse.Namespace(db=db_path, roots=[str(root)], interval=0.1, once=True)
+
+    assert watch.main(args) == {'loaded': 1, 'failed': 0}
+    assert read_table(db_path, model.LoadedRun.__table__.c.run_dir) == [(first_run_dir,)]
+
+    # Once the second run finishes, it's loaded; loaded runs aren't loaded
+    # again.
+    generate_runs(root, 2, num_libraries=10, variants_per_library=10)
+    assert watch.main(args) == {'loaded': 1, 'failed': 0}
+    assert watch.main(args) == {'loaded': 0, 'failed': 0}
+    assert read_table(db_path, model.LoadedRun.__table__.c.run_dir) == [(first_run_dir,), (second_run_dir,)]
+
+
+def test_watcher_forgets_removed_run_dirs(tmp_path):
+    root = tmp_path / 'runs'
+    run_dir = root / '210501_M01234_0001_000000000-ABC00'
+    run_dir.mkdir(parents=True)
+    watcher = watch.RunWatcher([str(root)], watch.DEFAULT_SENTINELS)
+
+    assert watcher.poll() == []
+    assert watcher.pending == {str(run_dir)}
+    run_dir.rmdir()
+    assert watcher.poll() == []
+    assert watcher.pending == set()
+
+
+def test_watcher_keeps_polling_after_errors(tmp_path, monkeypatch, capsys):
+    root = tmp_path / 'runs'
+    run_dir, = generate_runs(root, 1, num_libraries=2, variants_per_library=2)
+    watcher = watch.RunWatcher([str(root)], watch.DEFAULT_SENTINELS)
+
+    # A run that can't be read is checked again on the next poll.
+    run_files_signature = watch.run_files_signature
+    def unreadable_run(path):
+        monkeypatch.setattr(watch, 'run_files_signature', run_files_signature)
+        raise PermissionError(path)
+    monkeypatch.setattr(watch, 'run_files_signature', unreadable_run)
+    assert watcher.poll() == []
+    assert [event['run_dir'] for event in read_events(capsys, 'run_check_failed')] == [run_dir]
+
+    # A poll that fails doesn't stop the poller.
+    fail_once(monkeypatch, watcher, 'poll')
+    work_queue = queue.Queue()
+    stop = threading.Event()
+    poller = threading.Thread(target=watch.poll_runs, args=(watcher, work_queue, 0.01, stop))
+    poller.start()
+    try:
+        assert work_queue.get(timeout=10) == run_dir
+    finally:
+        stop.set()
+        poller.join()
+    assert len(read_events(capsys, 'poll_failed')) == 1
+
+
+def test_failed_pangolin_load_is_rolled_back_and_profiled(tmp_path, monkeypatch):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=10, variants_per_library=10)
+    pangolin_results_path = synthetic.generate_pangolin_results(str(tmp_path / 'lineage_report.csv'), run_dir)
+    args = argparse.Namespace(db=db_path, pangolin_results=pangolin_results_path, batch_size=4, profile=str(tmp_path / 'profile'))
+
+    # The load fails after its first batch has been written.
+    insert_ignore_duplicates = bulk.insert_ignore_duplicates
+    calls = []
+    def fail_second_batch(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError('insert_ignore_duplicates failed')
+        return insert_ignore_duplicates(*args, **kwargs)
+    monkeypatch.setattr(bulk, 'insert_ignore_duplicates', fail_second_batch)
+    with pytest.raises(RuntimeError):
+        store_pangolin_results.main(args)
+
+    assert read_table(db_path, model.PangolinResult.__table__) == []
+    assert os.path.exists(tmp_path / 'profile' / 'pangolin_results.prof')
+    monkeypatch.undo()
+    counts = store_pangolin_results.main(args)
+    assert counts['inserted'] == counts['parsed'] == len(read_table(db_path, model.PangolinResult.__table__))
+
+
+def test_pangolin_results_only_new_are_stored(tmp_path):
+    db_path = init_db(tmp_path)
+    run_dir = synthetic.generate_run(str(tmp_path), num_libraries=10, variants_per_library=10)
+    pangolin_results_path = synthetic.generate_pangolin_results(str(tmp_path / 'lineage_report.csv'), run_dir)
+    load_run(db_path, run_dir)
+
+    assert load_pangolin_results(db_path, pangolin_results_path) == {'parsed': 12, 'inserted': 12, 'skipped': 0}
+    pangolin_results = read_table(db_path, model.PangolinResult.__table__)
+    assert load_pangolin_results(db_path, pangolin_results_path) == {'parsed': 12, 'inserted': 0, 'skipped': 12}
+
+    # Results from another pangolin version are new.
+    with open(pangolin_results_path) as f:
+        lines = f.readlines()
+    with open(pangolin_results_path, 'a') as f:
+        f.write(lines[1].replace('3.1.17', '3.1.20'))
+    assert load_pangolin_results(db_path, pangolin_results_path) == {'parsed': 13, 'inserted': 1, 'skipped': 12}
+    assert len(read_table(db_path, model.PangolinResult.__table__)) == len(pangolin_results) + 1
+
+
+def metadata_record(library_id, collection_date=None, ct_value=None):
+    return {
+        'library_id': library_id,
+        'collection_date': None if collection_date is None else date.fromisoformat(collection_date),
+        'ct_value': ct_value,
+    }
+
+
+def test_metadata_staging_merge(tmp_path):
+    db_path = init_db(tmp_path)
+    session = db.create_session(db_path)
+    counts = store_metadata_tsv.store_metadata_records(session, [
+        metadata_record('C1-1000-1-A01', '2021-01-01'),
+    ])
+    assert counts == {'parsed': 1, 'inserted': 1, 'updated': 0, 'skipped': 0}
+
+    counts = store_metadata_tsv.store_metadata_records(session, [
+        # An existing container keeps its collection date, but a missing ct
+        # value is filled in.
+        metadata_record('C1-1000-1-A01', '2021-02-01', 20.0),
+        # A repeated container keeps its first non-null values.
+        metadata_record('C2-1000-1-A02'),
+        metadata_record('C2-1001-1-A02', '2021-03-01', 25.0),
+        metadata_record('C2-1002-1-A02', '2021-03-02', 26.0),
+        # Controls have no container.
+        metadata_record('POS-210501-1000-1'),
+    ])
+    assert counts == {'parsed': 5, 'inserted': 1, 'updated': 1, 'skipped': 3}
+    session.commit()
+    assert read_table(db_path, model.Container.__table__) == [
+        ('C1', date(2021, 1, 1)),
+        ('C2', date(2021, 3, 1)),
+    ]
+    assert read_table(db_path, model.QpcrResult.__table__) == [('C1', 20.0), ('C2', 25.0)]
+
+    # With force_update, collection dates are overwritten by the last record.
+    counts = store_metadata_tsv.store_metadata_records(session, [
+        metadata_record('C1-1000-1-A01', '2021-04-01', 30.0),
+        metadata_record('C1-1000-1-A01', '2021-04-02'),
+    ], force_update=True)
+    assert counts == {'parsed': 2, 'inserted': 0, 'updated': 1, 'skipped': 1}
+    session.commit()
+    assert read_table(db_path, model.Container.__table__)[0] == ('C1', date(2021, 4, 2))
+    assert read_table(db_path, model.QpcrResult.__table__)[0] == ('C1', 20.0)
+    db.close_session(session)
+
+
+
+def test_dictionary_encoding_migration_round_trip(tmp_path):
+    db_path = init_db(tmp_path)
+    run_dirs = generate_runs(tmp_path, 2, num_libraries=10, variants_per_library=10)
+    for n, run_dir in enumerate(run_dirs):
+        load_run(db_path, run_dir)
+        load_pangolin_results(db_path, synthetic.generate_pangolin_results(str(tmp_path / 'lineage_report_{}.csv'.format(n)), run_dir, seed=n))
+    variants = read_table(db_path, model.VariantIvar.__table__)
+    pangolin_results = read_table(db_path, model.PangolinResult.__table__)
+    assert variants and pangolin_results
+
+    migrate(db_path, alembic.command.downgrade, 'f1c6d2b8e4a7')
+    assert read_table(db_path, model.VariantIvar.__table__) == variants
+    assert read_table(db_path, model.PangolinResult.__table__) == pangolin_results
+    assert not {'variant_ivar_encoded', 'pangolin_result_encoded'} & set(sa.inspect(sa.create_engine('sqlite:///' + db_path)).get_table_names())
+
+    migrate(db_path, alembic.command.upgrade, 'a9d4e7c2f150')
+    assert read_table(db_path, model.VariantIvar.__table__) == variants
+    assert read_table(db_path, model.PangolinResult.__table__) == pangolin_results
+
 if __name__ == "__main__":
     
     test_truism()